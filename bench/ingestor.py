@@ -0,0 +1,79 @@
+'''Local HTTP stand-in for the spatial ingestor microservice.'''
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import uuid
+
+
+class IngestorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Buffer the response and send it in one segment, otherwise Nagle and
+    # delayed ACKs add ~40ms to every keep-alive request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _reply(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or '{}')
+        self._delay()
+        if self.path.rstrip('/').endswith('/job'):
+            job_id = str(uuid.uuid4())
+            self.server.jobs[job_id] = body
+            self._reply(200, {'job_id': job_id, 'job_key': str(uuid.uuid4())})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_GET(self):
+        self._delay()
+        if '/job/' in self.path:
+            job_id = self.path.rsplit('/', 1)[-1]
+            if job_id in self.server.jobs:
+                self._reply(200, {'status': 'complete', 'logs': [], 'job_id': job_id})
+            else:
+                self._reply(404, {'error': 'unknown job'})
+        elif self.path.rstrip('/').endswith('/queue'):
+            self._reply(200, {'depth': len(self.server.jobs)})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('ETag', '"bench"')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class IngestorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), IngestorHandler)
+        self.latency = latency
+        self.jobs = {}
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
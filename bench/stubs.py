@@ -0,0 +1,618 @@
+'''Stand-ins for the parts of CKAN and Pylons the extension imports.
+
+``install(catalogue, config)`` registers fake ``ckan.*`` and ``pylons``
+modules in ``sys.modules`` so the extension can be imported and driven
+without a CKAN site. Database access goes through :class:`FakeSession`,
+which evaluates the simple single-table queries the extension issues
+against the in-memory :class:`Catalogue`, and core actions come from a
+fake action registry backed by the same catalogue.
+'''
+import imp
+import json
+import operator
+import sys
+import uuid
+
+from sqlalchemy import MetaData
+from sqlalchemy.sql import column, elements, operators, table
+
+TRUE_VALUES = ('true', 'yes', 'on', 'y', 't', '1')
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class ValidationError(Exception):
+    def __init__(self, error_dict, error_summary=None, extra_msg=None):
+        super(ValidationError, self).__init__(error_dict)
+        self.error_dict = error_dict
+
+
+def asbool(obj):
+    if isinstance(obj, basestring):
+        return obj.strip().lower() in TRUE_VALUES
+    return bool(obj)
+
+
+def asint(obj):
+    return int(obj)
+
+
+def aslist(obj, sep=None, strip=True):
+    if isinstance(obj, basestring):
+        items = obj.split(sep)
+        return [i.strip() for i in items if i.strip()] if strip else items
+    elif isinstance(obj, (list, tuple)):
+        return list(obj)
+    elif obj is None:
+        return []
+    return [obj]
+
+
+def get_or_bust(data_dict, keys):
+    single = isinstance(keys, basestring)
+    keys = [keys] if single else keys
+    missing = [k for k in keys if k not in data_dict]
+    if missing:
+        raise ValidationError(dict((k, ['Missing value']) for k in missing))
+    values = [data_dict[k] for k in keys]
+    return values[0] if single else tuple(values)
+
+
+# Tables and mapped classes ---------------------------------------------------
+
+_tables = {
+    'package': table('package', *[column(c) for c in
+                                  ('id', 'name', 'state', 'owner_org', 'creator_user_id', 'metadata_modified')]),
+    'resource': table('resource', *[column(c) for c in
+                                    ('id', 'package_id', 'state', 'format', 'url', 'url_type', 'extras')]),
+    'group': table('group', *[column(c) for c in ('id', 'name', 'is_organization')]),
+    'user': table('user', *[column(c) for c in ('id', 'name', 'apikey', 'sysadmin')]),
+    'activity': table('activity', *[column(c) for c in ('id', 'object_id', 'user_id', 'timestamp')]),
+    'task_status': table('task_status', *[column(c) for c in
+                                          ('id', 'entity_id', 'entity_type', 'task_type', 'key', 'value',
+                                           'state', 'error', 'last_updated')]),
+    'package_extra': table('package_extra', *[column(c) for c in ('id', 'package_id', 'key', 'value', 'state')]),
+}
+
+
+class _Mapped(object):
+    __table_name__ = None
+
+    def __init__(self, **row):
+        self.__dict__.update(row)
+
+    @classmethod
+    def get(cls, reference):
+        rows = _catalogue.tables[cls.__table_name__]
+        row = rows.get(reference)
+        if row is None and 'name' in _tables[cls.__table_name__].c:
+            row = _catalogue.by_name[cls.__table_name__].get(reference)
+        return cls(**row) if row is not None else None
+
+    def as_dict(self):
+        result = dict((k, v) for k, v in self.__dict__.items() if k != 'extras')
+        result.update(self.__dict__.get('extras') or {})
+        return result
+
+
+def _mapped(name, class_name):
+    cls = type(class_name, (_Mapped,), {'__table_name__': name})
+    for col in _tables[name].c:
+        setattr(cls, col.name, col)
+    return cls
+
+
+Package = _mapped('package', 'Package')
+Resource = _mapped('resource', 'Resource')
+Group = _mapped('group', 'Group')
+User = _mapped('user', 'User')
+Activity = _mapped('activity', 'Activity')
+TaskStatus = _mapped('task_status', 'TaskStatus')
+PackageExtra = _mapped('package_extra', 'PackageExtra')
+
+
+# Catalogue ------------------------------------------------------------------
+
+class Catalogue(object):
+    '''In-memory tables, keyed by primary key.'''
+
+    def __init__(self):
+        self.tables = dict((name, {}) for name in _tables)
+        self.by_name = dict((name, {}) for name in _tables)
+        self.executed = []
+        # Statements no handler stands in for, answered with no rows
+        self.unhandled = set()
+        self.outbox = {}
+        self.tasks = {}
+        self.candidate_rows = None
+        self._indexes = {}
+
+    def add(self, table_name, row):
+        self.tables[table_name][row['id']] = row
+        if row.get('name'):
+            self.by_name[table_name][row['name']] = row
+        self._indexes.pop(table_name, None)
+        if table_name == 'task_status':
+            self.tasks[(row['entity_id'], row['task_type'], row['key'])] = row
+        return row
+
+    def lookup(self, table_name, column_name, value):
+        '''Rows with ``column_name == value``, through a lazily built index
+        so the stand-in does not add a table scan to every measured call.'''
+        if column_name == 'id':
+            row = self.tables[table_name].get(value)
+            return [row] if row is not None else []
+        indexes = self._indexes.setdefault(table_name, {})
+        index = indexes.get(column_name)
+        if index is None:
+            index = indexes[column_name] = {}
+            for row in self.tables[table_name].values():
+                index.setdefault(row.get(column_name), []).append(row)
+        return index.get(value, [])
+
+    def resources_of(self, package_id):
+        return self.resources_by_package.get(package_id, [])
+
+    def index(self):
+        self.resources_by_package = {}
+        for row in self.tables['resource'].values():
+            self.resources_by_package.setdefault(row['package_id'], []).append(row)
+
+
+_catalogue = Catalogue()
+
+
+# Query evaluation ------------------------------------------------------------
+
+def _value(clause):
+    if isinstance(clause, elements.BindParameter):
+        return clause.value
+    if isinstance(clause, elements.Grouping):
+        return _value(clause.element)
+    if isinstance(clause, elements.ClauseList):
+        return [_value(c) for c in clause.clauses]
+    if isinstance(clause, (list, tuple)):
+        return [_value(c) for c in clause]
+    return clause
+
+
+_binary_operators = {
+    operators.eq: operator.eq,
+    operators.ne: operator.ne,
+    operators.gt: operator.gt,
+    operators.ge: operator.ge,
+    operators.lt: operator.lt,
+    operators.le: operator.le,
+    operators.in_op: lambda left, right: left in right,
+    operators.notin_op: lambda left, right: left not in right,
+}
+
+
+def _evaluate(clause, row):
+    if isinstance(clause, elements.BooleanClauseList):
+        results = [_evaluate(c, row) for c in clause.clauses]
+        return any(results) if clause.operator is operators.or_ else all(results)
+    if isinstance(clause, elements.BinaryExpression):
+        left = row.get(clause.left.name)
+        right = _value(clause.right)
+        if clause.operator in (operators.in_op, operators.notin_op) and not isinstance(right, list):
+            right = [right]
+        if clause.operator not in _binary_operators:
+            raise NotImplementedError('The benchmark stubs cannot evaluate operator {0} in "{1}"'.format(
+                getattr(clause.operator, '__name__', clause.operator), clause))
+        return _binary_operators[clause.operator](left, right)
+    raise NotImplementedError('The benchmark stubs cannot evaluate {0} clause "{1}"'.format(
+        type(clause).__name__, clause))
+
+
+class FakeQuery(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.criteria = []
+        self.ordering = []
+        self._limit = None
+        self._offset = 0
+
+        first = entities[0]
+        self.table_name = first.__table_name__ if isinstance(first, type) else first.table.name
+
+    def filter(self, *criteria):
+        self.criteria.extend(criteria)
+        return self
+
+    def filter_by(self, **kwargs):
+        self.criteria.extend(_tables[self.table_name].c[k] == v for k, v in kwargs.items())
+        return self
+
+    def order_by(self, *clauses):
+        self.ordering.extend(clauses)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def offset(self, offset):
+        self._offset = offset
+        return self
+
+    def join(self, *args, **kwargs):
+        return self
+
+    def distinct(self):
+        return self
+
+    def _candidates(self):
+        for clause in self.criteria:
+            if isinstance(clause, elements.BinaryExpression) and clause.operator is operators.eq \
+                    and isinstance(clause.right, elements.BindParameter):
+                return _catalogue.lookup(self.table_name, clause.left.name, clause.right.value)
+            if isinstance(clause, elements.BinaryExpression) and clause.operator is operators.in_op \
+                    and clause.left.name == 'id':
+                rows = _catalogue.tables[self.table_name]
+                return [rows[i] for i in _value(clause.right) if i in rows]
+        return _catalogue.tables[self.table_name].values()
+
+    def _rows(self):
+        rows = [row for row in self._candidates() if all(_evaluate(c, row) for c in self.criteria)]
+        for clause in reversed(self.ordering):
+            descending = isinstance(clause, elements.UnaryExpression) and clause.modifier is operators.desc_op
+            name = clause.element.name if isinstance(clause, elements.UnaryExpression) else clause.name
+            rows.sort(key=lambda r: r.get(name), reverse=descending)
+        rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows
+
+    def _project(self, row):
+        if len(self.entities) == 1 and isinstance(self.entities[0], type):
+            return self.entities[0](**row)
+        return tuple(row.get(e.name) for e in self.entities)
+
+    def all(self):
+        return [self._project(r) for r in self._rows()]
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def first(self):
+        rows = self._rows()
+        return self._project(rows[0]) if rows else None
+
+    def count(self):
+        return len(self._rows())
+
+    def update(self, values, synchronize_session=None):
+        rows = self._rows()
+        for row in rows:
+            row.update(values)
+        _catalogue._indexes.pop(self.table_name, None)
+        return len(rows)
+
+
+class FakeResult(object):
+    def __init__(self, rows=(), rowcount=0):
+        self.rows = list(rows)
+        self.rowcount = rowcount or len(self.rows)
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def scalar(self):
+        row = self.fetchone()
+        return row[0] if row else None
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    def execution_options(self, **kwargs):
+        return self
+
+    def execute(self, statement, *multiparams, **params):
+        return FakeSession.execute(statement, multiparams[0] if multiparams else params)
+
+
+class FakeSession(object):
+    '''Replaces ``model.Session``. Raw SQL is recorded and answered by the
+    handlers in ``sql_handlers``, keyed by a prefix of the statement.'''
+
+    sql_handlers = []
+
+    @classmethod
+    def query(cls, *entities):
+        return FakeQuery(entities)
+
+    @classmethod
+    def execute(cls, statement, params=None):
+        sql = ' '.join(unicode(statement).split())
+        _catalogue.executed.append(sql)
+        for needle, handler in cls.sql_handlers:
+            if needle in sql:
+                return handler(sql, params or {})
+        _catalogue.unhandled.add(sql)
+        return FakeResult()
+
+    @classmethod
+    def connection(cls):
+        return FakeConnection()
+
+    @classmethod
+    def add(cls, obj):
+        _catalogue.add(obj.__table_name__, dict(obj.__dict__))
+
+    @classmethod
+    def flush(cls):
+        pass
+
+    commit = rollback = remove = flush
+
+
+def _discovery_handler(sql, params):
+    '''Answers discovery.iter_candidates from the precomputed candidate rows.'''
+    package_ids = params.get('package_ids')
+    if package_ids is not None:
+        rows = []
+        for package_id in package_ids:
+            rows.extend(_catalogue.candidate_rows.get(package_id, []))
+    else:
+        rows = [row for package_id in sorted(_catalogue.candidate_rows)
+                for row in _catalogue.candidate_rows[package_id]]
+    if 'WHERE spatial_parent' in sql:
+        rows = [row for row in rows if row[3]]
+    return FakeResult(rows)
+
+
+def _outbox_insert_handler(sql, params):
+    '''Keeps one pending entry per operation and entity, like the partial
+    unique index of the real outbox.'''
+    _catalogue.outbox[(params['operation'], params['entity_id'])] = params
+    return FakeResult()
+
+
+def _task_status_handler(sql, params):
+    '''Applies lifecycle.transition upserts and updates to the task table.'''
+    row = _catalogue.tasks.get((params['entity_id'], params['task_type'], params['key']))
+    if row is None:
+        if not sql.startswith('INSERT'):
+            return FakeResult()
+        row = _catalogue.add('task_status', {
+            'id': params['id'], 'entity_id': params['entity_id'], 'entity_type': 'resource',
+            'task_type': params['task_type'], 'key': params['key'], 'value': params['initial_value'],
+            'error': params['initial_error']})
+    elif 'if_state' in params and row.get('state') != params['if_state']:
+        return FakeResult()
+    elif 'if_value' in params and any(json.loads(row['value'] or '{}').get(k) != v
+                                      for k, v in json.loads(params['if_value']).items()):
+        return FakeResult()
+    elif 'jsonb' in sql:
+        row['value'] = json.dumps(dict(json.loads(row['value'] or '{}'), **json.loads(params['value'])))
+    elif 'value' in params:
+        row['value'] = params['value']
+    if 'error' in params:
+        row['error'] = params['error']
+    row['state'] = params['state']
+    if 'task_status.last_updated' not in sql:
+        row['last_updated'] = params['now']
+    columns = ('id', 'entity_id', 'entity_type', 'task_type', 'key', 'value', 'state', 'error', 'last_updated')
+    return FakeResult([tuple(row.get(c) for c in columns)])
+
+
+def _orphans_handler(sql, params):
+    '''Applies orphans.collect from the precomputed candidate rows.'''
+    package_ids = params.get('package_ids')
+    if package_ids is None:
+        package_ids = list(_catalogue.candidate_rows)
+    rows = []
+    for package_id in package_ids:
+        candidates = _catalogue.candidate_rows.get(package_id, [])
+        parents = set(c[1] for c in candidates if c[3])
+        for c in candidates:
+            if c[4] and c[4] not in parents:
+                rows.append((package_id,))
+    return FakeResult(rows)
+
+
+FakeSession.sql_handlers.append(('UPDATE resource r', _orphans_handler))
+FakeSession.sql_handlers.append(('FROM resource r JOIN package p', _discovery_handler))
+FakeSession.sql_handlers.append(('INSERT INTO task_status', _task_status_handler))
+FakeSession.sql_handlers.append(('UPDATE task_status', _task_status_handler))
+FakeSession.sql_handlers.append(('INSERT INTO spatialingestor_outbox', _outbox_insert_handler))
+# Job history is write only on the benchmarked paths
+FakeSession.sql_handlers.append(('INSERT INTO spatialingestor_job_history', lambda sql, params: FakeResult()))
+
+
+# Action registry --------------------------------------------------------------
+
+class ActionRegistry(dict):
+    def get_action(self, name):
+        action = self[name]
+
+        def wrapped(context, data_dict):
+            context = context if context is not None else {}
+            context.setdefault('model', sys.modules['ckan.model'])
+            context.setdefault('session', FakeSession)
+            context.setdefault('user', 'bench')
+            return action(context, data_dict)
+        return wrapped
+
+
+def _not_found(table_name, reference):
+    raise ObjectNotFound('{0} {1} not found'.format(table_name, reference))
+
+
+def resource_show(context, data_dict):
+    row = _catalogue.tables['resource'].get(data_dict['id']) or _not_found('resource', data_dict['id'])
+    return Resource(**row).as_dict()
+
+
+def package_show(context, data_dict):
+    row = _catalogue.tables['package'].get(data_dict['id']) or \
+        _catalogue.by_name['package'].get(data_dict['id']) or _not_found('package', data_dict['id'])
+    package = dict(row)
+    package['resources'] = [Resource(**r).as_dict() for r in _catalogue.resources_of(row['id'])]
+    organization = _catalogue.tables['group'].get(row['owner_org'])
+    package['organization'] = dict(organization) if organization else None
+    return package
+
+
+def resource_update(context, data_dict):
+    row = _catalogue.tables['resource'].get(data_dict['id']) or _not_found('resource', data_dict['id'])
+    columns = set(c.name for c in _tables['resource'].c)
+    extras = dict(row.get('extras') or {})
+    for key, value in data_dict.items():
+        if key in columns:
+            row[key] = value
+        else:
+            extras[key] = value
+    row['extras'] = extras
+    return Resource(**row).as_dict()
+
+
+def user_show(context, data_dict):
+    row = _catalogue.tables['user'].get(data_dict['id']) or \
+        _catalogue.by_name['user'].get(data_dict['id']) or _not_found('user', data_dict['id'])
+    return dict(row)
+
+
+def get_site_user(context, data_dict):
+    return user_show(context, {'id': 'site_user'})
+
+
+def _find_task(data_dict):
+    return _catalogue.tasks.get((data_dict.get('entity_id'), data_dict.get('task_type'), data_dict.get('key')))
+
+
+def task_status_show(context, data_dict):
+    if data_dict.get('id'):
+        row = _catalogue.tables['task_status'].get(data_dict['id'])
+    else:
+        row = _find_task(data_dict)
+    return dict(row) if row else _not_found('task_status', data_dict)
+
+
+def task_status_update(context, data_dict):
+    row = _catalogue.tables['task_status'].get(data_dict.get('id')) or _find_task(data_dict)
+    if row is None:
+        row = _catalogue.add('task_status', dict(data_dict, id=data_dict.get('id') or str(uuid.uuid4())))
+    else:
+        row.update(data_dict)
+    return dict(row)
+
+
+core_actions = {
+    'resource_show': resource_show,
+    'package_show': package_show,
+    'resource_update': resource_update,
+    'user_show': user_show,
+    'get_site_user': get_site_user,
+    'task_status_show': task_status_show,
+    'task_status_update': task_status_update,
+}
+
+
+# Module installation ----------------------------------------------------------
+
+def _module(name, **attrs):
+    module = imp.new_module(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent in sys.modules:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+class _Interface(object):
+    pass
+
+
+class _SingletonPlugin(object):
+    pass
+
+
+def _auth_allowed(context, data_dict):
+    return {'success': True}
+
+
+def install(catalogue, config):
+    '''Register the stand-in modules and return the action registry.'''
+    global _catalogue
+    _catalogue = catalogue
+
+    registry = ActionRegistry(core_actions)
+
+    _module('pylons', config=config)
+
+    toolkit_attrs = dict(
+        get_action=registry.get_action,
+        check_access=lambda name, context, data_dict=None: True,
+        asbool=asbool, asint=asint, aslist=aslist,
+        ValidationError=ValidationError, ObjectNotFound=ObjectNotFound, NotAuthorized=NotAuthorized,
+        add_template_directory=lambda config, path: None,
+        add_public_directory=lambda config, path: None,
+        _=lambda s: s, c=None, request=None,
+    )
+
+    _module('ckan')
+    _module('ckan.common', _=lambda s: s, c=None, request=None)
+    _module('ckan.plugins', SingletonPlugin=_SingletonPlugin, Interface=_Interface,
+            implements=lambda *args, **kwargs: None,
+            PluginImplementations=lambda interface: [],
+            **dict((name, type(name, (_Interface,), {})) for name in (
+                'IConfigurer', 'IConfigurable', 'IActions', 'IAuthFunctions', 'IResourceUrlChange',
+                'IDomainObjectModification', 'ITemplateHelpers', 'IRoutes', 'IPackageController', 'IMiddleware')))
+    _module('ckan.plugins.toolkit', **toolkit_attrs)
+
+    _module('ckan.model', Session=FakeSession, Package=Package, Resource=Resource, Group=Group, User=User,
+            Activity=Activity, TaskStatus=TaskStatus, PackageExtra=PackageExtra, State=type(
+                'State', (object,), {'ACTIVE': u'active', 'DELETED': u'deleted'}))
+    _module('ckan.model.meta', metadata=MetaData(), engine=None, Session=FakeSession)
+    _module('ckan.model.types', make_uuid=lambda: unicode(uuid.uuid4()))
+    _module('ckan.model.domain_object', DomainObjectOperation=type(
+        'DomainObjectOperation', (object,), {'new': 'new', 'changed': 'changed', 'deleted': 'deleted'}))
+
+    _module('ckan.logic', get_or_bust=get_or_bust, NotFound=ObjectNotFound, NotAuthorized=NotAuthorized,
+            ValidationError=ValidationError, get_action=registry.get_action)
+    _module('ckan.logic.auth')
+    for name in ('create', 'delete', 'get', 'update'):
+        _module('ckan.logic.auth.' + name, resource_create=_auth_allowed, resource_delete=_auth_allowed,
+                resource_show=_auth_allowed, package_update=_auth_allowed, organization_update=_auth_allowed)
+
+    _module('ckan.lib')
+    _module('ckan.lib.base', BaseController=object, render=lambda *a, **k: '', redirect=lambda *a, **k: None,
+            abort=lambda *a, **k: None)
+    _module('ckan.lib.helpers', url_for=lambda *a, **k: '/')
+    _module('ckan.lib.cli', parse_db_config=lambda key: _parse_db_config(config[key]), CkanCommand=object)
+    _module('ckan.lib.navl')
+    _module('ckan.lib.navl.dictization_functions', validate=lambda data, schema, context=None: (data, {}))
+    _module('ckan.lib.search', rebuild=lambda *a, **k: None, commit=lambda: None)
+    _module('ckan.lib.uploader', get_resource_uploader=lambda data_dict: type(
+        'Upload', (object,), {'get_path': lambda self, id: '/nonexistent/' + id})())
+
+    return registry
+
+
+def _parse_db_config(url):
+    import urlparse
+    parsed = urlparse.urlparse(url)
+    return {'db_type': parsed.scheme, 'db_user': parsed.username, 'db_pass': parsed.password,
+            'db_host': parsed.hostname, 'db_port': parsed.port, 'db_name': parsed.path.lstrip('/')}
@@ -0,0 +1,160 @@
+import datetime
+import json
+import logging
+import time
+
+import requests
+from ckan import model
+from sqlalchemy import text
+
+from ckanext.spatialingestor import lifecycle, metrics, outbox, settings
+from ckanext.spatialingestor.client import get_client
+from ckanext.spatialingestor.scheduler import IN_FLIGHT_STATES
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+# task_status state of submissions held back while the microservice is busy
+DEFERRED = 'deferred'
+
+# Held back submissions of interactive changes go before bulk ones, then oldest first
+_RELEASE = '''
+    UPDATE task_status SET state = 'submitting', last_updated = :now
+    WHERE id IN (
+        SELECT id FROM task_status
+        WHERE key = :key AND state = :deferred
+        ORDER BY coalesce(CAST(value::json -> 'deferred' ->> 'bulk' AS boolean), false), last_updated
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED)
+    RETURNING entity_id, task_type'''
+
+
+def enabled():
+    return settings.get().admission_high_water > 0
+
+
+def in_flight():
+    '''Number of jobs the microservice has not finished yet, according to
+    ``task_status``.'''
+    params = {'key': lifecycle.KEY,
+              'states': IN_FLIGHT_STATES,
+              'cutoff': datetime.datetime.utcnow() - datetime.timedelta(
+                  seconds=settings.get().scheduler_in_flight_timeout)}
+    return model.Session.execute(text('''
+        SELECT count(*) FROM task_status
+        WHERE key = :key AND state IN :states AND last_updated > :cutoff'''), params).scalar()
+
+
+_queue_depth = [0, None]
+
+
+def queue_depth():
+    '''Queue depth reported by the microservice at
+    ``ckan.spatialingestor.admission.queue_path``, cached for
+    ``ckan.spatialingestor.admission.queue_ttl`` seconds, or None if it is
+    not configured or cannot be read.'''
+    current = settings.get()
+    if not current.admission_queue_path:
+        return None
+    now = time.time()
+    if _queue_depth[0] > now:
+        return _queue_depth[1]
+
+    depth = None
+    try:
+        r = get_client().get(current.admission_queue_path, headers={'Content-Type': 'application/json'})
+        r.raise_for_status()
+        body = r.json()
+        depth = int(body['depth'] if isinstance(body, dict) else body)
+    except (requests.exceptions.RequestException, KeyError, TypeError, ValueError), e:
+        log.debug('Could not read the spatial ingestor queue depth: {0}'.format(e))
+    _queue_depth[:] = [now + current.admission_queue_ttl, depth]
+    return depth
+
+
+def load():
+    '''Jobs queued or running at the microservice: the local count, or the
+    depth it reports if that is higher.'''
+    return max(in_flight(), queue_depth() or 0)
+
+
+def admit(bulk=False):
+    '''Whether a submission can go to the microservice now.
+
+    Bulk submissions (``reingestall``, ``purgeall``) are held back above
+    ``ckan.spatialingestor.admission.high_water`` jobs, others only once
+    ``ckan.spatialingestor.admission.reserve`` more are queued.
+    '''
+    current = settings.get()
+    if not current.admission_high_water:
+        return True
+    limit = current.admission_high_water + (0 if bulk else current.admission_reserve)
+    admitted = load() < limit
+    metrics.inc('admission_total', outcome='admitted' if admitted else 'deferred', bulk=bool(bulk))
+    return admitted
+
+
+def _deferred_value(data_dict, bulk):
+    return {'deferred': {'fingerprint': data_dict.get('fingerprint'),
+                         'resume': data_dict.get('resume', False),
+                         'package_name': data_dict.get('package_name'),
+                         'bulk': bool(bulk)},
+            'fingerprint': data_dict.get('fingerprint')}
+
+
+def defer(resource_id, job_type, data_dict, bulk=False):
+    '''Hold back a submission until :func:`release` lets it through.'''
+    lifecycle.transition(resource_id, job_type, DEFERRED, value=_deferred_value(data_dict, bulk), error={})
+
+
+def hold(resource_id, job_type, data_dict):
+    '''Put a released submission that could not be sent back in the
+    ``submitting`` state, for :func:`submission` to find on the next try.'''
+    lifecycle.transition(resource_id, job_type, 'submitting', value=_deferred_value(data_dict, False))
+
+
+def release(limit=None, commit=True):
+    '''Queue held back submissions for the worker, as many as the
+    microservice has room for below the high-water mark.
+
+    The tasks are moved to ``submitting`` at once, so they count as in
+    flight and concurrent callers do not release the same capacity twice.
+
+    :returns: number of submissions released
+    '''
+    if not enabled():
+        return 0
+    if limit is None:
+        limit = settings.get().admission_high_water - load()
+    if limit <= 0:
+        return 0
+    rows = model.Session.execute(text(_RELEASE), {'now': datetime.datetime.utcnow(),
+                                                  'key': lifecycle.KEY,
+                                                  'deferred': DEFERRED,
+                                                  'limit': limit}).fetchall()
+    for resource_id, job_type in rows:
+        # Keyed by job type so an ingest and a purge of the same resource merge
+        outbox.enqueue(outbox.RELEASE, resource_id, {job_type: True})
+    if commit:
+        model.Session.commit()
+    if rows:
+        metrics.inc('admission_released_total', len(rows))
+        log.debug('Released {0} deferred submissions'.format(len(rows)))
+    return len(rows)
+
+
+def submission(resource_id, job_type):
+    '''The ``spatialingestor_job_submit`` arguments of a released
+    submission, or None if it was superseded in the meantime.'''
+    task = lifecycle.get(resource_id, job_type)
+    if task is None or task['state'] != 'submitting':
+        return None
+    deferred = json.loads(task['value'] or '{}').get('deferred')
+    if deferred is None:
+        return None
+    data_dict = {'resource_id': resource_id,
+                 'job_type': job_type,
+                 'fingerprint': deferred.get('fingerprint'),
+                 'resume': deferred.get('resume', False)}
+    if deferred.get('package_name'):
+        data_dict['package_name'] = deferred['package_name']
+    return data_dict
@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+
+from ckan import model
+from sqlalchemy import or_
+
+from ckanext.spatialingestor import metrics
+from ckanext.spatialingestor import settings as settings_module
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+
+class Blacklist(object):
+    '''Evaluates the organization, package and user blacklists.
+
+    The configured names are parsed once when the engine is built and
+    resolved to IDs on use, again every ``ttl`` seconds so organizations
+    and datasets created or renamed since are matched. Per-package
+    results are kept for ``ttl`` seconds so repeated checks of the same
+    dataset (template renders, bulk edits) do not hit the database again.
+    '''
+
+    max_cache_size = 10000
+
+    def __init__(self, org_names=(), pkg_names=(), user_names=(), ttl=30):
+        self.org_names = frozenset(org_names)
+        self.pkg_names = frozenset(pkg_names)
+        self.user_names = frozenset(user_names)
+        self.ttl = ttl
+
+        self._org_ids = None
+        self._pkg_ids = None
+        self._user_ids = None
+        self._resolved_until = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(org_names=settings.org_blacklist,
+                   pkg_names=settings.pkg_blacklist,
+                   user_names=settings.user_blacklist,
+                   ttl=settings.blacklist_cache_ttl)
+
+    @property
+    def empty(self):
+        return not (self.org_names or self.pkg_names or self.user_names)
+
+    def _resolve(self):
+        now = time.time()
+        if self._resolved_until > now:
+            return
+
+        def ids_for(table, names):
+            if not names:
+                return frozenset()
+            rows = model.Session.query(table.id).filter(
+                or_(table.name.in_(names), table.id.in_(names))).all()
+            return frozenset(r[0] for r in rows)
+
+        org_ids = ids_for(model.Group, self.org_names)
+        pkg_ids = ids_for(model.Package, self.pkg_names)
+        user_ids = ids_for(model.User, self.user_names)
+
+        if self._user_ids is None:
+            unresolved = len(self.user_names) - len(user_ids)
+            if unresolved > 0:
+                log.warning("{0} blacklisted user(s) could not be resolved".format(unresolved))
+
+        self._org_ids, self._pkg_ids, self._user_ids = org_ids, pkg_ids, user_ids
+        self._resolved_until = now + self.ttl
+
+    def last_editor(self, package_id, creator_user_id=None):
+        row = model.Session.query(model.Activity.user_id) \
+            .filter(model.Activity.object_id == package_id) \
+            .order_by(model.Activity.timestamp.desc()) \
+            .first()
+        return row[0] if row else creator_user_id
+
+    def _evaluate(self, package_id):
+        self._resolve()
+
+        row = model.Session.query(model.Package.owner_org, model.Package.creator_user_id) \
+            .filter(model.Package.id == package_id) \
+            .first()
+        if row is None:
+            return False
+        owner_org, creator_user_id = row
+
+        if owner_org in self._org_ids:
+            log.info("{0} in organization blacklist".format(owner_org))
+            return True
+        elif package_id in self._pkg_ids:
+            log.info("{0} in package blacklist".format(package_id))
+            return True
+        elif self._user_ids:
+            last_user = self.last_editor(package_id, creator_user_id)
+            if last_user in self._user_ids:
+                log.info("{0} was last edited by blacklisted user {1}".format(package_id, last_user))
+                return True
+
+        return False
+
+    def is_package_blacklisted(self, package_id):
+        if self.empty:
+            return False
+
+        now = time.time()
+        cached = self._cache.get(package_id)
+        if cached and cached[0] > now:
+            metrics.inc('blacklist_checks_total', cache='hit')
+            return cached[1]
+
+        metrics.inc('blacklist_checks_total', cache='miss')
+        with metrics.timer('blacklist_check_seconds'):
+            result = self._evaluate(package_id)
+        with self._lock:
+            if len(self._cache) >= self.max_cache_size:
+                self._cache = dict((k, v) for k, v in self._cache.iteritems() if v[0] > now)
+            self._cache[package_id] = (now + self.ttl, result)
+        return result
+
+    def is_resource_blacklisted(self, resource):
+        return self.is_package_blacklisted(resource['package_id'])
+
+    def invalidate(self, package_id=None):
+        with self._lock:
+            if package_id is None:
+                self._cache.clear()
+                self._resolved_until = 0
+            else:
+                self._cache.pop(package_id, None)
+
+
+_blacklist = None
+
+
+def get_blacklist():
+    global _blacklist
+    if _blacklist is None:
+        _blacklist = Blacklist.from_settings(settings_module.get())
+    return _blacklist
+
+
+def load(settings):
+    global _blacklist
+    _blacklist = Blacklist.from_settings(settings)
+    return _blacklist
@@ -0,0 +1,75 @@
+import json
+import logging
+
+from ckan import logic, model
+from ckan.plugins import toolkit
+
+from ckanext.spatialingestor import metrics, settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+            409: 'Conflict', 500: 'Internal Server Error'}
+
+
+class HookMiddleware(object):
+    '''Serves job callbacks signed with a callback token at
+    :data:`settings.HOOK_PATH`, ahead of the Pylons stack.
+
+    The token is checked by ``spatialingestor_hook`` itself, so these
+    requests skip API key identification, the user lookup and the
+    authorization checks of the action API. Everything else is passed on
+    to ``app``. The body is a ``spatialingestor_hook`` payload, or
+    ``{'callbacks': [...]}`` for ``spatialingestor_hook_batch``.
+    '''
+
+    def __init__(self, app, path=settings.HOOK_PATH):
+        self.app = app
+        self.path = path
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != self.path:
+            return self.app(environ, start_response)
+
+        with metrics.timer('hook_request_seconds'):
+            status, body = self.handle(environ)
+        payload = json.dumps(body)
+        start_response('{0} {1}'.format(status, _REASONS[status]),
+                       [('Content-Type', 'application/json;charset=utf-8'), ('Content-Length', str(len(payload)))])
+        return [payload]
+
+    def handle(self, environ):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return 405, {'success': False, 'error': {'message': 'Only POST is allowed'}}
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            data_dict = json.loads(environ['wsgi.input'].read(length))
+            if not isinstance(data_dict, dict):
+                raise ValueError('Expected a JSON object')
+        except ValueError, e:
+            return 400, {'success': False, 'error': {'message': 'Bad request: {0}'.format(e)}}
+
+        if 'callbacks' in data_dict:
+            action, tokens = 'spatialingestor_hook_batch', [
+                (c.get('metadata') or {}).get('callback_token') for c in data_dict['callbacks']
+                if isinstance(c, dict)]
+        else:
+            action, tokens = 'spatialingestor_hook', [(data_dict.get('metadata') or {}).get('callback_token')]
+        if not all(tokens):
+            return 403, {'success': False, 'error': {'message': 'A callback token is required'}}
+
+        context = {'model': model, 'session': model.Session, 'user': ''}
+        try:
+            result = toolkit.get_action(action)(context, data_dict)
+            return 200, {'success': True, 'result': result}
+        except logic.NotAuthorized, e:
+            return 403, {'success': False, 'error': {'message': str(e)}}
+        except logic.NotFound, e:
+            return 404, {'success': False, 'error': {'message': str(e)}}
+        except logic.ValidationError, e:
+            return 409, {'success': False, 'error': e.error_dict}
+        except Exception:
+            log.exception('Failed to process a job callback')
+            return 500, {'success': False, 'error': {'message': 'Internal server error'}}
+        finally:
+            model.Session.remove()
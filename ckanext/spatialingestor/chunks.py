@@ -0,0 +1,166 @@
+import datetime
+import json
+import logging
+
+from ckan import model
+from ckan.model import meta
+from sqlalchemy import Column, Table, exc, text, types
+
+from ckanext.spatialingestor import settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+# Split into tiles, everything else into feature ranges
+RASTER_FORMATS = ('GRID', 'GEOTIFF')
+
+STATES = ('pending', 'running', 'complete', 'error')
+
+chunk_table = Table(
+    'spatialingestor_chunk', meta.metadata,
+    Column('resource_id', types.UnicodeText, primary_key=True),
+    Column('chunk_index', types.Integer, primary_key=True),
+    Column('job_id', types.UnicodeText),
+    Column('state', types.UnicodeText, nullable=False, default=u'pending'),
+    Column('attempts', types.Integer, nullable=False, default=0),
+    Column('detail', types.UnicodeText),
+    Column('error', types.UnicodeText),
+    Column('last_updated', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+
+class ChunksNotReady(Exception):
+    pass
+
+
+def setup():
+    '''Create the chunk table if it does not exist yet.'''
+    if not chunk_table.exists(bind=meta.engine):
+        chunk_table.create(bind=meta.engine)
+        log.info('Created table {0}'.format(chunk_table.name))
+
+
+_ready = False
+
+
+def ensure_setup():
+    '''Run :func:`setup` once per process, so jobs keep working on a site
+    upgraded without running ``initdb``.
+
+    :raises ChunksNotReady: if the table is missing and cannot be created
+    '''
+    global _ready
+    if _ready:
+        return
+    try:
+        setup()
+    except exc.SQLAlchemyError, e:
+        # Another process may have created it in the meantime
+        if not chunk_table.exists(bind=meta.engine):
+            raise ChunksNotReady('The {0} table is missing and could not be created ({1}), run '
+                        '`paster --plugin=ckanext-spatialingestor spatialingestor initdb`'.format(
+                            chunk_table.name, e))
+    _ready = True
+
+
+def plan(size, input_format):
+    '''How the microservice should split a job, or None to run it whole.
+
+    Files of at least ``ckan.spatialingestor.chunk_min_size`` bytes are
+    split, rasters into tiles of ``chunk_tile_size`` pixels and vector
+    layers into ranges of ``chunk_features`` features.
+    '''
+    current = settings.get()
+    try:
+        size = int(size or 0)
+    except (TypeError, ValueError):
+        return None
+    if not current.chunk_min_size or size < current.chunk_min_size:
+        return None
+    if input_format in RASTER_FORMATS:
+        return {'strategy': 'tiles', 'tile_size': current.chunk_tile_size}
+    return {'strategy': 'features', 'features_per_chunk': current.chunk_features}
+
+
+def start(resource_id, resume=False):
+    '''Prepare the chunk records of a new job.
+
+    :param resume: keep the chunks completed by the previous job so the
+        microservice can skip them, otherwise start from scratch
+    :returns: indexes of the chunks that are already complete
+    '''
+    ensure_setup()
+    params = {'resource_id': resource_id}
+    if not resume:
+        model.Session.execute(text('DELETE FROM spatialingestor_chunk WHERE resource_id = :resource_id'), params)
+        return []
+    model.Session.execute(text('''DELETE FROM spatialingestor_chunk
+                                 WHERE resource_id = :resource_id AND state <> 'complete' '''), params)
+    rows = model.Session.execute(text('''SELECT chunk_index FROM spatialingestor_chunk
+                                        WHERE resource_id = :resource_id ORDER BY chunk_index'''), params)
+    return [r[0] for r in rows]
+
+
+def validate(chunk):
+    ''':raises ValueError: if the chunk of a callback has no valid index or status'''
+    if not isinstance(chunk, dict):
+        raise ValueError('Expected a chunk object')
+    try:
+        int(chunk['index'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Missing or invalid chunk index')
+    if chunk.get('status') not in STATES:
+        raise ValueError('Unknown chunk status {0!r}'.format(chunk.get('status')))
+
+
+def record(resource_id, job_id, chunk):
+    '''Store the progress of one chunk reported by a job callback.
+
+    :param chunk: ``{'index': <int>, 'status': <state>, ...}``; other keys
+        (rows, extent, timings) are kept as the chunk detail
+    :returns: whether a failed chunk should be tried again
+    :raises ValueError: if the chunk index or status is invalid
+    '''
+    validate(chunk)
+    ensure_setup()
+    status = chunk['status']
+
+    row = model.Session.execute(
+        text('''INSERT INTO spatialingestor_chunk
+                    (resource_id, chunk_index, job_id, state, attempts, detail, error, last_updated)
+                VALUES (:resource_id, :chunk_index, :job_id, :state, :failed, :detail, :error, :now)
+                ON CONFLICT (resource_id, chunk_index) DO UPDATE SET
+                    job_id = EXCLUDED.job_id, state = EXCLUDED.state,
+                    attempts = spatialingestor_chunk.attempts + EXCLUDED.attempts,
+                    detail = EXCLUDED.detail, error = EXCLUDED.error, last_updated = EXCLUDED.last_updated
+                RETURNING attempts'''),
+        {'resource_id': resource_id,
+         'chunk_index': int(chunk['index']),
+         'job_id': job_id,
+         'state': status,
+         'failed': 1 if status == 'error' else 0,
+         'detail': json.dumps(dict((k, v) for k, v in chunk.items() if k not in ('index', 'status', 'error'))),
+         'error': json.dumps(chunk.get('error')) if chunk.get('error') else None,
+         'now': datetime.datetime.utcnow()}).fetchone()
+
+    return status == 'error' and row[0] < settings.get().chunk_max_attempts
+
+
+def summary(resource_id, count=None):
+    '''Chunks of a resource per state, for the status page.
+
+    :param count: number of chunks of the job, if the microservice said;
+        chunks it has not reported on yet count as pending
+    '''
+    ensure_setup()
+    rows = model.Session.execute(
+        text('''SELECT state, count(*) FROM spatialingestor_chunk
+                WHERE resource_id = :resource_id GROUP BY state'''),
+        {'resource_id': resource_id}).fetchall()
+    states = dict((state, 0) for state in STATES)
+    states.update((r[0], r[1]) for r in rows)
+    reported = sum(states.values())
+    total = max(count or 0, reported)
+    states['pending'] += total - reported
+    states['count'] = total
+    states['progress'] = int(100 * states['complete'] / total) if total else 0
+    return states
@@ -1,30 +1,75 @@
 # encoding: utf-8
+import datetime
+import os
 import sys
+from multiprocessing.pool import ThreadPool
 
 import psycopg2
-import requests
 from ckan import model
 from ckan.lib import cli
 from ckan.plugins import toolkit
-from pylons import config
 
+from ckanext.spatialingestor import (chunks, discovery, extent, history, memo, orphans, outbox, planner, reconcile,
+                                     settings)
 from ckanext.spatialingestor.helpers import log
-from ckanext.spatialingestor.plugin import _ingest_resource as ingest_resource, _purge_resource as purge_resource
+from ckanext.spatialingestor.scheduler import Scheduler
+from ckanext.spatialingestor.worker import OutboxWorker, job_context
+
+
+def _resource_dict(resource_id):
+    return model.Resource.get(resource_id).as_dict()
 
 
 class SpatialIngestorCommand(cli.CkanCommand):
     '''Perform commands in the spatialingestor
     Usage:
         purge <pkgname> - Purges spatial child resources from pkgname
-        purgeall - Purges spatial child resources from all packages
+        purgeall [--workers N] [--batch-size N] [--checkpoint FILE] [--plan FILE] - Purges spatial child
+            resources from all packages
         reingest <pkgname> - Reingest child resources from pkgname
-        reingestall - Reingest all resources from all packages
+        reingestall [--workers N] [--batch-size N] [--checkpoint FILE] [--plan FILE] - Reingest all
+            resources from all packages
         purgelegacyall - Purges all artifacts from old spatial ingestor
+        orphans - Deletes spatial child resources whose parent is gone, across all packages
+        reconcile [--dry-run] [--incremental] [--batch-size N] [--yes] - Finds and repairs drift between
+            CKAN, PostGIS and GeoServer, dropping leftover tables and workspaces only with --yes
+        compact [--dry-run] [--older-than DAYS] - Deletes stale error and submitting tasks and expired
+            job history
+        stats [--group-by COLUMN] - Summarizes job durations and outcomes from the job history
+        plan <reingestall|purgeall> [--plan FILE] [--concurrency N] - Counts and estimates what the
+            command would do without changing anything, and writes the plan it can run with --plan
+        extent [--batch-size N] - Writes the spatial extent of every ingested dataset and reindexes them
+        initdb - Creates the job outbox, chunk and history tables
+        worker [--workers N] - Runs the worker pool that submits queued jobs
     '''
 
     summary = __doc__.split('\n')[0]
     usage = __doc__
 
+    def __init__(self, name):
+        super(SpatialIngestorCommand, self).__init__(name)
+
+        self.parser.add_option('-w', '--workers', dest='workers', type='int', default=4,
+                               help='Number of concurrent workers')
+        self.parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=100,
+                               help='Number of packages handed to the workers at a time')
+        self.parser.add_option('--checkpoint', dest='checkpoint', default=None,
+                               help='File recording processed packages, used to resume purgeall/reingestall')
+        self.parser.add_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                               help='Only report what reconcile or compact would change')
+        self.parser.add_option('--yes', dest='yes', action='store_true', default=False,
+                               help='Let reconcile drop leftover tables and workspaces')
+        self.parser.add_option('--incremental', dest='incremental', action='store_true', default=False,
+                               help='Only reconcile datasets modified since the last reconcile')
+        self.parser.add_option('--older-than', dest='older_than', type='int', default=None,
+                               help='Days after which compact deletes error and submitting tasks')
+        self.parser.add_option('--plan', dest='plan', default=None,
+                               help='Plan file written by plan, limiting purgeall/reingestall to its datasets')
+        self.parser.add_option('--concurrency', dest='concurrency', type='int', default=None,
+                               help='Jobs the microservice runs at a time, for the estimates of plan')
+        self.parser.add_option('--group-by', dest='group_by', default='input_format',
+                               help='Column stats groups by: {0}'.format(', '.join(history.GROUP_BY)))
+
     def command(self):
         if self.args and self.args[0] == 'purge':
             if len(self.args) != 2:
@@ -65,150 +110,301 @@ class SpatialIngestorCommand(cli.CkanCommand):
             self._confirm_or_abort()
 
             self._load_config()
-            self._submit_package(self.args[1])
+            self._purge_legacy_all()
+        elif self.args and self.args[0] == 'orphans':
+            self._load_config()
+            deleted = orphans.collect()
+            print "Deleted {0} orphaned spatial resources".format(deleted)
+        elif self.args and self.args[0] == 'reconcile':
+            if not self.options.dry_run:
+                self._confirm_or_abort()
+
+            self._load_config()
+            self._reconcile()
+        elif self.args and self.args[0] == 'initdb':
+            self._load_config()
+            outbox.setup()
+            chunks.setup()
+            history.setup()
+        elif self.args and self.args[0] == 'compact':
+            self._load_config()
+            self._compact()
+        elif self.args and self.args[0] == 'stats':
+            self._load_config()
+            self._stats()
+        elif self.args and self.args[0] == 'plan':
+            if len(self.args) != 2:
+                print "This command requires an argument\n"
+                print self.usage
+                sys.exit(1)
+
+            self._load_config()
+            self._plan(self.args[1])
+        elif self.args and self.args[0] == 'extent':
+            self._load_config()
+            self._extent()
+        elif self.args and self.args[0] == 'worker':
+            self._load_config()
+            self._worker()
         else:
             print self.usage
 
-    def _purge(self, pkg_id):
-        pkg_dict = model.Package.get(pkg_id).as_dict()
-
-        log.info("Purging spatially ingested resources from package {0}...".format(pkg_dict['name']))
+    def _worker(self):
+        outbox.setup()
+        current = settings.get()
+        OutboxWorker(workers=self.options.workers,
+                     poll_interval=current.worker_poll_interval,
+                     max_attempts=current.worker_max_attempts,
+                     scheduler=Scheduler.from_settings(current)).run()
+
+    def _reconcile(self):
+        def report(drift):
+            print '{0:<20} {1}'.format(drift.kind, drift.name)
+
+        counts = reconcile.reconcile(incremental=self.options.incremental, dry_run=self.options.dry_run,
+                                     batch_size=self.options.batch_size, report=report, drop=self.options.yes)
+
+        print '\n>>> {0} drift found{1}'.format(
+            ', '.join('{0} {1}'.format(v, k) for k, v in sorted(counts.items())) or 'No',
+            ' (dry run, nothing repaired)' if self.options.dry_run else '')
+        dropped = (reconcile.ORPHANED_TABLE, reconcile.ORPHANED_WORKSPACE)
+        if not self.options.dry_run and not self.options.yes and any(counts.get(k) for k in dropped):
+            print '>>> Leftover tables and workspaces were kept, run again with --yes to drop them'
+
+    def _compact(self):
+        current = settings.get()
+        older_than = self.options.older_than if self.options.older_than is not None else current.compact_after
+        counts = history.compact(older_than, current.history_max_age, dry_run=self.options.dry_run)
+        for table, count in sorted(counts.items()):
+            print '{0:<30} {1}'.format(table, count)
+        if self.options.dry_run:
+            print '\n>>> Dry run, nothing deleted'
+
+    def _extent(self):
+        def report(count):
+            sys.stdout.write('.' if count else '-')
+            sys.stdout.flush()
 
-        context = {'user': toolkit.get_action('user_show')({'ignore_auth': True}, {
-            'id': config.get('ckan.spatialingestor.ckan_user', 'default')
-        })}
+        changed, queued = extent.backfill(batch_size=self.options.batch_size, report=report)
+        print '\n>>> Updated the extent of {0} datasets, queued {1} layers without extents for the worker'.format(
+            changed, queued)
+
+    def _plan(self, operation):
+        current = settings.get()
+        concurrency = self.options.concurrency or current.admission_high_water or self.options.workers
+        try:
+            plan = planner.build(operation, concurrency)
+        except ValueError, e:
+            print e
+            sys.exit(1)
+        path = self.options.plan or '{0}.plan.json'.format(operation)
+        planner.write(plan, path)
+
+        def seconds(value):
+            return '{0:.0f}'.format(value) if value is not None else '-'
+
+        print '{0:<30} {1:<8} {2:<10} {3:>9} {4:>14} {5:>12}'.format(
+            'organization', 'format', 'size', 'resources', 'bytes', 'job s')
+        for group in plan['groups'][:50]:
+            print '{0:<30} {1:<8} {2:<10} {3:>9} {4:>14} {5:>12}'.format(
+                (group['organization'] or '-')[:30], group['format'] or '-', group['size_bucket'],
+                group['resources'], group['bytes'], seconds(group['estimated_seconds']))
+        if len(plan['groups']) > 50:
+            print '... {0} more groups in {1}'.format(len(plan['groups']) - 50, path)
+
+        print '\n>>> {0} would touch {1} resources (one GeoServer layer each) in {2} packages, {3} bytes'.format(
+            operation, plan['resources'], plan['packages'], plan['bytes'])
+        if plan['estimated_seconds'] is None:
+            print '>>> No job history to estimate the duration from'
+        else:
+            print '>>> Estimated {0} with {1} concurrent jobs{2}'.format(
+                datetime.timedelta(seconds=int(plan['estimated_seconds'])), concurrency,
+                ', {0} resources not estimated'.format(plan['unestimated_resources'])
+                if plan['unestimated_resources'] else '')
+        print '>>> Plan written to {0}, run it with: spatialingestor {1} --plan {0}'.format(path, operation)
+
+    def _stats(self):
+        try:
+            rows = history.stats(group_by=self.options.group_by)
+        except ValueError, e:
+            print e
+            sys.exit(1)
+
+        def seconds(value):
+            return '{0:.1f}'.format(value) if value is not None else '-'
+
+        print '{0:<20} {1:>8} {2:>9} {3:>10} {4:>10} {5:>10}'.format(
+            self.options.group_by, 'jobs', 'complete', 'mean s', 'p50 s', 'p95 s')
+        for row in rows:
+            print '{0:<20} {1:>8} {2:>9} {3:>10} {4:>10} {5:>10}'.format(
+                row[self.options.group_by] or '-', row['jobs'], row['complete'], seconds(row['mean_seconds']),
+                seconds(row['p50_seconds']), seconds(row['p95_seconds']))
+
+    def _purge_package(self, context, pkg_id, candidates):
+        for candidate in candidates:
+            if candidate.spatial_parent:
+                toolkit.get_action('spatialingestor_purge_resource_datastores')(
+                    dict(context), _resource_dict(candidate.resource_id))
+
+    def _reingest_package(self, context, pkg_id, candidates):
+        # The resources of a package share one memo of package and user lookups
+        context = dict(context)
+        context[memo.CONTEXT_KEY] = memo.Memo()
+        for candidate in candidates:
+            if candidate.detected_format and not candidate.spatial_child_of:
+                toolkit.get_action('spatialingestor_ingest_resource')(
+                    dict(context, force_ingest=True), _resource_dict(candidate.resource_id))
 
-        for res in pkg_dict['resources']:
-            purge_resource(context, res['id'])
+    def _purge(self, pkg_id):
+        package = model.Package.get(pkg_id)
 
-    def _purge_all(self):
-        context = {'user': toolkit.get_action('user_show')({'ignore_auth': True}, {
-            'id': config.get('ckan.spatialingestor.ckan_user', 'default')
-        })}
+        log.info("Purging spatially ingested resources from package {0}...".format(package.name))
 
-        pkg_ids = [r[0] for r in model.Session.query(model.Package.id).filter(model.Package.state != 'deleted').all()]
+        self._purge_package(job_context(), package.id,
+                            list(discovery.iter_candidates(package_ids=[package.id], parents_only=True)))
 
+    def _purge_all(self):
         log.info("Purging spatially ingested resources from all packages...")
 
-        total_packages = len(pkg_ids)
-        for counter, pkg_id in enumerate(pkg_ids):
-            sys.stdout.write(
-                "\rPurging spatially ingested resources from dataset {0}/{1}".format(counter + 1, total_packages))
-            sys.stdout.flush()
-            pkg_dict = model.Package.get(pkg_id).as_dict()
-            try:
-                for res in pkg_dict['resources']:
-                    purge_resource(context, res['id'])
-            except Exception, e:
-                log.error("Processing {0} failed with error {1}, continuing...".format(pkg_dict['name'], str(e)))
-
-        sys.stdout.write("\n>>> Process complete\n")
+        self._process_all(self._purge_package, "Purging spatially ingested resources from dataset",
+                          self._planned(planner.PURGE, discovery.iter_candidates(parents_only=True)))
 
     def _reingest(self, pkg_id):
-        pkg_dict = model.Package.get(pkg_id).as_dict()
+        package = model.Package.get(pkg_id)
 
-        log.info("Re-ingesting spatial resources for package {0}...".format(pkg_dict['name']))
+        log.info("Re-ingesting spatial resources for package {0}...".format(package.name))
 
-        context = {'user': toolkit.get_action('user_show')({'ignore_auth': True}, {
-            'id': config.get('ckan.spatialingestor.ckan_user', 'default')
-        })}
-
-        for res in pkg_dict['resources']:
-            ingest_resource(context, res['id'], False)
+        self._reingest_package(job_context(), package.id,
+                               list(discovery.iter_candidates(package_ids=[package.id])))
 
     def _reingest_all(self):
-        context = {'user': toolkit.get_action('user_show')({'ignore_auth': True}, {
-            'id': config.get('ckan.spatialingestor.ckan_user', 'default')
-        })}
-
-        pkg_ids = [r[0] for r in model.Session.query(model.Package.id).filter(model.Package.state != 'deleted').all()]
-
         log.info("Re-ingesting spatial resources for all packages...")
 
-        total_packages = len(pkg_ids)
-        for counter, pkg_id in enumerate(pkg_ids):
-            sys.stdout.write("\rRe-ingesting spatial resources for dataset {0}/{1}".format(counter + 1, total_packages))
-            sys.stdout.flush()
-            pkg_dict = model.Package.get(pkg_id).as_dict()
+        self._process_all(self._reingest_package, "Re-ingesting spatial resources for dataset",
+                          self._planned(planner.REINGEST, discovery.iter_candidates()))
+
+    def _planned(self, operation, candidates):
+        '''Limit ``candidates`` to the datasets of the ``--plan`` file, if given.'''
+        if not self.options.plan:
+            return candidates
+        try:
+            plan = planner.load(self.options.plan, operation)
+        except (IOError, ValueError), e:
+            print e
+            sys.exit(1)
+        log.info("Following the plan of {0}: {1} resources in {2} packages".format(
+            plan['created'], plan['resources'], plan['packages']))
+        package_ids = frozenset(plan['package_ids'])
+        return (c for c in candidates if c.package_id in package_ids)
+
+    def _process_all(self, process, description, candidates):
+        '''Run ``process`` over every package in the ``candidates`` stream.
+
+        Packages are handed to a pool of ``--workers`` threads in batches of
+        ``--batch-size``. When ``--checkpoint`` is given, each package that
+        was processed successfully is appended to that file and skipped on
+        the next run.
+        '''
+        # Held back by admission control while the microservice is busy
+        context = dict(job_context(), bulk=True)
+        checkpoint_path = self.options.checkpoint
+
+        done = set()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                done = set(line.strip() for line in f if line.strip())
+            log.info("Resuming, {0} packages already processed".format(len(done)))
+
+        def run(item):
+            pkg_id, package_candidates = item
             try:
-                for res in pkg_dict['resources']:
-                    ingest_resource(context, res['id'], False)
+                process(context, pkg_id, package_candidates)
+                return pkg_id, True
             except Exception, e:
-                log.error("Processing {0} failed with error {1}, continuing...".format(pkg_dict['name'], str(e)))
+                model.Session.rollback()
+                log.error("Processing {0} failed with error {1}, continuing...".format(pkg_id, str(e)))
+                return pkg_id, False
+            finally:
+                model.Session.remove()
+
+        def batches():
+            batch = []
+            for item in discovery.iter_packages(candidates):
+                if item[0] in done:
+                    continue
+                batch.append(item)
+                if len(batch) >= self.options.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        checkpoint = open(checkpoint_path, 'a') if checkpoint_path else None
+        pool = ThreadPool(self.options.workers)
+        counter = 0
+        try:
+            for batch in batches():
+                for pkg_id, success in pool.imap_unordered(run, batch):
+                    counter += 1
+                    sys.stdout.write("\r{0} {1}".format(description, counter))
+                    sys.stdout.flush()
+                    if success and checkpoint:
+                        checkpoint.write(pkg_id + '\n')
+                        checkpoint.flush()
+        finally:
+            pool.close()
+            pool.join()
+            if checkpoint:
+                checkpoint.close()
 
         sys.stdout.write("\n>>> Process complete\n")
 
     def _purge_legacy_all(self):
-        geoserver_info = cli.parse_db_config('ckan.spatialingestor.postgis_url')
+        geoserver = reconcile.GeoServer.from_config()
 
-        geoserver_credentials = (geoserver_info['db_user'], geoserver_info['db_pass'])
-        geoserver_wsurl = 'http://' + geoserver_info['db_host'] + 'rest/workspaces'
-
-        postgist_info = cli.parse_db_config('ckan.spatialingestor.postgis_url')
-
-        def get_db_cursor():
-            try:
-                connection = psycopg2.connect(dbname=postgist_info['db_name'],
-                                              user=postgist_info['db_user'],
-                                              password=postgist_info['db_pass'],
-                                              host=postgist_info['db_host'],
-                                              port=postgist_info.get('db_port', None))
-
-                connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-
-                return connection.cursor(), connection
-            except Exception, e:
-                log.error("Failed to connect with PostGIS with error {0}".format(str(e)))
-                return None
-
-        def process_pkg(db_cursor, input_pkg):
-            table_name = input_pkg['id'].replace("-", "_")
-
-            results = db_cursor.execute(
-                u'''SELECT 1 FROM "_table_metadata" where name = {tab_name} and alias_of is null'''.format(
-                    tab_name=table_name))
-            res_exists = results.rowcount > 0
-
-            if res_exists:
-                log.debug("{0} appears to contain a legacy spatial ingestion.".format(pkg_dict['name']))
-                # We have a table that exists in the PostGIS DB
-                pkg_raw = model.Package.get(input_pkg['id'])
-
-                if pkg_raw.state != 'deleted':
-                    for res_raw in pkg_raw.resources:
-                        res_dict = res_raw.as_dict()
-                        if "http://data.gov.au/geoserver/" in res_dict.get('url', ''):
-                            toolkit.get_action('resource_delete')({'ignore_auth': True}, res_dict)
+        try:
+            connection = reconcile.postgis_connection()
+            connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        except Exception, e:
+            log.error("Failed to open SQL connection to PostGIS DB with error {0}".format(str(e)))
+            return None
 
-                res = requests.delete(geoserver_wsurl + '/' + input_pkg['name'] + '?recurse=true&quietOnNotFound',
-                                      auth=geoserver_credentials)
+        # The old ingestor named its tables after the package ID
+        cursor = connection.cursor()
+        cursor.execute(u'''SELECT name FROM "_table_metadata" WHERE alias_of IS NULL''')
+        legacy_tables = set(row[0] for row in cursor.fetchall())
 
-                log.info("Geoserver recursive workspace deletion returned {0}".format(res))
+        def process_pkg(pkg_raw):
+            table_name = pkg_raw.id.replace("-", "_")
+            log.debug("{0} appears to contain a legacy spatial ingestion.".format(pkg_raw.name))
 
-                db_cursor.execute("DROP TABLE IF EXISTS {tab_name}".format(tab_name=table_name))
+            if pkg_raw.state != 'deleted':
+                for res_raw in pkg_raw.resources:
+                    res_dict = res_raw.as_dict()
+                    if "http://data.gov.au/geoserver/" in res_dict.get('url', ''):
+                        toolkit.get_action('resource_delete')({'ignore_auth': True}, res_dict)
 
-                log.ingo("Dropped SQL table {0}".format(table_name))
+            res = geoserver.rest.delete('workspaces/' + pkg_raw.name + '?recurse=true&quietOnNotFound')
 
-        db_res = get_db_cursor()
+            log.info("Geoserver recursive workspace deletion returned {0}".format(res))
 
-        if db_res is None:
-            log.error("Failed to open SQL connection to PostGIS DB")
-            return None
+            cursor.execute('DROP TABLE IF EXISTS "{tab_name}"'.format(tab_name=table_name))
 
-        cursor, connection = db_res
+            log.info("Dropped SQL table {0}".format(table_name))
 
-        pkg_ids = [r[0] for r in model.Session.query(model.Package.id).all()]
-        log.info("Migrating legacy spatial ingestion on all packages...")
+        pkg_ids = [r[0] for r in model.Session.query(model.Package.id).all()
+                   if r[0].replace("-", "_") in legacy_tables]
+        log.info("Migrating legacy spatial ingestion on {0} packages...".format(len(pkg_ids)))
 
         total_packages = len(pkg_ids)
         for counter, pkg_id in enumerate(pkg_ids):
             sys.stdout.write("\rProcessing dataset {0}/{1}".format(counter + 1, total_packages))
             sys.stdout.flush()
-            pkg_dict = model.Package.get(pkg_id).as_dict()
+            pkg_raw = model.Package.get(pkg_id)
             try:
-                process_pkg(cursor, pkg_dict)
+                process_pkg(pkg_raw)
             except Exception, e:
-                log.error("Processing {0} failed with error {1}, continuing...".format(pkg_dict['name'], str(e)))
+                log.error("Processing {0} failed with error {1}, continuing...".format(pkg_raw.name, str(e)))
 
         cursor.close()
         connection.close()
@@ -0,0 +1,193 @@
+import logging
+import os
+import random
+import threading
+import time
+import urlparse
+
+import requests
+
+from ckanext.spatialingestor import settings
+
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    NewConnectionError = None
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+# Methods that are safe to send twice. Others, like submitting a job, are
+# only retried when the request cannot have reached the server.
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+
+def _not_sent(e):
+    '''Whether a failed request never reached the server: the connection
+    timed out or was refused.'''
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.Timeout) or NewConnectionError is None or not e.args:
+        return False
+    return isinstance(getattr(e.args[0], 'reason', None), NewConnectionError)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''Raised without touching the network while the circuit is open.'''
+
+
+class CircuitBreaker(object):
+    '''Fails fast after ``threshold`` consecutive failed calls.
+
+    Once open, calls are rejected for ``reset_timeout`` seconds, after
+    which a single trial call is let through; its outcome closes or
+    re-opens the circuit.
+    '''
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.reset_timeout:
+                # Half open: let this call through, keep rejecting the others
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    log.warning('Spatial ingestor circuit opened after {0} failures'.format(self.failures))
+                self.opened_at = time.time()
+
+
+class MicroserviceClient(object):
+    '''HTTP client for the spatial ingestor microservice (or GeoServer).
+
+    Keeps a per-process ``requests.Session`` so connections are reused,
+    applies connect/read timeouts to every call and retries connection
+    errors and 5xx responses with jittered exponential backoff.
+
+    Non-idempotent calls (POST) are only retried when the connection could
+    not be made, never after a read timeout or a 5xx response, as the
+    server may have acted on them already.
+    '''
+
+    def __init__(self, base_url, connect_timeout=5, read_timeout=30, retries=3, backoff_factor=0.5,
+                 pool_size=10, breaker=None, auth=None):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.auth = auth
+
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Sessions must not be shared across a fork
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                            pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.auth = self.auth
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def url(self, path):
+        return urlparse.urljoin(self.base_url, path)
+
+    def _sleep(self, attempt):
+        time.sleep(self.backoff_factor * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def request(self, method, path, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError('Circuit open for {0}, not calling {1}'.format(self.base_url, path))
+
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url(path)
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                if attempt >= self.retries or not (idempotent or _not_sent(e)):
+                    self.breaker.failure()
+                    raise
+                log.debug('{0} {1} failed ({2}), retrying'.format(method, url, e))
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.breaker.success()
+                    return response
+                if attempt >= self.retries or not idempotent:
+                    self.breaker.failure()
+                    return response
+                log.debug('{0} {1} returned {2}, retrying'.format(method, url, response.status_code))
+
+            self._sleep(attempt)
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+def from_config(base_url, auth=None):
+    current = settings.get()
+    return MicroserviceClient(
+        base_url,
+        connect_timeout=current.connect_timeout,
+        read_timeout=current.read_timeout,
+        retries=current.retries,
+        backoff_factor=current.backoff_factor,
+        pool_size=current.pool_size,
+        breaker=CircuitBreaker(threshold=current.breaker_threshold, reset_timeout=current.breaker_reset),
+        auth=auth)
+
+
+_client = None
+
+
+def get_client():
+    '''The shared client for ``ckan.spatialingestor.url``.'''
+    global _client
+    if _client is None:
+        _client = from_config(settings.get().url)
+    return _client
+
+
+def reset():
+    '''Drop the shared client, e.g. after the settings changed.'''
+    global _client
+    _client = None
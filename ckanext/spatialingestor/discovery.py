@@ -0,0 +1,87 @@
+import itertools
+from collections import namedtuple
+
+from ckan import model
+from sqlalchemy import text
+
+from ckanext.spatialingestor import formats
+
+SpatialCandidate = namedtuple('SpatialCandidate',
+                              ['package_id', 'resource_id', 'detected_format', 'spatial_parent', 'spatial_child_of'])
+
+# Values toolkit.asbool() treats as true
+TRUE_VALUES = ('true', 'yes', 'on', 'y', 't', '1')
+
+
+def format_case(params):
+    '''SQL CASE expression mirroring helpers.get_spatial_input_format.'''
+    return formats.get_registry().sql_case(params)
+
+
+def iter_candidates(package_ids=None, spatial_only=True, parents_only=False, batch_size=1000):
+    '''Stream the spatial resources of active packages, ordered by package.
+
+    The format is classified and the ``spatial_parent``/``spatial_child_of``
+    extras are extracted in the database, and rows are read through a
+    server-side cursor ``batch_size`` at a time, so memory use does not
+    depend on the size of the catalogue.
+
+    :param package_ids: restrict to these packages (default: all)
+    :param spatial_only: only return resources with a spatial format or
+        that are spatial parents/children
+    :param parents_only: only return spatial parents
+    :returns: iterator of :class:`SpatialCandidate`
+    '''
+    params = {'true_values': TRUE_VALUES}
+    where = ["r.state = 'active'", "p.state = 'active'"]
+    if package_ids is not None:
+        params['package_ids'] = tuple(package_ids)
+        if not params['package_ids']:
+            return
+        where.append('r.package_id IN :package_ids')
+
+    inner = '''
+        SELECT r.package_id, r.id AS resource_id,
+               {format_case} AS detected_format,
+               coalesce(lower(r.extras::json ->> 'spatial_parent') IN :true_values, false) AS spatial_parent,
+               nullif(r.extras::json ->> 'spatial_child_of', '') AS spatial_child_of
+        FROM resource r JOIN package p ON p.id = r.package_id
+        WHERE {where}
+    '''.format(format_case=format_case(params), where=' AND '.join(where))
+
+    outer_where = []
+    if parents_only:
+        outer_where.append('spatial_parent')
+    elif spatial_only:
+        outer_where.append('(detected_format IS NOT NULL OR spatial_parent OR spatial_child_of IS NOT NULL)')
+
+    sql = 'SELECT * FROM ({0}) candidates {1} ORDER BY package_id, resource_id'.format(
+        inner, 'WHERE ' + ' AND '.join(outer_where) if outer_where else '')
+
+    connection = model.Session.connection().execution_options(stream_results=True)
+    result = connection.execute(text(sql), **params)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield SpatialCandidate(*row)
+    finally:
+        result.close()
+
+
+def iter_packages(candidates):
+    '''Group an ordered candidate stream into ``(package_id, [candidates])``.'''
+    for package_id, group in itertools.groupby(candidates, key=lambda c: c.package_id):
+        yield package_id, list(group)
+
+
+def orphaned_children(candidates):
+    '''Spatial children whose parent is not an active spatial parent of the
+    same package.'''
+    orphans = []
+    for package_id, group in iter_packages(candidates):
+        parent_ids = set(c.resource_id for c in group if c.spatial_parent)
+        orphans.extend(c for c in group if c.spatial_child_of and c.spatial_child_of not in parent_ids)
+    return orphans
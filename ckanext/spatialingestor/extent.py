@@ -0,0 +1,170 @@
+import json
+import logging
+
+from ckan import model
+from ckan.model import types as _types
+from sqlalchemy import orm, text
+
+from ckanext.spatialingestor import discovery, lifecycle, orphans, outbox, reconcile, settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+# The dataset extra ckanext-spatial indexes for bbox queries
+EXTRA_KEY = 'spatial'
+
+# Union of the extents recorded on the active children of each dataset, not
+# counting copies of children whose parent is in another dataset
+_EXTENTS = '''
+    WITH extents AS (
+        SELECT r.package_id, CAST(nullif(r.extras::json ->> 'spatial_extent', '') AS json) AS e
+        FROM resource r JOIN package p ON p.id = r.package_id
+        WHERE r.state = 'active' AND p.state = 'active'
+          AND EXISTS (SELECT 1 FROM resource parent
+                      WHERE parent.id = r.extras::json ->> 'spatial_child_of' AND parent.package_id = r.package_id)
+          {where})
+    SELECT package_id, min((e ->> 0)::float), min((e ->> 1)::float), max((e ->> 2)::float), max((e ->> 3)::float)
+    FROM extents
+    WHERE e IS NOT NULL
+    GROUP BY package_id
+    ORDER BY package_id'''
+
+# Updates the existing extras that differ and inserts the missing ones in
+# one statement, so only datasets whose extent changed are returned
+_WRITE = '''
+    WITH v AS (
+        SELECT * FROM unnest(CAST(:ids AS text[]), CAST(:package_ids AS text[]), CAST(:values AS text[]))
+            AS v(id, package_id, value)),
+    updated AS (
+        UPDATE package_extra pe SET value = v.value, state = 'active'
+        FROM v
+        WHERE pe.package_id = v.package_id AND pe.key = :key {keep}
+          AND (pe.value IS DISTINCT FROM v.value OR pe.state <> 'active')
+        RETURNING pe.package_id),
+    existing AS (
+        SELECT package_id FROM package_extra WHERE key = :key AND package_id = ANY(CAST(:package_ids AS text[]))),
+    inserted AS (
+        INSERT INTO package_extra (id, package_id, key, value, state)
+        SELECT v.id, v.package_id, :key, v.value, 'active' FROM v
+        WHERE v.package_id NOT IN (SELECT package_id FROM existing)
+        RETURNING package_id)
+    SELECT package_id FROM updated UNION SELECT package_id FROM inserted'''
+
+# Leave extents entered by hand alone
+_KEEP_EXISTING = "AND (pe.value IS NULL OR pe.value = '' OR pe.state <> 'active')"
+
+# Ingested parents none of whose children have an extent yet
+_UNDESCRIBED = '''
+    SELECT r.id FROM resource r
+    JOIN package p ON p.id = r.package_id
+    JOIN task_status t ON t.entity_id = r.id AND t.task_type = 'spatial_ingest' AND t.key = :key
+    WHERE r.state = 'active' AND p.state = 'active' AND t.state = 'complete'
+      AND coalesce(lower(r.extras::json ->> 'spatial_parent') IN :true_values, false)
+      AND NOT EXISTS (
+          SELECT 1 FROM resource c
+          WHERE c.state = 'active' AND c.package_id = r.package_id AND c.extras::json ->> 'spatial_child_of' = r.id
+            AND nullif(c.extras::json ->> 'spatial_extent', '') IS NOT NULL)'''
+
+
+def normalize(extent):
+    '''GeoJSON geometry of a ``[min_x, min_y, max_x, max_y]`` extent in
+    EPSG:4326, clamped to the valid range, or None if it is empty.'''
+    if not extent or None in extent:
+        return None
+    min_x, max_x = [round(max(-180.0, min(180.0, x)), 6) for x in (extent[0], extent[2])]
+    min_y, max_y = [round(max(-90.0, min(90.0, y)), 6) for y in (extent[1], extent[3])]
+    if min_x > max_x or min_y > max_y:
+        return None
+    if min_x == max_x and min_y == max_y:
+        return {'type': 'Point', 'coordinates': [min_x, min_y]}
+    return {'type': 'Polygon',
+            'coordinates': [[[min_x, min_y], [max_x, min_y], [max_x, max_y], [min_x, max_y], [min_x, min_y]]]}
+
+
+def extents(package_ids=None):
+    '''``(package_id, geometry)`` of datasets with recorded layer extents,
+    ordered by dataset, streamed from the database.'''
+    params = {}
+    where = ''
+    if package_ids is not None:
+        params['package_ids'] = tuple(package_ids)
+        if not params['package_ids']:
+            return
+        where = 'AND r.package_id IN :package_ids'
+    for row in reconcile.stream(_EXTENTS.format(where=where), params):
+        geometry = normalize(list(row[1:]))
+        if geometry:
+            yield row[0], geometry
+
+
+def write(package_geometries, session=None):
+    '''Set the ``spatial`` extra of many datasets in one statement and
+    commit ``session`` (the current CKAN session by default).
+
+    Unless ``ckan.spatialingestor.extent_overwrite`` is set, extents that
+    are already filled in are kept.
+
+    :param package_geometries: ``(package_id, geometry)`` pairs
+    :returns: IDs of the datasets whose extent changed, the ones to reindex
+    '''
+    session = session or model.Session
+    package_geometries = list(package_geometries)
+    if not package_geometries:
+        return []
+    keep = '' if settings.get().extent_overwrite else _KEEP_EXISTING
+    rows = session.execute(text(_WRITE.format(keep=keep)), {
+        'key': EXTRA_KEY,
+        'ids': [_types.make_uuid() for _ in package_geometries],
+        'package_ids': [package_id for package_id, _ in package_geometries],
+        # Sorted keys keep the text of an unchanged extent the same
+        'values': [json.dumps(geometry, sort_keys=True) for _, geometry in package_geometries]}).fetchall()
+    session.commit()
+    return sorted(set(row[0] for row in rows))
+
+
+def update(package_ids):
+    '''Recompute and store the extent of ``package_ids``, without reindexing.
+
+    :returns: IDs of the datasets that changed
+    '''
+    return write(extents(package_ids))
+
+
+def backfill(batch_size=500, report=None):
+    '''Set the extent of every dataset with recorded layer extents,
+    ``batch_size`` datasets per statement and reindex, and queue the
+    ingested parents that have no extents yet for the worker to describe.
+
+    :param report: called with the number of datasets changed by each batch
+    :returns: ``(datasets changed, parents queued)``
+    '''
+    pending = [row[0] for row in model.Session.execute(text(_UNDESCRIBED), {
+        'key': lifecycle.KEY, 'true_values': discovery.TRUE_VALUES})]
+
+    # Written on their own session, the extents are still being streamed
+    # from model.Session
+    session = orm.sessionmaker(bind=model.meta.engine)()
+    changed = []
+    try:
+        batch = []
+        for item in extents():
+            batch.append(item)
+            if len(batch) >= batch_size:
+                changed.extend(_write_batch(batch, session, report))
+                batch = []
+        if batch:
+            changed.extend(_write_batch(batch, session, report))
+    finally:
+        session.close()
+
+    orphans.reindex(changed, batch_size)
+    for resource_id in pending:
+        outbox.enqueue(outbox.DESCRIBE, resource_id)
+    model.Session.commit()
+    return len(changed), len(pending)
+
+
+def _write_batch(batch, session, report):
+    package_ids = write(batch, session)
+    if report:
+        report(len(package_ids))
+    return package_ids
@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import os
+
+import requests
+from ckan.lib import uploader
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _upload_fingerprint(resource_dict, previous):
+    path = uploader.get_resource_uploader(resource_dict).get_path(resource_dict['id'])
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    fingerprint = {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+    # Hashing a multi-GB upload is expensive, reuse the previous digest
+    # when the file has not been touched since
+    if previous and previous.get('sha256') and \
+            previous.get('size') == fingerprint['size'] and previous.get('mtime') == fingerprint['mtime']:
+        fingerprint['sha256'] = previous['sha256']
+    else:
+        fingerprint['sha256'] = _sha256(path)
+    return fingerprint
+
+
+def _remote_fingerprint(resource_dict):
+    url = resource_dict.get('url')
+    if not url:
+        return None
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=10)
+        r.raise_for_status()
+    except requests.exceptions.RequestException, e:
+        log.debug('Could not fingerprint {0}: {1}'.format(url, e))
+        return None
+
+    fingerprint = dict((key, r.headers[header]) for key, header in
+                       (('etag', 'ETag'), ('last_modified', 'Last-Modified'), ('size', 'Content-Length'))
+                       if r.headers.get(header))
+    if not fingerprint:
+        # Nothing identifies the content, so it can never be considered unchanged
+        return None
+    fingerprint['url'] = url
+    return fingerprint
+
+
+def compute(resource_dict, previous=None):
+    '''Fingerprint of the content behind a resource, or None if unknown.
+
+    Uploads are identified by size, mtime and sha256; links by the ETag,
+    Last-Modified and Content-Length headers of a HEAD request.
+    '''
+    if resource_dict.get('url_type') == 'upload':
+        return _upload_fingerprint(resource_dict, previous)
+    return _remote_fingerprint(resource_dict)
+
+
+def unchanged(current, previous):
+    '''Whether two fingerprints identify the same content.'''
+    if not current or not previous:
+        return False
+    if 'sha256' in current:
+        return current.get('sha256') == previous.get('sha256')
+    return current == previous
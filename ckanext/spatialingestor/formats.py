@@ -0,0 +1,227 @@
+import logging
+import posixpath
+import threading
+import urlparse
+from collections import namedtuple
+
+import requests
+from ckan import plugins
+from ckan.lib import uploader
+
+from ckanext.spatialingestor import settings
+from ckanext.spatialingestor.interfaces import ISpatialFormats
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+
+class SpatialFormat(namedtuple('SpatialFormat', ['input_format', 'names', 'mimetypes', 'extensions', 'magic'])):
+    '''A spatial input format the microservice understands.
+
+    :param input_format: name sent to the microservice, e.g. ``SHP``
+    :param names: values of the resource ``format`` field, case insensitive
+    :param mimetypes: values of the resource ``mimetype`` field
+    :param extensions: URL extensions including the dot, e.g. ``.shp.zip``
+    :param magic: ``(offset, bytes)`` signatures of the first bytes of the file
+    '''
+    __slots__ = ()
+
+
+DEFAULT_FORMATS = (
+    SpatialFormat('SHP', ('SHP', 'SHAPEFILE', 'ESRI SHAPEFILE', 'ZIPPED SHAPEFILE', 'SHP ZIP', 'ZIP SHP'),
+                  ('application/x-shapefile', 'application/vnd.shp', 'x-gis/x-shapefile'),
+                  ('.shp', '.shp.zip', '.shz'), ((0, '\x00\x00\x27\x0a'),)),
+    SpatialFormat('KML', ('KML',), ('application/vnd.google-earth.kml+xml',), ('.kml',), ()),
+    SpatialFormat('KMZ', ('KMZ',), ('application/vnd.google-earth.kmz',), ('.kmz',), ()),
+    SpatialFormat('GRID', ('GRID', 'ESRI GRID', 'ARCGRID'), (), (), ()),
+    SpatialFormat('GEOJSON', ('GEOJSON', 'GEO JSON'), ('application/geo+json', 'application/vnd.geo+json'),
+                  ('.geojson',), ()),
+    SpatialFormat('GPKG', ('GPKG', 'GEOPACKAGE'), ('application/geopackage+sqlite3',), ('.gpkg',),
+                  ((68, 'GPKG'), (68, 'GP10'), (68, 'GP11'))),
+    SpatialFormat('GEOTIFF', ('GEOTIFF', 'GEO TIFF', 'TIF', 'TIFF'), ('image/tiff', 'image/geotiff'),
+                  ('.tif', '.tiff', '.geotiff'), ((0, 'II*\x00'), (0, 'MM\x00*'))),
+)
+
+# What is ingested when ckan.spatialingestor.target_formats is not set
+DEFAULT_ENABLED = ('SHP', 'KML', 'KMZ', 'GRID')
+
+# Text formats have no fixed signature, look for these markers instead
+TEXT_MARKERS = (('<kml', 'KML'), ('"FeatureCollection"', 'GEOJSON'), ('"Feature"', 'GEOJSON'))
+
+
+def normalize_name(name):
+    return (name or '').strip().lstrip('.').upper()
+
+
+def url_extensions(url):
+    '''Candidate extensions of the path of ``url``, longest first.'''
+    path = urlparse.urlsplit(url or '').path.lower()
+    root, ext = posixpath.splitext(path)
+    if not ext:
+        return ()
+    inner = posixpath.splitext(root)[1]
+    return (inner + ext, ext) if inner else (ext,)
+
+
+class Registry(object):
+    '''Maps format names, MIME types and URL extensions to input formats
+    with one dictionary lookup each.
+
+    Only formats in ``enabled`` are detected.
+    '''
+
+    def __init__(self, formats=DEFAULT_FORMATS, enabled=DEFAULT_ENABLED):
+        self.enabled = frozenset(enabled)
+        self.formats = []
+        self.by_name = {}
+        self.by_mimetype = {}
+        self.by_extension = {}
+        for spatial_format in formats:
+            self.register(spatial_format)
+
+    def register(self, spatial_format):
+        self.formats.append(spatial_format)
+        if spatial_format.input_format not in self.enabled:
+            return
+        for name in spatial_format.names + (spatial_format.input_format,):
+            self.by_name[normalize_name(name)] = spatial_format.input_format
+        for mimetype in spatial_format.mimetypes:
+            self.by_mimetype[mimetype.lower()] = spatial_format.input_format
+        for extension in spatial_format.extensions:
+            self.by_extension[extension.lower()] = spatial_format.input_format
+
+    def detect(self, resource):
+        '''Input format of ``resource`` from its metadata, or None.
+
+        A format found by sniffing (the ``spatial_input_format`` extra) wins,
+        then the ``format`` field, the ``mimetype`` field and the URL
+        extension, in that order.
+        '''
+        extras = resource.get('__extras') or {}
+        for name in (resource.get('spatial_input_format'), extras.get('format'), resource.get('format')):
+            input_format = self.by_name.get(normalize_name(name))
+            if input_format:
+                return input_format
+        input_format = self.by_mimetype.get((resource.get('mimetype') or '').lower())
+        if input_format:
+            return input_format
+        for extension in url_extensions(resource.get('url')):
+            input_format = self.by_extension.get(extension)
+            if input_format:
+                return input_format
+        return None
+
+    def match_magic(self, head):
+        '''Input format identified by the first bytes of a file, or None.'''
+        for spatial_format in self.formats:
+            if spatial_format.input_format not in self.enabled:
+                continue
+            for offset, signature in spatial_format.magic:
+                if head[offset:offset + len(signature)] == signature:
+                    return spatial_format.input_format
+        if head.lstrip('\xef\xbb\xbf \t\r\n')[:1] in ('<', '{'):
+            for marker, input_format in TEXT_MARKERS:
+                if input_format in self.enabled and marker in head:
+                    return input_format
+        return None
+
+    def sql_case(self, params):
+        '''SQL CASE expression over the resource alias ``r`` that mirrors
+        :meth:`detect`, with its values added to ``params``.'''
+        whens = []
+
+        def when(expression, operator, value, input_format):
+            i = len(whens)
+            params['match_{0}'.format(i)] = value
+            params['format_{0}'.format(i)] = input_format
+            whens.append('WHEN {0} {1} :match_{2} THEN :format_{2}'.format(expression, operator, i))
+
+        for column in ("r.extras::json ->> 'spatial_input_format'", 'r.format'):
+            for input_format, names in _group(self.by_name):
+                when("upper(trim(leading '.' from trim({0})))".format(column), 'IN', names, input_format)
+        for input_format, mimetypes in _group(self.by_mimetype):
+            when('lower(r.mimetype)', 'IN', mimetypes, input_format)
+        # Longest extensions first, like url_extensions
+        for extension, input_format in sorted(self.by_extension.items(), key=lambda e: (-len(e[0]), e[0])):
+            when("lower(split_part(split_part(r.url, '?', 1), '#', 1))", 'LIKE', '%' + extension, input_format)
+
+        if not whens:
+            return 'NULL'
+        return 'CASE {0} END'.format(' '.join(whens))
+
+
+def _group(mapping):
+    '''``{value: input_format}`` as sorted ``(input_format, (value, ...))``.'''
+    groups = {}
+    for value, input_format in mapping.items():
+        groups.setdefault(input_format, []).append(value)
+    return sorted((input_format, tuple(sorted(values))) for input_format, values in groups.items())
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def build():
+    '''Registry of the built-in formats and those of ``ISpatialFormats``
+    plugins, limited to ``ckan.spatialingestor.target_formats``.'''
+    formats = list(DEFAULT_FORMATS)
+    for plugin in plugins.PluginImplementations(ISpatialFormats):
+        formats.extend(plugin.get_spatial_formats())
+    return Registry(formats, enabled=settings.get().target_spatial_formats or DEFAULT_ENABLED)
+
+
+def get_registry():
+    # Built on first use so every plugin has been loaded by then
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = build()
+    return _registry
+
+
+def reset():
+    global _registry
+    _registry = None
+
+
+def detect(resource):
+    return get_registry().detect(resource)
+
+
+def _read_upload(resource, max_bytes):
+    path = uploader.get_resource_uploader(resource).get_path(resource['id'])
+    try:
+        with open(path, 'rb') as f:
+            return f.read(max_bytes)
+    except IOError:
+        return None
+
+
+def _read_remote(url, max_bytes):
+    try:
+        r = requests.get(url, headers={'Range': 'bytes=0-{0}'.format(max_bytes - 1)}, stream=True, timeout=10)
+        try:
+            r.raise_for_status()
+            # Bounded even if the server ignores the Range header
+            return r.raw.read(max_bytes)
+        finally:
+            r.close()
+    except requests.exceptions.RequestException, e:
+        log.debug('Could not sniff {0}: {1}'.format(url, e))
+        return None
+
+
+def sniff(resource):
+    '''Input format of ``resource`` from the first
+    ``ckan.spatialingestor.sniff_bytes`` bytes of its content, or None.'''
+    max_bytes = settings.get().sniff_bytes
+    if resource.get('url_type') == 'upload':
+        head = _read_upload(resource, max_bytes)
+    elif resource.get('url'):
+        head = _read_remote(resource['url'], max_bytes)
+    else:
+        head = None
+    if not head:
+        return None
+    return get_registry().match_magic(head)
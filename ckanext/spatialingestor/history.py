@@ -0,0 +1,219 @@
+import datetime
+import logging
+
+from ckan import model
+from ckan.model import meta, types as _types
+from sqlalchemy import Column, Index, Table, exc, text, types
+
+from ckanext.spatialingestor import chunks, lifecycle, settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+history_table = Table(
+    'spatialingestor_job_history', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
+    Column('resource_id', types.UnicodeText, nullable=False),
+    Column('job_type', types.UnicodeText, nullable=False),
+    Column('job_id', types.UnicodeText),
+    Column('input_format', types.UnicodeText),
+    Column('outcome', types.UnicodeText, nullable=False),
+    Column('error_class', types.UnicodeText),
+    Column('bytes', types.BigInteger),
+    Column('duration', types.Float),
+    Column('finished', types.DateTime, nullable=False),
+    Index('idx_spatialingestor_job_history_resource', 'resource_id', 'job_type', 'finished'),
+    Index('idx_spatialingestor_job_history_finished', 'finished'),
+)
+
+# Columns stats() can group by
+GROUP_BY = ('input_format', 'outcome', 'error_class', 'job_type')
+
+# Task states compact() removes once they are old enough: failed jobs and
+# submissions that never got an answer
+STALE_STATES = ('error', 'submitting')
+
+
+class HistoryNotReady(Exception):
+    pass
+
+
+def setup():
+    '''Create the history table if it does not exist yet.'''
+    if not history_table.exists(bind=meta.engine):
+        history_table.create(bind=meta.engine)
+        log.info('Created table {0}'.format(history_table.name))
+
+
+_ready = False
+
+
+def ensure_setup():
+    '''Run :func:`setup` once per process, so jobs keep working on a site
+    upgraded without running ``initdb``.
+
+    :raises HistoryNotReady: if the table is missing and cannot be created
+    '''
+    global _ready
+    if _ready:
+        return
+    try:
+        setup()
+    except exc.SQLAlchemyError, e:
+        # Another process may have created it in the meantime
+        if not history_table.exists(bind=meta.engine):
+            raise HistoryNotReady('The {0} table is missing and could not be created ({1}), run '
+                        '`paster --plugin=ckanext-spatialingestor spatialingestor initdb`'.format(
+                            history_table.name, e))
+    _ready = True
+
+
+def error_class(error):
+    '''Short classification of a job error, e.g. ``ConnectionError``.'''
+    if not error:
+        return None
+    if isinstance(error, dict):
+        name = error.get('type') or error.get('class') or error.get('message') or 'error'
+    elif isinstance(error, (list, tuple)):
+        # A traceback, the exception is on the last line
+        name = error[-1] if error else 'error'
+    else:
+        name = error
+    name = unicode(name).strip().split(':', 1)[0].strip()
+    return name[:100] or 'error'
+
+
+def _as_int(value):
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def record(resource_id, job_type, outcome, job_id=None, input_format=None, error=None, size=None,
+           duration=None):
+    '''Add a finished job to the history of a resource, keeping only the
+    last ``ckan.spatialingestor.history_size`` jobs per resource and job
+    type. Written through the current session, the caller commits.'''
+    keep = settings.get().history_size
+    if not keep:
+        return
+    ensure_setup()
+    params = {'id': _types.make_uuid(),
+              'resource_id': resource_id,
+              'job_type': job_type,
+              'job_id': job_id,
+              'input_format': input_format,
+              'outcome': outcome,
+              'error_class': error_class(error),
+              'bytes': _as_int(size),
+              'duration': duration,
+              'finished': datetime.datetime.utcnow(),
+              'keep': keep}
+    # One round trip: the DELETE does not see the row being inserted, so
+    # it keeps the newest keep - 1 older jobs
+    model.Session.execute(text('''
+        WITH inserted AS (
+            INSERT INTO spatialingestor_job_history
+                (id, resource_id, job_type, job_id, input_format, outcome, error_class, bytes, duration, finished)
+            VALUES (:id, :resource_id, :job_type, :job_id, :input_format, :outcome, :error_class, :bytes,
+                    :duration, :finished))
+        DELETE FROM spatialingestor_job_history WHERE id IN (
+            SELECT id FROM spatialingestor_job_history
+            WHERE resource_id = :resource_id AND job_type = :job_type
+            ORDER BY finished DESC
+            OFFSET :keep - 1)'''), params)
+
+
+def recent(resource_id, job_type):
+    '''The recorded jobs of a resource, newest first.'''
+    if not settings.get().history_size:
+        return []
+    ensure_setup()
+    rows = model.Session.execute(text('''
+        SELECT job_id, input_format, outcome, error_class, bytes, duration, finished
+        FROM spatialingestor_job_history
+        WHERE resource_id = :resource_id AND job_type = :job_type
+        ORDER BY finished DESC'''), {'resource_id': resource_id, 'job_type': job_type}).fetchall()
+    return [{'job_id': r[0],
+             'input_format': r[1],
+             'outcome': r[2],
+             'error_class': r[3],
+             'bytes': r[4],
+             'duration': r[5],
+             'finished': r[6].isoformat() if r[6] else None} for r in rows]
+
+
+def stats(group_by='input_format', job_type='spatial_ingest', max_age=None):
+    '''Job counts and durations aggregated in the database.
+
+    :param group_by: one of :data:`GROUP_BY`
+    :param max_age: only count jobs finished in the last ``max_age`` seconds
+    :raises ValueError: for an unknown ``group_by``
+    '''
+    if group_by not in GROUP_BY:
+        raise ValueError('Cannot group by {0!r}, use one of {1}'.format(group_by, ', '.join(GROUP_BY)))
+    ensure_setup()
+    params = {'job_type': job_type}
+    where = ['job_type = :job_type']
+    if max_age is not None:
+        params['since'] = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age)
+        where.append('finished >= :since')
+
+    rows = model.Session.execute(text('''
+        SELECT {group_by}, count(*),
+               count(*) FILTER (WHERE outcome = 'complete'),
+               avg(duration),
+               percentile_cont(0.5) WITHIN GROUP (ORDER BY duration),
+               percentile_cont(0.95) WITHIN GROUP (ORDER BY duration),
+               sum(bytes)
+        FROM spatialingestor_job_history
+        WHERE {where}
+        GROUP BY 1
+        ORDER BY 2 DESC'''.format(group_by=group_by, where=' AND '.join(where))), params).fetchall()
+    return [{group_by: r[0],
+             'jobs': r[1],
+             'complete': r[2],
+             'mean_seconds': r[3],
+             'p50_seconds': r[4],
+             'p95_seconds': r[5],
+             'bytes': r[6]} for r in rows]
+
+
+def compact(older_than, history_max_age, dry_run=False):
+    '''Prune the tables the extension writes to.
+
+    Removes ``error`` and ``submitting`` tasks not updated in the last
+    ``older_than`` days, history older than ``history_max_age`` days,
+    and the history and chunks of resources that are no longer active.
+
+    :returns: number of rows removed (or, with ``dry_run``, that would be)
+        per table
+    '''
+    ensure_setup()
+    chunks.ensure_setup()
+    now = datetime.datetime.utcnow()
+    params = {'key': lifecycle.KEY,
+              'stale_states': STALE_STATES,
+              'task_cutoff': now - datetime.timedelta(days=older_than),
+              'history_cutoff': now - datetime.timedelta(days=history_max_age)}
+    gone = '''NOT EXISTS (SELECT 1 FROM resource r WHERE r.id = {0} AND r.state = 'active')'''
+    prune = [
+        ('task_status', 't', '''t.key = :key AND t.state IN :stale_states AND t.last_updated < :task_cutoff'''),
+        ('spatialingestor_job_history', 'h', 'h.finished < :history_cutoff OR ' + gone.format('h.resource_id')),
+        ('spatialingestor_chunk', 'c', gone.format('c.resource_id') + '''
+            OR NOT EXISTS (SELECT 1 FROM task_status t
+                           WHERE t.entity_id = c.resource_id AND t.task_type = 'spatial_ingest' AND t.key = :key)'''),
+    ]
+
+    counts = {}
+    for table, alias, where in prune:
+        if dry_run:
+            counts[table] = model.Session.execute(text('SELECT count(*) FROM {0} {1} WHERE {2}'.format(
+                table, alias, where)), params).scalar()
+        else:
+            counts[table] = model.Session.execute(text('DELETE FROM {0} {1} WHERE {2}'.format(
+                table, alias, where)), params).rowcount
+    if not dry_run:
+        model.Session.commit()
+        log.info('Compacted {0}'.format(', '.join('{0} {1}'.format(v, k) for k, v in sorted(counts.items()))))
+    return counts
@@ -0,0 +1,14 @@
+from ckan import plugins
+
+
+class ISpatialFormats(plugins.Interface):
+    '''Register additional spatial input formats with the spatial ingestor.'''
+
+    def get_spatial_formats(self):
+        '''Return a list of
+        :class:`ckanext.spatialingestor.formats.SpatialFormat`.
+
+        They are only detected if their ``input_format`` is listed in
+        ``ckan.spatialingestor.target_formats``.
+        '''
+        return []
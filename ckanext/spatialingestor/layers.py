@@ -0,0 +1,152 @@
+import json
+import logging
+from collections import namedtuple
+
+from ckan import model
+from ckan.plugins import toolkit
+from sqlalchemy import text
+
+from ckanext.spatialingestor import extent, memo, metrics, orphans, reconcile, settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+# Format of the vector tile child resource
+VECTOR_TILE_FORMAT = 'MVT'
+
+VECTOR_TILE_MIMETYPE = 'application/vnd.mapbox-vector-tile'
+
+# Web mercator, the gridset GeoWebCache seeds by default
+GRIDSET = 'EPSG:900913'
+
+LayerInfo = namedtuple('LayerInfo', ['extent', 'feature_count', 'geometry_type', 'crs'])
+
+# Computed in one scan; only the corners of the extent are reprojected
+_DESCRIBE = '''
+    SELECT n, ST_XMin(box), ST_YMin(box), ST_XMax(box), ST_YMax(box) FROM (
+        SELECT count(*) AS n, {box} AS box FROM "{schema}"."{table}") stats'''
+
+
+def table_name(resource_id):
+    '''The PostGIS table (and GeoServer layer) the microservice creates for a parent.'''
+    return resource_id.replace('-', '_')
+
+
+def describe(connection, schema, table):
+    '''Extent in EPSG:4326, feature count, geometry type and CRS of an
+    ingested table, or None if it has no geometry column.'''
+    cursor = connection.cursor()
+    try:
+        cursor.execute('''SELECT f_geometry_column, srid, type FROM geometry_columns
+                          WHERE f_table_schema = %(schema)s AND f_table_name = %(table)s
+                          ORDER BY f_geometry_column LIMIT 1''', {'schema': schema, 'table': table})
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        column, srid, geometry_type = row
+
+        box = 'ST_SetSRID(ST_Extent("{0}")::geometry, {1})'.format(column.replace('"', '""'), int(srid or 0))
+        if srid and srid != 4326:
+            box = 'ST_Envelope(ST_Transform({0}, 4326))'.format(box)
+        cursor.execute(_DESCRIBE.format(box=box, schema=schema, table=table))
+        count, min_x, min_y, max_x, max_y = cursor.fetchone()
+    finally:
+        cursor.close()
+    connection.commit()
+
+    extent = None
+    if min_x is not None:
+        extent = [round(value, 6) for value in (min_x, min_y, max_x, max_y)]
+    return LayerInfo(extent=extent, feature_count=count, geometry_type=geometry_type,
+                     crs='EPSG:{0}'.format(srid) if srid else None)
+
+
+def as_extras(info):
+    return {'spatial_extent': json.dumps(info.extent) if info.extent else '',
+            'spatial_feature_count': str(info.feature_count),
+            'spatial_geometry_type': info.geometry_type or '',
+            'spatial_crs': info.crs or ''}
+
+
+def record(parent_id, package_id, info):
+    '''Store ``info`` as extras of the active children of ``parent_id`` in
+    one statement. Only children in the parent's dataset ``package_id`` are
+    changed, copies of them in other datasets point at a parent of their own.
+
+    :returns: IDs of the datasets that changed, to be reindexed
+    '''
+    rows = model.Session.execute(text('''
+        UPDATE resource SET extras = (coalesce(nullif(extras, ''), '{}')::jsonb || CAST(:extras AS jsonb))::text
+        WHERE state = 'active' AND package_id = :package_id AND extras::json ->> 'spatial_child_of' = :parent_id
+        RETURNING package_id'''),
+        {'parent_id': parent_id, 'package_id': package_id, 'extras': json.dumps(as_extras(info))}).fetchall()
+    model.Session.commit()
+    return sorted(set(row[0] for row in rows))
+
+
+def layer_name(package_name, resource_id):
+    return '{0}:{1}'.format(package_name, table_name(resource_id))
+
+
+def vector_tile_url(layer):
+    return '{0}/gwc/service/tms/1.0.0/{1}@{2}@pbf/{{z}}/{{x}}/{{y}}.pbf'.format(
+        settings.get().public_geoserver_url.rstrip('/'), layer, GRIDSET)
+
+
+def register_vector_tiles(context, parent, package, layer):
+    '''Add a vector tile child resource to ``parent`` unless it has one.'''
+    for resource in package.get('resources', []):
+        if resource.get('spatial_child_of') == parent['id'] and resource.get('format') == VECTOR_TILE_FORMAT:
+            return
+    toolkit.get_action('resource_create')(dict(context), {
+        'package_id': package['id'],
+        'name': u'{0} - Vector tiles'.format(parent.get('name') or parent['id']),
+        'description': 'Mapbox vector tiles of this layer (TMS tile scheme).',
+        'url': vector_tile_url(layer),
+        'format': VECTOR_TILE_FORMAT,
+        'mimetype': VECTOR_TILE_MIMETYPE,
+        'spatial_child_of': parent['id']})
+    memo.for_context(context).invalidate(package_id=package['id'])
+
+
+def process(context, resource_id, geoserver=None, connection=None):
+    '''Precompute what previews and search need once a parent is ingested:
+    layer extras on the children, an optional seeded tile cache for the
+    low zoom levels and an optional vector tile child.'''
+    current = settings.get()
+    parent = memo.show('resource_show', context, {'id': resource_id})
+    package = memo.show('package_show', context, {'id': parent['package_id']})
+
+    own_connection = connection is None
+    connection = connection or reconcile.postgis_connection()
+    try:
+        with metrics.timer('describe_seconds'):
+            info = describe(connection, current.postgis_schema, table_name(resource_id))
+    finally:
+        if own_connection:
+            connection.close()
+
+    if info is None:
+        log.debug('No geometry table for resource {0}, nothing to describe'.format(resource_id))
+    elif current.describe_layers:
+        changed = set(record(resource_id, package['id'], info))
+        if current.package_extent:
+            changed.update(extent.update([package['id']]))
+        memo.for_context(context).invalidate(package_id=package['id'])
+        if changed:
+            orphans.reindex(sorted(changed))
+
+    # Rasters have no table but are worth seeding all the same
+    vector_tiles = current.vector_tiles and info is not None
+    layer = layer_name(package['name'], resource_id)
+    if current.seed_zoom_levels:
+        geoserver = geoserver or reconcile.GeoServer.from_config()
+        formats = ['image/png'] + ([VECTOR_TILE_MIMETYPE] if vector_tiles else [])
+        for mime_format in formats:
+            try:
+                geoserver.seed(layer, current.seed_zoom_levels - 1, mime_format, GRIDSET)
+            except Exception, e:
+                # The tiles are rendered on demand instead
+                log.warning('Could not seed {0} tiles of {1}: {2}'.format(mime_format, layer, str(e)))
+    if vector_tiles:
+        register_vector_tiles(context, parent, package, layer)
+    return info
@@ -0,0 +1,107 @@
+import datetime
+import json
+import uuid
+
+from ckan import model
+from sqlalchemy import text
+
+from ckanext.spatialingestor import metrics
+
+KEY = 'spatialingestor'
+
+_COLUMNS = 'id, entity_id, entity_type, task_type, key, value, state, error, last_updated'
+
+_UPSERT = '''
+    INSERT INTO task_status (id, entity_id, entity_type, task_type, key, value, state, error, last_updated)
+    VALUES (:id, :entity_id, 'resource', :task_type, :key, :initial_value, :state, :initial_error, :now)
+    ON CONFLICT (entity_id, task_type, key) DO UPDATE
+    SET state = EXCLUDED.state, last_updated = {last_updated},
+        value = {value}, error = {error}
+    WHERE true {guard}
+    RETURNING ''' + _COLUMNS
+
+_UPDATE = '''
+    UPDATE task_status
+    SET state = :state, last_updated = {last_updated}, value = {value}, error = {error}
+    WHERE entity_id = :entity_id AND task_type = :task_type AND key = :key {guard}
+    RETURNING ''' + _COLUMNS
+
+
+def _as_dict(row):
+    task = dict(zip([c.strip() for c in _COLUMNS.split(',')], row))
+    if isinstance(task['last_updated'], datetime.datetime):
+        task['last_updated'] = task['last_updated'].isoformat()
+    return task
+
+
+def get(entity_id, job_type):
+    '''The spatialingestor task of a resource, shaped like the output of
+    ``task_status_show``, or None.'''
+    with metrics.timer('task_status_seconds', operation='read'):
+        task = model.Session.query(model.TaskStatus).filter_by(
+            entity_id=entity_id, task_type=job_type, key=KEY).first()
+    if task is None:
+        return None
+    return _as_dict([getattr(task, c.strip()) for c in _COLUMNS.split(',')])
+
+
+def transition(entity_id, job_type, state, value=None, merge_value=None, error=None, create=True, touch=True,
+               commit=True, if_state=None, if_value=None):
+    '''Move the task of a resource to ``state`` in a single statement.
+
+    :param value: replace the task value with this dict
+    :param merge_value: merge these keys into the current task value
+    :param error: replace the task error with this dict
+    :param create: create the task if it does not exist yet, otherwise
+        return None for a missing task
+    :param touch: set ``last_updated`` of an existing task to now
+    :param commit: commit the session; pass False to batch several
+        transitions into the caller's transaction
+    :param if_state: only change an existing task that is still in this
+        state, otherwise leave it alone and return None
+    :param if_value: likewise, only change an existing task whose value
+        contains these keys and values
+    :returns: the task after the transition, like :func:`get`
+    '''
+    params = {'entity_id': entity_id,
+              'task_type': job_type,
+              'key': KEY,
+              'state': state,
+              'now': datetime.datetime.utcnow()}
+
+    # Keep whatever is not given, value and error are JSON text columns
+    value_sql = 'task_status.value'
+    if value is not None:
+        params['value'] = json.dumps(value)
+        value_sql = ':value'
+    elif merge_value:
+        params['value'] = json.dumps(merge_value)
+        value_sql = "(coalesce(nullif(task_status.value, ''), '{}')::jsonb || CAST(:value AS jsonb))::text"
+    error_sql = 'task_status.error'
+    if error is not None:
+        params['error'] = json.dumps(error)
+        error_sql = ':error'
+
+    guard = ''
+    if if_state is not None:
+        params['if_state'] = if_state
+        guard += ' AND task_status.state = :if_state'
+    if if_value:
+        params['if_value'] = json.dumps(if_value)
+        guard += " AND coalesce(nullif(task_status.value, ''), '{}')::jsonb @> CAST(:if_value AS jsonb)"
+
+    if create:
+        params['id'] = unicode(uuid.uuid4())
+        params['initial_value'] = params.get('value', '{}')
+        params['initial_error'] = params.get('error', '{}')
+        sql = _UPSERT
+    else:
+        sql = _UPDATE
+
+    with metrics.timer('task_status_seconds', operation='write'):
+        sql = sql.format(value=value_sql, error=error_sql, guard=guard,
+                         last_updated=':now' if touch else 'task_status.last_updated')
+        row = model.Session.execute(text(sql), params).fetchone()
+        if commit:
+            model.Session.commit()
+    return _as_dict(row) if row else None
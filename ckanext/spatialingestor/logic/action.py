@@ -1,6 +1,6 @@
 import datetime
 import json
-import urlparse
+import time
 
 import ckan.lib.navl.dictization_functions
 import requests
@@ -8,90 +8,101 @@ from ckan import logic
 from ckan.lib import search
 from ckan.plugins import toolkit
 from dateutil.parser import parse as parse_date
-from pylons import config
+from sqlalchemy import func
 
+from ckanext.spatialingestor import (admission, chunks, fingerprint, formats, history, lifecycle, memo, metrics,
+                                     orphans, outbox, settings, tokens)
+from ckanext.spatialingestor.client import get_client
 from ckanext.spatialingestor.helpers import get_microservice_metadata, is_spatially_ingestible_resource, log
 
 _get_or_bust = logic.get_or_bust
 _validate = ckan.lib.navl.dictization_functions.validate
 
 
+class IngestorUnavailable(toolkit.ValidationError):
+    '''The microservice could not be reached (or its circuit is open), so
+    the submission is worth retrying later.'''
+
+
 def spatialingestor_job_submit(context, data_dict):
     res_id, job_type = _get_or_bust(data_dict, ['resource_id', 'job_type'])
 
     toolkit.check_access('spatialingestor_job_submit', context, data_dict)
 
     try:
-        toolkit.get_action('resource_show')(context, {
+        resource = memo.show('resource_show', context, {
             'id': res_id,
         })
     except logic.NotFound:
         return False
 
-    spatialingestor_url = config.get('ckan.spatialingestor.url')
+    if not context.get('admitted') and not admission.admit(bulk=context.get('bulk', False)):
+        # Submitted by the worker once finished jobs make room, see admission.release
+        log.debug('Spatial Ingestor is busy, deferring {0} of resource {1}'.format(job_type, res_id))
+        metrics.inc('submissions_total', job_type=job_type, outcome='deferred')
+        admission.defer(res_id, job_type, data_dict, bulk=context.get('bulk', False))
+        return True
 
-    if not spatialingestor_url:
-        raise Exception(
-            'Config option `{0}` must be set to use the SpatialIngestor.'.format('ckan.spatialingestor.url'))
+    current = settings.get()
+    site_url = current.site_url
+    callback_url = current.callback_url
 
-    site_url = config['ckan.site_url']
-    callback_url = site_url.rstrip('/') + '/api/3/action/spatialingestor_hook'
+    api_key = _api_key(context['model'], context['user'])
 
-    user = toolkit.get_action('user_show')(context, {'id': context['user']})
+    input_format = formats.detect(resource)
+    chunking = None
+    if job_type == 'spatial_ingest':
+        chunking = chunks.plan((data_dict.get('fingerprint') or {}).get('size') or resource.get('size'),
+                               input_format)
 
-    task = {
-        'entity_id': res_id,
-        'entity_type': 'resource',
-        'task_type': job_type,
-        'last_updated': str(datetime.datetime.utcnow()),
-        'state': 'submitting',
-        'key': 'spatialingestor',
-        'value': '{}',
-        'error': '{}',
-    }
-
-    try:
-        task_id = toolkit.get_action('task_status_show')(context, {
-            'entity_id': res_id,
-            'task_type': job_type,
-            'key': 'spatialingestor'
-        })['id']
-        task['id'] = task_id
-    except logic.NotFound:
-        pass
-
-    context['ignore_auth'] = True
-    toolkit.get_action('task_status_update')(context, task)
+    # Start from a clean slate, the submission fills in the value. The
+    # nonce ties callback tokens to this submission, callbacks can come
+    # in before the job is recorded as pending.
+    nonce = tokens.nonce() if tokens.enabled() else None
+    lifecycle.transition(res_id, job_type, 'submitting', value={'nonce': nonce} if nonce else {}, error={})
 
     try:
         metadata_package = get_microservice_metadata()
         metadata_package['resource_id'] = res_id
         metadata_package['ckan_url'] = site_url
+        if input_format:
+            metadata_package['input_format'] = input_format
+        if nonce:
+            # Sent back in the metadata of every callback of the job
+            metadata_package['job_type'] = job_type
+            metadata_package['callback_token'] = tokens.issue(res_id, job_type, nonce)
+        if chunking:
+            # The microservice skips the chunks that are already complete and
+            # reports on each chunk through spatialingestor_hook
+            chunking['completed'] = chunks.start(res_id, resume=toolkit.asbool(data_dict.get('resume', False)))
+            chunking['max_attempts'] = current.chunk_max_attempts
+            metadata_package['chunking'] = chunking
         if job_type == 'spatial_purge':
             metadata_package['package_name'] = _get_or_bust(data_dict, 'package_name')
 
-        r = requests.post(
-            urlparse.urljoin(spatialingestor_url, 'job'),
-            headers={
-                'Content-Type': 'application/json'
-            },
-            data=json.dumps({
-                'api_key': user['apikey'],
-                'job_type': job_type,
-                'result_url': callback_url,
-                'metadata': metadata_package
-            }))
+        with metrics.timer('submit_seconds', job_type=job_type):
+            r = get_client().post(
+                'job',
+                headers={
+                    'Content-Type': 'application/json'
+                },
+                data=json.dumps({
+                    'api_key': api_key,
+                    'job_type': job_type,
+                    'result_url': callback_url,
+                    'metadata': metadata_package
+                }))
         r.raise_for_status()
-    except requests.exceptions.ConnectionError, e:
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+        metrics.inc('submissions_total', job_type=job_type, outcome='connection_error')
         error = {'message': 'Could not connect to Spatial Ingestor.',
                  'details': str(e)}
-        task['error'] = json.dumps(error)
-        task['state'] = 'error'
-        task['last_updated'] = str(datetime.datetime.utcnow()),
-        toolkit.get_action('task_status_update')(context, task)
-        raise toolkit.ValidationError(error)
+        history.record(res_id, job_type, 'error', input_format=input_format, error={'type': type(e).__name__})
+        lifecycle.transition(res_id, job_type, 'error', error=error)
+        raise IngestorUnavailable(error)
 
     except requests.exceptions.HTTPError, e:
+        metrics.inc('submissions_total', job_type=job_type, outcome='http_error')
         m = 'An Error occurred while sending the job: {0}'.format(e.message)
         try:
             body = e.response.json()
@@ -100,19 +111,21 @@ def spatialingestor_job_submit(context, data_dict):
         error = {'message': m,
                  'details': body,
                  'status_code': r.status_code}
-        task['error'] = json.dumps(error)
-        task['state'] = 'error'
-        task['last_updated'] = str(datetime.datetime.utcnow()),
-        toolkit.get_action('task_status_update')(context, task)
+        history.record(res_id, job_type, 'error', input_format=input_format,
+                       error={'type': 'HTTP {0}'.format(r.status_code)})
+        lifecycle.transition(res_id, job_type, 'error', error=error)
         raise toolkit.ValidationError(error)
 
-    value = json.dumps({'job_id': r.json()['job_id'],
-                        'job_key': r.json()['job_key']})
+    metrics.inc('submissions_total', job_type=job_type, outcome='submitted')
 
-    task['value'] = value
-    task['state'] = 'pending'
-    task['last_updated'] = str(datetime.datetime.utcnow()),
-    toolkit.get_action('task_status_update')(context, task)
+    job = r.json()
+    lifecycle.transition(res_id, job_type, 'pending', value={'job_id': job['job_id'],
+                                                             'job_key': job['job_key'],
+                                                             'fingerprint': data_dict.get('fingerprint'),
+                                                             'chunking': chunking,
+                                                             'input_format': input_format,
+                                                             'nonce': nonce,
+                                                             'submitted': str(datetime.datetime.utcnow())})
 
     return True
 
@@ -127,35 +140,91 @@ def spatialingestor_hook(context, data_dict):
     :type resource: dict
     :param task_info: message list of task steps
     :type tast_info: list[string]
+    :param chunk: progress of one chunk of a split job, ``{'index': <int>,
+        'status': <state>, 'count': <number of chunks>, ...}`` (optional)
+    :type chunk: dict
+
+    :returns: for chunk callbacks, ``{'retry_chunk': <bool>}`` telling the
+        microservice whether to try a failed chunk again
+    :rtype: dictionary
     '''
 
     metadata, status = _get_or_bust(data_dict, ['metadata', 'status'])
-    job_type = 'spatial_ingest'
+    # Signed submissions say which job they are, others are ingests
+    job_type = metadata.get('job_type') if metadata.get('callback_token') else None
+    job_type = job_type or 'spatial_ingest'
 
     res_id = _get_or_bust(metadata, 'resource_id')
+    chunk = data_dict.get('chunk')
 
-    # Pass metadata, not data_dict, as it contains the resource id needed
-    # on the auth checks
-    toolkit.check_access('spatialingestor_job_submit', context, {
-        'resource_id': res_id,
-        'job_type': job_type})
+    current_job = None
+    if metadata.get('callback_token') and tokens.enabled():
+        # A valid token is all the authorization a callback needs, as long
+        # as it belongs to the current submission (checked on the update)
+        try:
+            current_job = {'nonce': tokens.verify(metadata['callback_token'], res_id, job_type)}
+        except tokens.InvalidToken, e:
+            raise toolkit.NotAuthorized(str(e))
+        context = dict(context, ignore_auth=True)
+    else:
+        # Pass metadata, not data_dict, as it contains the resource id needed
+        # on the auth checks
+        toolkit.check_access('spatialingestor_job_submit', context, {
+            'resource_id': res_id,
+            'job_type': job_type})
+
+    if chunk is not None:
+        try:
+            chunks.validate(chunk)
+        except ValueError, e:
+            raise toolkit.ValidationError({'chunk': [str(e)]})
+
+    # Keep the job detail sent with the callback (step log, timings,
+    # outputs) so spatialingestor_status can serve it without asking
+    # the microservice. The transition is committed together with a
+    # possible resubmission below, or by spatialingestor_hook_batch.
+    merge_value = {'detail_updated': str(datetime.datetime.utcnow())}
+    if chunk is None:
+        merge_value['job_detail'] = dict((k, v) for k, v in data_dict.items() if k not in ('metadata', 'status'))
+    elif chunk.get('count'):
+        # The job detail stays that of the whole job
+        merge_value['chunk_count'] = chunk['count']
+    task = lifecycle.transition(res_id, job_type, status, merge_value=merge_value, create=False, commit=False,
+                                if_value=current_job)
+    if task is None:
+        if current_job and lifecycle.get(res_id, job_type) is not None:
+            raise toolkit.NotAuthorized('Callback token of a superseded {0} job of resource {1}'.format(
+                job_type, res_id))
+        raise toolkit.ObjectNotFound('No {0} task for resource {1}'.format(job_type, res_id))
+    value = json.loads(task['value'])
 
-    task = toolkit.get_action('task_status_show')(context, {
-        'entity_id': res_id,
-        'task_type': job_type,
-        'key': 'spatialingestor'
-    })
+    retry_chunk = False
+    if chunk is not None:
+        metrics.inc('chunk_callbacks_total', status=chunk['status'])
+        retry_chunk = chunks.record(res_id, value.get('job_id'), chunk)
 
-    task['state'] = status
-    task['last_updated'] = str(datetime.datetime.utcnow())
+    metrics.inc('hook_callbacks_total', job_type=job_type, status=status)
+    if status in ('complete', 'error'):
+        duration = None
+        if value.get('submitted'):
+            try:
+                duration = (datetime.datetime.utcnow() - parse_date(value['submitted'])).total_seconds()
+                metrics.observe('job_seconds', duration, job_type=job_type, status=status)
+            except ValueError:
+                pass
+        history.record(res_id, job_type, status, job_id=value.get('job_id'), input_format=value.get('input_format'),
+                       error=data_dict.get('error'), duration=duration,
+                       size=data_dict.get('bytes') or (value.get('fingerprint') or {}).get('size'))
+        # The finished job makes room for a deferred submission, committed
+        # together with this callback
+        admission.release(commit=False)
 
     resubmit = False
 
-    if status == 'complete':
+    if status == 'complete' and job_type == 'spatial_ingest':
         # Create default views for resource if necessary (only the ones that
         # require data to be in the DataStore)
-        resource_dict = toolkit.get_action('resource_show')(
-            context, {'id': res_id})
+        resource_dict = memo.show('resource_show', context, {'id': res_id})
 
         # Check if the uploaded file has been modified in the meantime
         if (resource_dict.get('last_modified') and
@@ -178,14 +247,53 @@ def spatialingestor_hook(context, data_dict):
                 resource_dict['url'], metadata['original_url']))
             resubmit = True
 
-    context['ignore_auth'] = True
-    toolkit.get_action('task_status_update')(context, task)
-
     if resubmit:
-        log.debug('Resource {0} has been modified, '
-                  'resubmitting to DataPusher'.format(res_id))
-        toolkit.get_action('spatialingestor_job_submit')(
-            context, res_id, job_type)
+        # The worker compares content fingerprints and only resubmits if
+        # the data itself changed
+        log.debug('Resource {0} may have been modified, '
+                  'queueing it for the Spatial Ingestor'.format(res_id))
+        outbox.enqueue(outbox.INGEST, res_id)
+    elif status == 'complete' and job_type == 'spatial_ingest' and _describe_enabled():
+        # Too slow for the callback, the worker reads the layer from PostGIS
+        outbox.enqueue(outbox.DESCRIBE, res_id)
+
+    if not context.get('defer_commit'):
+        context['model'].Session.commit()
+
+    if chunk is not None:
+        return {'retry_chunk': retry_chunk}
+
+
+def spatialingestor_hook_batch(context, data_dict):
+    '''Apply several spatialingestor job callbacks in one transaction.
+
+    :param callbacks: ``spatialingestor_hook`` payloads
+    :type callbacks: list of dictionaries
+
+    :returns: ``{'updated': <count>, 'errors': [{'resource_id': ..., 'error': ...}, ...],
+        'retry_chunks': [{'resource_id': ..., 'index': ...}, ...]}``
+    :rtype: dictionary
+    '''
+    callbacks = _get_or_bust(data_dict, 'callbacks')
+    if not isinstance(callbacks, list):
+        raise toolkit.ValidationError({'callbacks': ['Must be a list of callbacks']})
+
+    updated = 0
+    errors = []
+    retry_chunks = []
+    for callback in callbacks:
+        try:
+            result = spatialingestor_hook(dict(context, defer_commit=True), callback)
+            updated += 1
+            if result and result['retry_chunk']:
+                retry_chunks.append({'resource_id': callback['metadata']['resource_id'],
+                                     'index': callback['chunk']['index']})
+        except (toolkit.ObjectNotFound, toolkit.ValidationError, toolkit.NotAuthorized), e:
+            errors.append({'resource_id': (callback.get('metadata') or {}).get('resource_id'),
+                           'error': str(e)})
+
+    context['model'].Session.commit()
+    return {'updated': updated, 'errors': errors, 'retry_chunks': retry_chunks}
 
 
 def spatialingestor_status(context, data_dict):
@@ -193,32 +301,37 @@ def spatialingestor_status(context, data_dict):
 
     toolkit.check_access('spatialingestor_status', context, {'id': res_id})
 
-    task = toolkit.get_action('task_status_show')(context, {
-        'entity_id': res_id,
-        'task_type': job_type,
-        'key': 'spatialingestor'
-    })
-
-    spatialingestor_url = config.get('ckan.spatialingestor.url')
-    if not spatialingestor_url:
-        raise toolkit.ValidationError({'configuration': ['ckan.spatialingestor.url not in config file']})
+    task = lifecycle.get(res_id, job_type)
+    if task is None:
+        raise toolkit.ObjectNotFound('No {0} task for resource {1}'.format(job_type, res_id))
 
     value = json.loads(task['value'])
     job_key = value.get('job_key')
     job_id = value.get('job_id')
     url = None
-    job_detail = None
+    job_detail = value.get('job_detail')
 
     if job_id:
-        url = urlparse.urljoin(spatialingestor_url, 'job' + '/' + job_id)
-        try:
-            r = requests.get(url, headers={'Content-Type': 'application/json',
-                                           'Authorization': job_key})
-            r.raise_for_status()
-            job_detail = r.json()
-        except (requests.exceptions.ConnectionError,
-                requests.exceptions.HTTPError):
-            job_detail = {'error': 'cannot connect to spatialingestor'}
+        client = get_client()
+        url = client.url('job' + '/' + job_id)
+
+        if job_detail is None or toolkit.asbool(data_dict.get('refresh', False)) or \
+                _job_detail_stale(task['state'], value.get('detail_updated')):
+            try:
+                r = client.get(url, headers={'Content-Type': 'application/json',
+                                             'Authorization': job_key})
+                r.raise_for_status()
+                job_detail = r.json()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError):
+                job_detail = job_detail or {'error': 'cannot connect to spatialingestor'}
+            else:
+                # Only cache the detail if no callback or resubmission moved the task on since it was read
+                lifecycle.transition(res_id, job_type, task['state'], merge_value={
+                    'job_detail': job_detail,
+                    'detail_updated': str(datetime.datetime.utcnow())}, create=False, touch=False,
+                    if_state=task['state'])
 
     return {
         'status': task['state'],
@@ -227,42 +340,252 @@ def spatialingestor_status(context, data_dict):
         'last_updated': task['last_updated'],
         'job_key': job_key,
         'task_info': job_detail,
-        'error': json.loads(task['error'])
+        'error': json.loads(task['error']),
+        'chunks': chunks.summary(res_id, value.get('chunk_count')) if value.get('chunking') else None,
+        'history': history.recent(res_id, job_type)
     }
 
 
+def spatialingestor_status_list(context, data_dict):
+    '''Return the spatial ingestor task records of many resources at once.
+
+    :param resource_ids: resources to report on
+    :type resource_ids: list of strings
+    :param package_id: report on the resources of this dataset
+    :type package_id: string
+    :param organization_id: report on the resources of this organization
+    :type organization_id: string
+    :param state: only return tasks in these states (e.g. ``pending``, ``error``)
+    :type state: string or list of strings
+    :param job_type: only return tasks of this type (e.g. ``spatial_ingest``)
+    :type job_type: string
+    :param max_age: only return tasks updated in the last ``max_age`` seconds
+    :type max_age: int
+    :param limit: maximum number of records to return (default: 100, max: 1000)
+    :type limit: int
+    :param offset: number of records to skip
+    :type offset: int
+
+    :returns: ``{'count': <total matches>, 'results': [<status record>, ...]}``
+    :rtype: dictionary
+    '''
+    model = context['model']
+
+    toolkit.check_access('spatialingestor_status_list', context, data_dict)
+
+    resource_ids = data_dict.get('resource_ids')
+    if isinstance(resource_ids, basestring):
+        resource_ids = toolkit.aslist(resource_ids, ',')
+    states = data_dict.get('state')
+    if isinstance(states, basestring):
+        states = toolkit.aslist(states, ',')
+
+    errors = {}
+    limit = _int_param(data_dict, 'limit', 100, 1, errors)
+    offset = _int_param(data_dict, 'offset', 0, 0, errors)
+    max_age = _int_param(data_dict, 'max_age', None, None, errors)
+    if errors:
+        raise toolkit.ValidationError(errors)
+    limit = min(limit, 1000)
+
+    task = model.TaskStatus
+    query = model.Session.query(task, model.Resource.package_id, func.count().over()) \
+        .join(model.Resource, model.Resource.id == task.entity_id) \
+        .filter(task.key == 'spatialingestor')
+
+    if resource_ids:
+        query = query.filter(task.entity_id.in_(resource_ids))
+    if data_dict.get('package_id'):
+        package = model.Package.get(data_dict['package_id'])
+        if package is None:
+            raise toolkit.ObjectNotFound('Dataset not found')
+        query = query.filter(model.Resource.package_id == package.id)
+    if data_dict.get('organization_id'):
+        organization = model.Group.get(data_dict['organization_id'])
+        if organization is None:
+            raise toolkit.ObjectNotFound('Organization not found')
+        query = query.join(model.Package, model.Package.id == model.Resource.package_id) \
+            .filter(model.Package.owner_org == organization.id)
+    if states:
+        query = query.filter(task.state.in_(states))
+    if data_dict.get('job_type'):
+        query = query.filter(task.task_type == data_dict['job_type'])
+    if max_age is not None:
+        query = query.filter(task.last_updated >= datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age))
+
+    rows = query.order_by(task.last_updated.desc()).limit(limit).offset(offset).all()
+
+    results = []
+    for task_obj, package_id, _ in rows:
+        value = json.loads(task_obj.value or '{}')
+        results.append({
+            'resource_id': task_obj.entity_id,
+            'package_id': package_id,
+            'job_type': task_obj.task_type,
+            'status': task_obj.state,
+            'job_id': value.get('job_id'),
+            'last_updated': task_obj.last_updated.isoformat() if task_obj.last_updated else None,
+            'task_info': value.get('job_detail'),
+            'error': json.loads(task_obj.error or '{}'),
+        })
+
+    return {'count': rows[0][2] if rows else 0,
+            'results': results}
+
+
+def spatialingestor_metrics(context, data_dict):
+    '''Return the metrics of this process in the Prometheus text format.
+
+    Queue depths (outbox entries and spatialingestor tasks per state) are
+    sampled from the database on each call.
+    '''
+    model = context['model']
+
+    toolkit.check_access('spatialingestor_metrics', context, data_dict)
+
+    for state, count in outbox.depth().items():
+        metrics.set_gauge('outbox_entries', count, state=state)
+
+    rows = model.Session.query(model.TaskStatus.task_type, model.TaskStatus.state, func.count()) \
+        .filter(model.TaskStatus.key == 'spatialingestor') \
+        .group_by(model.TaskStatus.task_type, model.TaskStatus.state)
+    for job_type, state, count in rows:
+        metrics.set_gauge('tasks', count, job_type=job_type, state=state)
+
+    return metrics.get_backend().render()
+
+
+def spatialingestor_job_stats(context, data_dict):
+    '''Return counts and durations of finished jobs from the job history.
+
+    :param group_by: ``input_format`` (default), ``outcome``, ``error_class``
+        or ``job_type``
+    :type group_by: string
+    :param job_type: only count jobs of this type (default: ``spatial_ingest``)
+    :type job_type: string
+    :param max_age: only count jobs finished in the last ``max_age`` seconds
+    :type max_age: int
+
+    :returns: one record per group with ``jobs``, ``complete``,
+        ``mean_seconds``, ``p50_seconds``, ``p95_seconds`` and ``bytes``
+    :rtype: list of dictionaries
+    '''
+    toolkit.check_access('spatialingestor_job_stats', context, data_dict)
+
+    errors = {}
+    max_age = _int_param(data_dict, 'max_age', None, None, errors)
+    if errors:
+        raise toolkit.ValidationError(errors)
+    try:
+        return history.stats(group_by=data_dict.get('group_by', 'input_format'),
+                             job_type=data_dict.get('job_type', 'spatial_ingest'), max_age=max_age)
+    except ValueError, e:
+        raise toolkit.ValidationError({'group_by': [str(e)]})
+
+
+_api_keys = {}
+
+
+def _api_key(model, user_name):
+    '''API key of ``user_name`` for the microservice, cached for
+    ``ckan.spatialingestor.api_key_cache_ttl`` seconds instead of a
+    ``user_show`` per submission.'''
+    now = time.time()
+    cached = _api_keys.get(user_name)
+    if cached and cached[0] > now:
+        metrics.inc('api_key_lookups_total', cache='hit')
+        return cached[1]
+    metrics.inc('api_key_lookups_total', cache='miss')
+    user = model.User.get(user_name)
+    if user is None:
+        raise toolkit.ObjectNotFound('User {0} not found'.format(user_name))
+    _api_keys[user_name] = (now + settings.get().api_key_cache_ttl, user.apikey)
+    return user.apikey
+
+
+def _int_param(data_dict, key, default, minimum, errors):
+    '''``data_dict[key]`` as an integer, or ``default`` if it is not given.
+    Problems are added to ``errors`` under ``key``.'''
+    value = data_dict.get(key)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        errors[key] = ['{0} must be an integer'.format(key)]
+        return default
+    if minimum is not None and value < minimum:
+        errors[key] = ['{0} must be at least {1}'.format(key, minimum)]
+        return default
+    return value
+
+
+def _describe_enabled():
+    current = settings.get()
+    return current.describe_layers or current.seed_zoom_levels or current.vector_tiles
+
+
+def _job_detail_stale(state, detail_updated):
+    '''Whether the cached job detail of an unfinished job is older than
+    ``ckan.spatialingestor.status_refresh_after`` seconds (0 disables).'''
+    refresh_after = settings.get().status_refresh_after
+    if not refresh_after or state in ('complete', 'error') or not detail_updated:
+        return False
+    try:
+        age = datetime.datetime.utcnow() - parse_date(detail_updated)
+    except ValueError:
+        return True
+    return age > datetime.timedelta(seconds=refresh_after)
+
+
 def ingest_resource(context, resource_dict):
+    if context.get('sniff_format') and not is_spatially_ingestible_resource(resource_dict):
+        input_format = formats.sniff(resource_dict)
+        if not input_format:
+            log.debug('No spatial format found in the content of resource {0}'.format(resource_dict['id']))
+            return
+        log.info('Sniffed format {0} for resource {1}'.format(input_format, resource_dict['id']))
+        # Kept as an extra so the format is still known after the update below
+        resource_dict['spatial_input_format'] = input_format
+
     if toolkit.asbool(resource_dict.get('spatial_parent', 'False')):
-        try:
-            task = toolkit.get_action('task_status_show')(
-                {
-                    'ignore_auth': True
-                }, {
-                    'entity_id': resource_dict['id'],
-                    'task_type': 'spatial_ingest',
-                    'key': 'spatialingestor'
-                })
-            if task.get('state') in ['pending']:
-                # There already is a pending Spatialingestor submission,
-                # skip this one ...
-                log.debug(
-                    'Skipping Spatial Ingestor submission for resource {0}'.format(resource_dict['id']))
-                return
-        except toolkit.ObjectNotFound:
-            pass
+        task = lifecycle.get(resource_dict['id'], 'spatial_ingest') or {}
+        if task.get('state') in ['pending']:
+            # There already is a pending Spatialingestor submission,
+            # skip this one ...
+            log.debug(
+                'Skipping Spatial Ingestor submission for resource {0}'.format(resource_dict['id']))
+            return
+        previous_state = task.get('state')
+        previous_value = json.loads(task.get('value') or '{}')
+        previous_fingerprint = previous_value.get('fingerprint')
+
+        current_fingerprint = fingerprint.compute(resource_dict, previous_fingerprint)
+        unchanged = fingerprint.unchanged(current_fingerprint, previous_fingerprint)
+        if previous_state == 'complete' and not context.get('force_ingest') and unchanged:
+            log.debug('Content of resource {0} is unchanged, skipping Spatial Ingestor submission'.format(
+                resource_dict['id']))
+            return
+        # A split job that failed part way through picks up where it stopped
+        resume = previous_state == 'error' and bool(previous_value.get('chunking')) and unchanged
 
         try:
             log.debug('Submitting resource {0} to Spatial Ingestor'.format(resource_dict['id']))
 
             toolkit.get_action('spatialingestor_job_submit')(context, {
                 'resource_id': resource_dict['id'],
-                'job_type': 'spatial_ingest'
+                'job_type': 'spatial_ingest',
+                'fingerprint': current_fingerprint,
+                'resume': resume
             })
+        except IngestorUnavailable:
+            # Left to the outbox worker to retry with backoff
+            raise
         except toolkit.ValidationError, e:
             log.error(e)
     elif is_spatially_ingestible_resource(resource_dict):
         try:
-            dataset = toolkit.get_action('package_show')(context, {
+            dataset = memo.show('package_show', context, {
                 'id': resource_dict['package_id'],
             })
         except Exception, e:
@@ -278,6 +601,9 @@ def ingest_resource(context, resource_dict):
             toolkit.get_action('resource_update')(context, resource_dict)
         except toolkit.ValidationError, e:
             log.error(e)
+        finally:
+            memo.for_context(context).invalidate(package_id=resource_dict['package_id'],
+                                                 resource_id=resource_dict['id'])
 
 
 def purge_resource_datastores(context, resource_dict):
@@ -288,23 +614,12 @@ def purge_resource_datastores(context, resource_dict):
 
     if toolkit.asbool(resource_dict.get('spatial_parent', 'False')):
         # We have a spatial parent, so we have to get all the child resources
-        try:
-            # Make sure there is no other purginging process is running
-            task = toolkit.get_action('task_status_show')(
-                {
-                    'ignore_auth': True
-                }, {
-                    'entity_id': resource_dict['id'],
-                    'task_type': 'spatial_purge',
-                    'key': 'spatialingestor'
-                })
-
-            if task.get('state') in ['init', 'pending']:
-                log.debug(
-                    'Skipping spatial ingestor purge for resource {0}'.format(resource_dict['id']))
-                return
-        except toolkit.ObjectNotFound:
-            pass
+        # Make sure there is no other purginging process is running
+        task = lifecycle.get(resource_dict['id'], 'spatial_purge') or {}
+        if task.get('state') in ['init', 'pending']:
+            log.debug(
+                'Skipping spatial ingestor purge for resource {0}'.format(resource_dict['id']))
+            return
 
         log.debug(
             'Submitting job to purge PostGIS and Geoserver assets linked to resource {0}'.format(resource_dict['id']))
@@ -321,25 +636,5 @@ def purge_resource_datastores(context, resource_dict):
 
 
 def delete_orphaned_resources(context, pkg_dict):
-    spatial_parent_ids = []
-    spatial_children = []
-    invalid_ids = []
-
-    for res in pkg_dict['resources']:
-        if toolkit.asbool(res.get('spatial_parent', 'False')):
-            spatial_parent_ids.append(res['id'])
-        elif res.get('spatial_child_of', '') != '':
-            spatial_children.append((res['id'], res['spatial_child_of']))
-
-    for child_id, parent_id in spatial_children:
-        if parent_id not in spatial_parent_ids:
-            invalid_ids.append(child_id)
-
-    model = context['model']
-
-    for res in pkg_dict['resources']:
-        if res['id'] in invalid_ids:
-            del_dict = dict(state='deleted')
-            model.Session.query(model.Resource).filter_by(id=res['id']).update(del_dict)
-
-
+    if orphans.collect(package_ids=[pkg_dict['id']]):
+        memo.for_context(context).invalidate(package_id=pkg_dict['id'])
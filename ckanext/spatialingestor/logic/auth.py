@@ -1,19 +1,40 @@
 from ckan.logic import get_or_bust
-from ckan.logic.auth import create as auth_create, delete as auth_delete, get as auth_get
+from ckan.logic.auth import create as auth_create, delete as auth_delete, get as auth_get, update as auth_update
 
 
 def spatialingestor_job_submit(context, data):
     res_id, job_type = get_or_bust(data, ['resource_id', 'job_type'])
 
-    if job_type == 'ingest':
+    # The task types the actions and the resource page pass
+    if job_type == 'spatial_ingest':
         return auth_create.resource_create(context, {'id': res_id})
-    elif job_type == 'purge':
+    elif job_type == 'spatial_purge':
         return auth_delete.resource_delete(context, {'id': res_id})
     else:
-        return False
+        return {'success': False}
 
 
 def spatialingestor_status(context, data):
     res_id = get_or_bust(data, 'resource_id')
 
     return auth_get.resource_show(context, {'id': res_id})
+
+
+def spatialingestor_status_list(context, data):
+    if data.get('package_id'):
+        return auth_update.package_update(context, {'id': data['package_id']})
+    elif data.get('organization_id'):
+        return auth_update.organization_update(context, {'id': data['organization_id']})
+    else:
+        # Listing arbitrary resources or the whole site is for sysadmins only
+        return {'success': False}
+
+
+def spatialingestor_metrics(context, data):
+    # Sysadmins only
+    return {'success': False}
+
+
+def spatialingestor_job_stats(context, data):
+    # Sysadmins only
+    return {'success': False}
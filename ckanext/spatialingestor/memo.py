@@ -0,0 +1,65 @@
+from ckan.plugins import toolkit
+
+from ckanext.spatialingestor import metrics
+
+CONTEXT_KEY = 'spatialingestor_memo'
+
+MEMOIZED_ACTIONS = ('package_show', 'resource_show', 'user_show')
+
+
+class Memo(object):
+    '''Remembers the results of ``package_show``, ``resource_show`` and
+    ``user_show`` for the length of one request or job.
+
+    The cached dicts are shared between callers and must not be modified.
+    Whoever changes a dataset, resource or user through the extension
+    calls :meth:`invalidate` so later lookups see the change.
+    '''
+
+    def __init__(self):
+        self._results = {}
+
+    def show(self, action, context, data_dict):
+        if action not in MEMOIZED_ACTIONS:
+            raise ValueError('{0} is not memoized'.format(action))
+        key = (action, data_dict['id'])
+        if key in self._results:
+            metrics.inc('memo_lookups_total', action=action, cache='hit')
+            return self._results[key]
+        metrics.inc('memo_lookups_total', action=action, cache='miss')
+        with metrics.timer(action + '_seconds'):
+            result = toolkit.get_action(action)(dict(context), data_dict)
+        # Remember the result under both its ID and its name
+        self._results[key] = result
+        if isinstance(result, dict) and result.get('id'):
+            self._results[(action, result['id'])] = result
+            if result.get('name'):
+                self._results[(action, result['name'])] = result
+        return result
+
+    def invalidate(self, package_id=None, resource_id=None, user_id=None):
+        '''Forget the given objects. A resource change also affects the
+        dataset that holds it, so pass both.'''
+        for action, reference in (('package_show', package_id), ('resource_show', resource_id),
+                                  ('user_show', user_id)):
+            if reference is None:
+                continue
+            cached = self._results.get((action, reference))
+            stale = set([reference])
+            if isinstance(cached, dict):
+                stale.update(value for value in (cached.get('id'), cached.get('name')) if value)
+            for value in stale:
+                self._results.pop((action, value), None)
+
+
+def for_context(context):
+    '''The memo of ``context``, created on first use. Copies of a context
+    share its memo.'''
+    memo = context.get(CONTEXT_KEY)
+    if memo is None:
+        memo = context[CONTEXT_KEY] = Memo()
+    return memo
+
+
+def show(action, context, data_dict):
+    return for_context(context).show(action, context, data_dict)
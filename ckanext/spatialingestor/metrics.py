@@ -0,0 +1,199 @@
+import bisect
+import contextlib
+import functools
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from ckan.plugins import toolkit
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+PREFIX = 'spatialingestor_'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+class NullBackend(object):
+    '''Discards everything. Also the interface other backends implement.'''
+
+    def inc(self, name, value=1, labels=None):
+        pass
+
+    def observe(self, name, seconds, labels=None):
+        pass
+
+    def set(self, name, value, labels=None):
+        pass
+
+    def render(self):
+        return ''
+
+
+class MemoryBackend(NullBackend):
+    '''Keeps counters, gauges and histograms in process memory and renders
+    them in the Prometheus text exposition format.'''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, labels=None):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def set(self, name, value, labels=None):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), value in sorted(values.items()):
+                    if name not in typed:
+                        lines.append('# TYPE {0}{1} {2}'.format(PREFIX, name, kind))
+                        typed.add(name)
+                    lines.append('{0}{1}{2} {3}'.format(PREFIX, name, _format_labels(labels), value))
+
+            typed = set()
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE {0}{1} histogram'.format(PREFIX, name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append('{0}{1}_bucket{2} {3}'.format(
+                        PREFIX, name, _format_labels(labels, [('le', bound)]), cumulative))
+                lines.append('{0}{1}_bucket{2} {3}'.format(
+                    PREFIX, name, _format_labels(labels, [('le', '+Inf')]), histogram['count']))
+                lines.append('{0}{1}_sum{2} {3}'.format(PREFIX, name, _format_labels(labels), histogram['sum']))
+                lines.append('{0}{1}_count{2} {3}'.format(PREFIX, name, _format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+class FileBackend(MemoryBackend):
+    '''Memory backend that also writes its metrics to ``path`` at most
+    every ``interval`` seconds, e.g. for the node_exporter textfile
+    collector. ``{pid}`` in the path is replaced by the process ID so
+    each CKAN process writes its own file.'''
+
+    def __init__(self, path, interval=15, **kwargs):
+        super(FileBackend, self).__init__(**kwargs)
+        self.path = path
+        self.interval = interval
+        self._written = 0
+
+    def _maybe_write(self):
+        now = time.time()
+        if now - self._written < self.interval:
+            return
+        self._written = now
+        path = self.path.format(pid=os.getpid())
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            log.warning('Could not write metrics to {0}: {1}'.format(path, e))
+
+    def inc(self, name, value=1, labels=None):
+        super(FileBackend, self).inc(name, value, labels)
+        self._maybe_write()
+
+    def observe(self, name, seconds, labels=None):
+        super(FileBackend, self).observe(name, seconds, labels)
+        self._maybe_write()
+
+
+_backend = MemoryBackend()
+
+
+def load(config):
+    '''Select the backend from ``ckan.spatialingestor.metrics.backend``:
+    ``memory`` (default), ``file``, ``null`` or ``package.module:Class``.'''
+    global _backend
+    name = config.get('ckan.spatialingestor.metrics.backend', 'memory')
+    if name == 'memory':
+        _backend = MemoryBackend()
+    elif name == 'null':
+        _backend = NullBackend()
+    elif name == 'file':
+        path = config.get('ckan.spatialingestor.metrics.file')
+        if not path:
+            raise Exception('Config option `ckan.spatialingestor.metrics.file` must be set '
+                            'to use the file metrics backend.')
+        _backend = FileBackend(path, interval=toolkit.asint(config.get('ckan.spatialingestor.metrics.interval', 15)))
+    else:
+        module_name, class_name = name.split(':')
+        module = __import__(module_name, fromlist=[class_name])
+        _backend = getattr(module, class_name)()
+    return _backend
+
+
+def get_backend():
+    return _backend
+
+
+def inc(name, value=1, **labels):
+    _backend.inc(name, value, labels)
+
+
+def observe(name, seconds, **labels):
+    _backend.observe(name, seconds, labels)
+
+
+def set_gauge(name, value, **labels):
+    _backend.set(name, value, labels)
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    '''Record the duration of the block in the ``name`` histogram.'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        _backend.observe(name, time.time() - start, labels)
+
+
+def timed(name, **labels):
+    '''Decorator version of :func:`timer`.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
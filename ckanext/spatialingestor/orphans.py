@@ -0,0 +1,58 @@
+import logging
+
+from ckan import model
+from ckan.lib import search
+from sqlalchemy import text
+
+from ckanext.spatialingestor import discovery, metrics
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+# Same notion of an orphan as discovery.orphaned_children: an active
+# spatial child whose parent is not an active spatial parent of the same
+# active dataset
+_DELETE_ORPHANS = '''
+    UPDATE resource r SET state = 'deleted'
+    FROM package p
+    WHERE p.id = r.package_id AND p.state = 'active' AND r.state = 'active'
+      AND nullif(r.extras::json ->> 'spatial_child_of', '') IS NOT NULL
+      {where}
+      AND NOT EXISTS (
+          SELECT 1 FROM resource parent
+          WHERE parent.id = r.extras::json ->> 'spatial_child_of'
+            AND parent.package_id = r.package_id
+            AND parent.state = 'active'
+            AND coalesce(lower(parent.extras::json ->> 'spatial_parent') IN :true_values, false))
+    RETURNING r.package_id'''
+
+
+def collect(package_ids=None, reindex_batch_size=500):
+    '''Delete the orphaned spatial children of ``package_ids`` (default:
+    every dataset) in one statement, then reindex the affected datasets.
+
+    :returns: number of resources deleted
+    '''
+    params = {'true_values': discovery.TRUE_VALUES}
+    where = ''
+    if package_ids is not None:
+        params['package_ids'] = tuple(package_ids)
+        if not params['package_ids']:
+            return 0
+        where = 'AND r.package_id IN :package_ids'
+
+    rows = model.Session.execute(text(_DELETE_ORPHANS.format(where=where)), params).fetchall()
+    model.Session.commit()
+
+    if rows:
+        metrics.inc('orphans_deleted_total', len(rows))
+        affected = sorted(set(row[0] for row in rows))
+        log.info('Deleted {0} orphaned spatial resources from {1} datasets'.format(len(rows), len(affected)))
+        reindex(affected, reindex_batch_size)
+    return len(rows)
+
+
+def reindex(package_ids, batch_size=500):
+    '''Reindex ``package_ids`` in batches with one search commit at the end.'''
+    for i in range(0, len(package_ids), batch_size):
+        search.rebuild(package_ids=package_ids[i:i + batch_size], defer_commit=True, quiet=True)
+    search.commit()
@@ -0,0 +1,219 @@
+import datetime
+import json
+import logging
+
+from ckan import model
+from ckan.model import meta, types as _types
+from sqlalchemy import Column, Index, Table, exc, text, types
+
+from ckanext.spatialingestor import settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+INGEST = 'ingest'
+PURGE = 'purge'
+ORPHANS = 'orphans'
+DESCRIBE = 'describe'
+RELEASE = 'release'
+
+outbox_table = Table(
+    'spatialingestor_outbox', meta.metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=_types.make_uuid),
+    Column('operation', types.UnicodeText, nullable=False),
+    Column('entity_id', types.UnicodeText, nullable=False),
+    Column('payload', types.UnicodeText),
+    Column('state', types.UnicodeText, nullable=False, default=u'pending'),
+    Column('attempts', types.Integer, nullable=False, default=0),
+    Column('error', types.UnicodeText),
+    Column('created', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Column('available_at', types.DateTime, nullable=False, default=datetime.datetime.utcnow),
+    Index('idx_spatialingestor_outbox_state_available', 'state', 'available_at'),
+    # At most one pending entry per operation and entity, see enqueue()
+    Index('idx_spatialingestor_outbox_pending', 'operation', 'entity_id', unique=True,
+          postgresql_where=text("state = 'pending'")),
+)
+
+# Idempotent statements bringing tables created by older versions up to date
+_migrations = [
+    """CREATE UNIQUE INDEX IF NOT EXISTS idx_spatialingestor_outbox_pending
+       ON spatialingestor_outbox (operation, entity_id) WHERE state = 'pending'""",
+]
+
+
+class OutboxNotReady(Exception):
+    pass
+
+
+def setup():
+    '''Create the outbox table if it does not exist yet and migrate it.'''
+    if not outbox_table.exists(bind=meta.engine):
+        outbox_table.create(bind=meta.engine)
+        log.info('Created table {0}'.format(outbox_table.name))
+
+    for statement in _migrations:
+        meta.engine.execute(statement)
+
+
+_ready = False
+
+
+def ensure_setup():
+    '''Run :func:`setup` once per process, so resource changes keep working
+    on a site upgraded without running ``initdb``.
+
+    :raises OutboxNotReady: if the table is missing and cannot be created
+    '''
+    global _ready
+    if _ready:
+        return
+    try:
+        setup()
+    except exc.SQLAlchemyError, e:
+        # Another process may have created it in the meantime
+        if not outbox_table.exists(bind=meta.engine):
+            raise OutboxNotReady('The {0} table is missing and could not be created ({1}), run '
+                                 '`paster --plugin=ckanext-spatialingestor spatialingestor initdb`'.format(
+                                     outbox_table.name, e))
+    _ready = True
+
+
+def enqueue(operation, entity_id, payload=None, session=None):
+    '''Record the intent to run ``operation`` on ``entity_id``.
+
+    The row is written through ``session`` (the current CKAN session by
+    default), so when this is called from ``notify`` it is committed
+    atomically with the change that triggered it.
+
+    Triggers for the same operation and entity are coalesced: while an
+    entry is still pending, a new trigger only merges its payload and
+    pushes the entry back by ``ckan.spatialingestor.quiet_window`` seconds
+    (but no further than ``ckan.spatialingestor.quiet_window_max`` seconds
+    after the first trigger), so a burst of saves results in one job.
+    '''
+    ensure_setup()
+    session = session or model.Session
+    now = datetime.datetime.utcnow()
+    current = settings.get()
+    quiet_window, quiet_window_max = current.quiet_window, current.quiet_window_max
+
+    session.execute(
+        text('''INSERT INTO spatialingestor_outbox
+                    (id, operation, entity_id, payload, state, attempts, created, available_at)
+                VALUES (:id, :operation, :entity_id, :payload, 'pending', 0, :now, :available_at)
+                ON CONFLICT (operation, entity_id) WHERE state = 'pending' DO UPDATE SET
+                    payload = (spatialingestor_outbox.payload::jsonb || EXCLUDED.payload::jsonb)::text,
+                    available_at = LEAST(EXCLUDED.available_at,
+                                         spatialingestor_outbox.created + :max_delay)'''),
+        {'id': _types.make_uuid(),
+         'operation': operation,
+         'entity_id': entity_id,
+         'payload': json.dumps(payload or {}),
+         'now': now,
+         'available_at': now + datetime.timedelta(seconds=quiet_window),
+         'max_delay': datetime.timedelta(seconds=quiet_window_max)})
+
+
+_NOT_RUNNING = '''NOT EXISTS (
+    SELECT 1 FROM spatialingestor_outbox running
+    WHERE running.state = 'running'
+      AND running.operation = pending.operation
+      AND running.entity_id = pending.entity_id)'''
+
+
+def claim(limit, exclude_operations=(), ids=None):
+    '''Atomically mark up to ``limit`` due entries as running and return them.
+
+    ``SKIP LOCKED`` lets several worker processes drain the outbox
+    without handing out the same entry twice, and an entry is not handed
+    out while the same operation on the same entity is still running.
+    While an entry is running ``available_at`` holds the time it was
+    claimed.
+
+    :param exclude_operations: leave entries of these operations alone
+    :param ids: only claim these entries, returned in the given order
+    '''
+    params = {'now': datetime.datetime.utcnow(), 'limit': limit}
+    where = ["state = 'pending'", 'available_at <= :now', _NOT_RUNNING]
+    if exclude_operations:
+        params['exclude_operations'] = tuple(exclude_operations)
+        where.append('operation NOT IN :exclude_operations')
+    if ids is not None:
+        if not ids:
+            return []
+        params['ids'] = tuple(ids)
+        where.append('id IN :ids')
+
+    rows = model.Session.execute(
+        text('''UPDATE spatialingestor_outbox
+                SET state = 'running', attempts = attempts + 1, available_at = :now
+                WHERE id IN (
+                    SELECT id FROM spatialingestor_outbox pending
+                    WHERE {where}
+                    ORDER BY available_at
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED)
+                RETURNING id, operation, entity_id, payload, attempts'''.format(where=' AND '.join(where))),
+        params).fetchall()
+    model.Session.commit()
+
+    entries = [{'id': r[0],
+                'operation': r[1],
+                'entity_id': r[2],
+                'payload': json.loads(r[3] or '{}'),
+                'attempts': r[4]} for r in rows]
+    if ids is not None:
+        order = dict((entry_id, i) for i, entry_id in enumerate(ids))
+        entries.sort(key=lambda entry: order[entry['id']])
+    return entries
+
+
+def complete(entry_id):
+    model.Session.execute(outbox_table.delete().where(outbox_table.c.id == entry_id))
+    model.Session.commit()
+
+
+_DELETE_SUPERSEDED = '''
+    DELETE FROM spatialingestor_outbox entry
+    WHERE {where} AND EXISTS (
+        SELECT 1 FROM spatialingestor_outbox pending
+        WHERE pending.state = 'pending'
+          AND pending.operation = entry.operation
+          AND pending.entity_id = entry.entity_id)'''
+
+
+def fail(entry_id, error, retry_in=None):
+    '''Put an entry back for another attempt after ``retry_in`` seconds,
+    or park it in the ``error`` state when ``retry_in`` is None.'''
+    values = {'error': unicode(error)}
+    if retry_in is None:
+        values['state'] = u'error'
+    else:
+        values['state'] = u'pending'
+        values['available_at'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_in)
+        # A newer trigger is already queued and covers this retry
+        model.Session.execute(_DELETE_SUPERSEDED.format(where='entry.id = :id'), {'id': entry_id})
+
+    model.Session.execute(outbox_table.update().where(outbox_table.c.id == entry_id).values(**values))
+    model.Session.commit()
+
+
+def requeue_stale(older_than):
+    '''Return ``running`` entries abandoned by a dead worker to the queue.'''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=older_than)
+    model.Session.execute(
+        _DELETE_SUPERSEDED.format(where="entry.state = 'running' AND entry.available_at < :cutoff"),
+        {'cutoff': cutoff})
+    result = model.Session.execute(
+        outbox_table.update()
+        .where(outbox_table.c.state == u'running')
+        .where(outbox_table.c.available_at < cutoff)
+        .values(state=u'pending'))
+    model.Session.commit()
+    return result.rowcount
+
+
+def depth():
+    '''Number of outbox entries per state.'''
+    rows = model.Session.execute(
+        'SELECT state, count(*) FROM spatialingestor_outbox GROUP BY state').fetchall()
+    return dict((r[0], r[1]) for r in rows)
@@ -0,0 +1,167 @@
+import datetime
+import json
+
+from ckan import model
+from sqlalchemy import text
+
+from ckanext.spatialingestor import discovery, lifecycle, reconcile
+
+REINGEST = 'reingestall'
+PURGE = 'purgeall'
+
+# Job type whose durations estimate each operation
+JOB_TYPES = {REINGEST: 'spatial_ingest', PURGE: 'spatial_purge'}
+
+# Upper bounds in bytes, then everything larger
+SIZE_BUCKETS = ((1 << 20, '<1MB'), (10 << 20, '1-10MB'), (100 << 20, '10-100MB'), (1 << 30, '100MB-1GB'))
+LARGEST_SIZE = '>1GB'
+UNKNOWN_SIZE = 'unknown'
+
+# What reingestall submits (_reingest_package) and what purgeall purges
+# (_purge_package); the size is the stored one or that of the last job
+_CANDIDATES = '''
+    SELECT * FROM (
+        SELECT r.package_id, g.name AS organization, {format_case} AS detected_format,
+               coalesce(r.size, CAST(CAST(nullif(t.value, '') AS json) -> 'fingerprint' ->> 'size' AS bigint)),
+               coalesce(lower(r.extras::json ->> 'spatial_parent') IN :true_values, false) AS spatial_parent,
+               nullif(r.extras::json ->> 'spatial_child_of', '') AS spatial_child_of
+        FROM resource r
+        JOIN package p ON p.id = r.package_id
+        LEFT JOIN "group" g ON g.id = p.owner_org
+        LEFT JOIN task_status t ON t.entity_id = r.id AND t.task_type = 'spatial_ingest' AND t.key = :key
+        WHERE r.state = 'active' AND p.state = 'active') candidates
+    WHERE {where}'''
+
+_WHERE = {REINGEST: 'detected_format IS NOT NULL AND spatial_child_of IS NULL',
+          PURGE: 'spatial_parent'}
+
+# Median duration of finished jobs per format and size, per format, per
+# size and overall. Resources without history fall back to their last
+# job in task_status.
+_DURATIONS = '''
+    WITH durations AS (
+        SELECT input_format AS format, bytes AS size, duration
+        FROM spatialingestor_job_history
+        WHERE job_type = :job_type AND outcome = 'complete' AND duration IS NOT NULL
+        UNION ALL
+        SELECT value::json ->> 'input_format',
+               CAST(value::json -> 'fingerprint' ->> 'size' AS bigint),
+               extract(epoch FROM last_updated - CAST(value::json ->> 'submitted' AS timestamp))
+        FROM task_status t
+        WHERE key = :key AND task_type = :job_type AND state = 'complete' AND value LIKE '%"submitted"%'
+          AND NOT EXISTS (SELECT 1 FROM spatialingestor_job_history h
+                          WHERE h.resource_id = t.entity_id AND h.job_type = t.task_type)),
+    bucketed AS (
+        SELECT format, {bucket} AS bucket, duration FROM durations WHERE duration >= 0)
+    SELECT GROUPING(format, bucket), format, bucket, percentile_cont(0.5) WITHIN GROUP (ORDER BY duration)
+    FROM bucketed
+    GROUP BY GROUPING SETS ((format, bucket), (format), (bucket), ())'''
+
+
+def size_bucket(size):
+    if size is None:
+        return UNKNOWN_SIZE
+    for limit, name in SIZE_BUCKETS:
+        if size < limit:
+            return name
+    return LARGEST_SIZE
+
+
+def _bucket_sql(column):
+    '''SQL mirroring :func:`size_bucket`.'''
+    whens = ' '.join("WHEN {0} < {1} THEN '{2}'".format(column, limit, name) for limit, name in SIZE_BUCKETS)
+    return "CASE WHEN {0} IS NULL THEN '{1}' {2} ELSE '{3}' END".format(column, UNKNOWN_SIZE, whens, LARGEST_SIZE)
+
+
+def durations(job_type):
+    '''Median job durations in seconds keyed by ``(format, bucket)``,
+    ``(format, None)``, ``(None, bucket)`` and ``(None, None)`` for all jobs.'''
+    rows = model.Session.execute(text(_DURATIONS.format(bucket=_bucket_sql('size'))), {
+        'job_type': job_type, 'key': lifecycle.KEY}).fetchall()
+    medians = {}
+    for grouping, fmt, bucket, median in rows:
+        # GROUPING() sets bit 1 when the format is aggregated, bit 0 for the size
+        medians[(None if grouping & 2 else fmt or '', None if grouping & 1 else bucket)] = median
+    return medians
+
+
+def _median(medians, fmt, bucket):
+    for key in ((fmt or '', bucket), (fmt or '', None), (None, bucket), (None, None)):
+        if medians.get(key) is not None:
+            return medians[key]
+    return None
+
+
+def build(operation, concurrency):
+    '''Plan ``reingestall`` or ``purgeall`` without changing anything.
+
+    The candidates are streamed in one read-only transaction and counted
+    per organization, format and size bucket. Each group is estimated
+    from the median duration of past jobs of the same format and size,
+    and the total from ``concurrency`` jobs running at a time.
+
+    :returns: the plan, see :func:`write`
+    '''
+    if operation not in JOB_TYPES:
+        raise ValueError('Cannot plan {0!r}, use one of {1}'.format(operation, ', '.join(sorted(JOB_TYPES))))
+
+    # Nothing below writes, the database enforces it
+    model.Session.rollback()
+    model.Session.execute('SET TRANSACTION READ ONLY')
+    try:
+        params = {'true_values': discovery.TRUE_VALUES, 'key': lifecycle.KEY}
+        sql = _CANDIDATES.format(format_case=discovery.format_case(params), where=_WHERE[operation])
+        groups = {}
+        package_ids = set()
+        for package_id, organization, fmt, size, _, _ in reconcile.stream(sql, params):
+            package_ids.add(package_id)
+            group = groups.setdefault((organization, fmt, size_bucket(size)), [0, 0])
+            group[0] += 1
+            group[1] += size or 0
+        medians = durations(JOB_TYPES[operation])
+    finally:
+        model.Session.rollback()
+
+    rows = []
+    for (organization, fmt, bucket), (count, size) in groups.items():
+        median = _median(medians, fmt, bucket)
+        rows.append({'organization': organization,
+                     'format': fmt,
+                     'size_bucket': bucket,
+                     'resources': count,
+                     'bytes': size,
+                     'estimated_seconds': median * count if median is not None else None})
+    rows.sort(key=lambda r: (-(r['estimated_seconds'] or 0), -r['resources']))
+
+    job_seconds = sum(r['estimated_seconds'] for r in rows if r['estimated_seconds'] is not None)
+    longest = max([_median(medians, r['format'], r['size_bucket']) or 0 for r in rows] or [0])
+    return {'operation': operation,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'concurrency': concurrency,
+            'packages': len(package_ids),
+            'resources': sum(r['resources'] for r in rows),
+            'bytes': sum(r['bytes'] for r in rows),
+            'unestimated_resources': sum(r['resources'] for r in rows if r['estimated_seconds'] is None),
+            # Jobs run concurrency at a time, but no faster than the slowest one
+            'estimated_seconds': max(job_seconds / max(concurrency, 1), longest) if rows and medians else None,
+            'groups': rows,
+            'package_ids': sorted(package_ids)}
+
+
+def write(plan, path):
+    with open(path, 'w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+
+
+def load(path, operation):
+    '''The plan written to ``path`` for ``operation``.
+
+    :raises ValueError: if the file is not a plan for ``operation``
+    '''
+    with open(path) as f:
+        plan = json.load(f)
+    if not isinstance(plan, dict) or 'package_ids' not in plan:
+        raise ValueError('{0} is not a spatialingestor plan'.format(path))
+    if plan.get('operation') != operation:
+        raise ValueError('{0} is a plan for {1}, not {2}'.format(path, plan.get('operation'), operation))
+    return plan
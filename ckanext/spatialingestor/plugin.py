@@ -3,9 +3,8 @@ from ckan.common import _
 from ckan.lib import base
 from ckan.lib import helpers as core_helpers
 from ckan.plugins import toolkit
-from pylons import config
 
-from ckanext.spatialingestor import helpers
+from ckanext.spatialingestor import blacklist, callbacks, formats, helpers, memo, metrics, outbox, scheduler, settings
 from ckanext.spatialingestor.logic import auth, action
 
 
@@ -17,6 +16,7 @@ class SpatialIngestorPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IDomainObjectModification, inherit=True)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     legacy_mode = False
     resource_show_action = None
@@ -24,26 +24,60 @@ class SpatialIngestorPlugin(plugins.SingletonPlugin):
 
     def update_config(self, config):
         toolkit.add_template_directory(config, 'templates')
+        # Fails fast on a missing or malformed option
+        blacklist.load(settings.load(config))
+        metrics.load(config)
+        # Rebuilt on first use, once every ISpatialFormats plugin is loaded
+        formats.reset()
 
     def notify(self, entity, operation=None):
+        # Runs inside the commit of the triggering change, so only record
+        # what has to be done; `paster spatialingestor worker` does the rest.
         if isinstance(entity, model.Resource):
-            resource_dict = model.Resource.get(entity.id).as_dict()
-            if helpers.is_spatially_ingestible_resource(resource_dict):
-                d_type = model.domain_object.DomainObjectOperation
-                auto_ingest = toolkit.asbool(config.get('ckan.spatialingestor.auto_ingest', 'False'))
-                is_spatial_parent = toolkit.asbool(resource_dict.get('spatial_parent', 'False'))
-                if operation == d_type.deleted or entity.state == 'deleted':
-                    helpers.log.error(">>>>>>> Registered Purge Trigger")
-                    toolkit.get_action('spatialingestor_purge_resource_datastores')({}, resource_dict)
-
-                    package_dict = model.Package.get(resource_dict['package_id']).as_dict()
-                    if package_dict['state'] != 'deleted':
-                        helpers.log.error(">>>>>>> Registered Orphan Delete Trigger")
-                        toolkit.get_action('spatialingestor_delete_orphaned_resources')({}, package_dict)
-                elif (is_spatial_parent and (operation == d_type.changed or not operation)) or (
-                        operation == d_type.new and auto_ingest):
-                    helpers.log.error(">>>>>>> Registered Ingest Trigger")
-                    toolkit.get_action('spatialingestor_ingest_resource')({}, resource_dict)
+            with metrics.timer('notify_seconds'):
+                self._notify_resource(entity, operation)
+
+    def _notify_resource(self, entity, operation):
+        resource_dict = entity.as_dict()
+        if helpers.is_spatially_ingestible_resource(resource_dict):
+            d_type = model.domain_object.DomainObjectOperation
+            auto_ingest = settings.get().auto_ingest
+            is_spatial_parent = toolkit.asbool(resource_dict.get('spatial_parent', 'False'))
+            if operation == d_type.deleted or entity.state == 'deleted':
+                helpers.log.debug("Queueing purge of resource {0}".format(entity.id))
+                metrics.inc('triggers_total', operation=outbox.PURGE)
+                outbox.enqueue(outbox.PURGE, entity.id)
+
+                package = model.Package.get(entity.package_id)
+                if package.state != 'deleted':
+                    helpers.log.debug("Queueing orphan cleanup of package {0}".format(package.id))
+                    metrics.inc('triggers_total', operation=outbox.ORPHANS)
+                    outbox.enqueue(outbox.ORPHANS, package.id)
+            elif (is_spatial_parent and (operation == d_type.changed or not operation)) or (
+                    operation == d_type.new and auto_ingest):
+                helpers.log.debug("Queueing ingest of resource {0}".format(entity.id))
+                metrics.inc('triggers_total', operation=outbox.INGEST)
+                outbox.enqueue(outbox.INGEST, entity.id)
+        elif self._should_sniff(resource_dict, entity, operation):
+            # The format may be missing or wrong, let the worker look at the content
+            helpers.log.debug("Queueing format sniff of resource {0}".format(entity.id))
+            metrics.inc('triggers_total', operation='sniff')
+            outbox.enqueue(outbox.INGEST, entity.id, {'sniff': True})
+
+    def _should_sniff(self, resource_dict, entity, operation):
+        d_type = model.domain_object.DomainObjectOperation
+        current = settings.get()
+        if not (current.sniff and current.auto_ingest) or entity.state == 'deleted':
+            return False
+        if operation not in (d_type.new, d_type.changed) or not resource_dict.get('url'):
+            return False
+        # Only uploads and resources without a format, not every CSV edit
+        if resource_dict.get('url_type') != 'upload' and resource_dict.get('format'):
+            return False
+        return not resource_dict.get('spatial_child_of') and not helpers.is_resource_blacklisted(resource_dict)
+
+    def make_middleware(self, app, config):
+        return callbacks.HookMiddleware(app)
 
     def before_map(self, m):
         m.connect(
@@ -55,26 +89,45 @@ class SpatialIngestorPlugin(plugins.SingletonPlugin):
     def get_actions(self):
         return {'spatialingestor_job_submit': action.spatialingestor_job_submit,
                 'spatialingestor_hook': action.spatialingestor_hook,
+                'spatialingestor_hook_batch': action.spatialingestor_hook_batch,
                 'spatialingestor_status': action.spatialingestor_status,
+                'spatialingestor_status_list': action.spatialingestor_status_list,
+                'spatialingestor_metrics': action.spatialingestor_metrics,
+                'spatialingestor_job_stats': action.spatialingestor_job_stats,
                 'spatialingestor_ingest_resource': action.ingest_resource,
                 'spatialingestor_purge_resource_datastores': action.purge_resource_datastores,
                 'spatialingestor_delete_orphaned_resources': action.delete_orphaned_resources}
 
     def get_auth_functions(self):
         return {'spatialingestor_job_submit': auth.spatialingestor_job_submit,
-                'spatialingestor_status': auth.spatialingestor_status}
+                'spatialingestor_status': auth.spatialingestor_status,
+                'spatialingestor_status_list': auth.spatialingestor_status_list,
+                'spatialingestor_metrics': auth.spatialingestor_metrics,
+                'spatialingestor_job_stats': auth.spatialingestor_job_stats}
 
     def get_helpers(self):
         return {'spatialingestor_status_description': helpers.spatialingestor_status_description,
+                'spatialingestor_chunk_description': helpers.spatialingestor_chunk_description,
                 'spatialingestor_is_spatially_ingestible_resource': helpers.is_spatially_ingestible_resource}
 
 
 class ResourceSpatialController(base.BaseController):
     def resource_spatialingest(self, resource_id):
+        # Share the lookups of this request between the actions it calls
+        context = {'model': model, 'session': model.Session, 'user': toolkit.c.user,
+                   'auth_user_obj': toolkit.c.userobj, memo.CONTEXT_KEY: memo.Memo()}
         if toolkit.request.method == 'POST':
             try:
-                resource_dict = toolkit.get_action('resource_show')({}, {'id': resource_id})
-                toolkit.get_action('spatialingestor_ingest_resource')({}, resource_dict)
+                # The worker submits as the site user, so check the requester here
+                toolkit.check_access('spatialingestor_job_submit', context, {'resource_id': resource_id,
+                                                                             'job_type': 'spatial_ingest'})
+            except logic.NotAuthorized:
+                base.abort(401, _('Unauthorized to ingest this resource'))
+            try:
+                memo.show('resource_show', context, {'id': resource_id})
+                # Manual triggers skip the scheduler's queue and caps
+                outbox.enqueue(outbox.INGEST, resource_id, {'force': True, 'priority': scheduler.MANUAL})
+                model.Session.commit()
             except logic.ValidationError:
                 pass
 
@@ -84,19 +137,15 @@ class ResourceSpatialController(base.BaseController):
                 resource_id=resource_id)
             )
         try:
-            toolkit.c.resource = toolkit.get_action('resource_show')(
-                None, {'id': resource_id}
-            )
-            toolkit.c.pkg_dict = toolkit.get_action('package_show')(
-                None, {'id': toolkit.c.resource['package_id']}
-            )
+            toolkit.c.resource = memo.show('resource_show', context, {'id': resource_id})
+            toolkit.c.pkg_dict = memo.show('package_show', context, {'id': toolkit.c.resource['package_id']})
         except logic.NotFound:
             base.abort(404, _('Resource not found'))
         except logic.NotAuthorized:
             base.abort(401, _('Unauthorized to edit this resource'))
 
         try:
-            spatialingestor_status = toolkit.get_action('spatialingestor_status')(None, {
+            spatialingestor_status = toolkit.get_action('spatialingestor_status')(dict(context), {
                 'resource_id': resource_id,
                 'job_type': 'spatial_ingest'
             })
@@ -0,0 +1,415 @@
+import datetime
+import json
+import logging
+from collections import namedtuple
+
+import psycopg2
+from ckan import model
+from sqlalchemy import orm, text
+
+from ckanext.spatialingestor import chunks, client, discovery, lifecycle, outbox, settings
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+WATERMARK_KEY = 'ckanext.spatialingestor.reconcile_watermark'
+
+# Tables the microservice creates are named after the parent resource ID
+TABLE_PATTERN = '^[0-9a-f]{8}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{4}_[0-9a-f]{12}$'
+
+MISSING_TABLE = 'missing_table'
+MISSING_COVERAGE = 'missing_coverage'
+ORPHANED_TABLE = 'orphaned_table'
+UNKNOWN_TABLE = 'unknown_table'
+MISSING_WORKSPACE = 'missing_workspace'
+EMPTY_WORKSPACE = 'empty_workspace'
+ORPHANED_WORKSPACE = 'orphaned_workspace'
+UNKNOWN_WORKSPACE = 'unknown_workspace'
+ORPHANED_CHILD = 'orphaned_child'
+
+Drift = namedtuple('Drift', ['kind', 'name', 'package_id', 'resource_id'])
+
+CkanTable = namedtuple('CkanTable', ['name', 'resource_id', 'package_id', 'package_name', 'parent', 'format',
+                                     'state'])
+
+CkanWorkspace = namedtuple('CkanWorkspace', ['name', 'package_id', 'expected', 'ingested'])
+
+_SPATIAL_PARENT = "coalesce(lower(r.extras::json ->> 'spatial_parent') IN :true_values, false)"
+
+
+def merge(expected, actual):
+    '''Diff two streams sorted by name in one pass.
+
+    :param expected: ``(name, item)`` pairs that should exist
+    :param actual: names that do exist
+    :returns: iterator of ``(item, name)`` for names that exist as
+        expected, ``(item, None)`` for missing and ``(None, name)`` for
+        unexpected ones
+    '''
+    expected, actual = iter(expected), iter(actual)
+    want = next(expected, None)
+    have = next(actual, None)
+    while want is not None or have is not None:
+        if have is None or (want is not None and want[0] < have):
+            yield want[1], None
+            want = next(expected, None)
+        elif want is None or have < want[0]:
+            yield None, have
+            have = next(actual, None)
+        else:
+            yield want[1], have
+            want = next(expected, None)
+            have = next(actual, None)
+
+
+def stream(sql, params, batch_size=1000):
+    '''Rows of ``sql`` read through a server-side cursor, ``batch_size`` at
+    a time, on the connection of the current CKAN session.'''
+    result = model.Session.connection().execution_options(stream_results=True).execute(text(sql), **params)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def ckan_tables(since=None):
+    '''Resources of CKAN as :class:`CkanTable`, ordered by table name.
+
+    Without ``since`` every resource ever submitted for ingestion is
+    returned, going by its ``spatial_ingest`` task, including deleted and
+    purged ones. With ``since`` every resource of a dataset modified after
+    that time is returned. ``parent`` tells whether it is an active spatial
+    parent, ``format`` is the detected input format and ``state`` that of
+    the ``spatial_ingest`` task, None if it was never submitted.
+    '''
+    params = {'true_values': discovery.TRUE_VALUES, 'key': lifecycle.KEY}
+    task = "t.task_type = 'spatial_ingest' AND t.key = :key"
+    if since is None:
+        source = '''task_status t
+        LEFT JOIN resource r ON r.id = t.entity_id
+        LEFT JOIN package p ON p.id = r.package_id'''
+        where = task
+    else:
+        source = '''resource r
+        JOIN package p ON p.id = r.package_id
+        LEFT JOIN task_status t ON t.entity_id = r.id AND {0}'''.format(task)
+        where = 'p.metadata_modified > :since'
+        params['since'] = since
+    rows = stream('''
+        SELECT replace(coalesce(r.id, t.entity_id), '-', '_'), coalesce(r.id, t.entity_id), r.package_id, p.name,
+               coalesce(r.state = 'active' AND p.state = 'active' AND {parent}, false), {format_case}, t.state
+        FROM {source}
+        WHERE {where}
+        ORDER BY 1 COLLATE "C"'''.format(parent=_SPATIAL_PARENT, format_case=discovery.format_case(params),
+                                         source=source, where=where), params)
+    return (CkanTable(*row) for row in rows)
+
+
+def ingested(row):
+    '''Whether a :class:`CkanTable` was ever submitted for ingestion, so a
+    table named after it was created by the microservice.'''
+    return row.state is not None
+
+
+def has_table(row):
+    '''Whether the microservice should have created a PostGIS table for a
+    :class:`CkanTable`: vector parents whose last ingest completed.
+    Rasters are served from a GeoServer coverage instead.'''
+    return row.parent and row.state == 'complete' and row.format not in chunks.RASTER_FORMATS
+
+
+def has_coverage(row):
+    '''Whether a :class:`CkanTable` should have a GeoServer coverage layer.'''
+    return row.parent and row.state == 'complete' and row.format in chunks.RASTER_FORMATS
+
+
+def ckan_workspaces(since=None):
+    '''Datasets of CKAN as :class:`CkanWorkspace`, ordered by name.
+
+    ``expected`` tells whether the dataset has active spatial parents and so
+    should have a GeoServer workspace, ``ingested`` whether any of its
+    resources was ever submitted for ingestion, so a workspace named after
+    it was created by the microservice. Without ``since`` only datasets
+    that are either are returned, ``since`` works as in :func:`ckan_tables`.
+    '''
+    params = {'true_values': discovery.TRUE_VALUES, 'key': lifecycle.KEY}
+    expected = "p.state = 'active' AND coalesce(bool_or(r.state = 'active' AND {0}), false)".format(
+        _SPATIAL_PARENT)
+    ingested = 'bool_or(t.id IS NOT NULL)'
+    if since is None:
+        where, having = 'true', 'HAVING ({0}) OR {1}'.format(expected, ingested)
+    else:
+        where, having = 'p.metadata_modified > :since', ''
+        params['since'] = since
+    rows = stream('''
+        SELECT p.name, p.id, {expected}, {ingested}
+        FROM package p
+        LEFT JOIN resource r ON r.package_id = p.id
+        LEFT JOIN task_status t ON t.entity_id = r.id AND t.task_type = 'spatial_ingest' AND t.key = :key
+        WHERE {where}
+        GROUP BY p.id, p.name {having}
+        ORDER BY 1 COLLATE "C"'''.format(expected=expected, ingested=ingested, where=where, having=having), params)
+    return (CkanWorkspace(*row) for row in rows)
+
+
+def postgis_connection():
+    info = settings.get().postgis
+    return psycopg2.connect(dbname=info['db_name'], user=info['db_user'], password=info['db_pass'],
+                            host=info['db_host'], port=info.get('db_port') or None)
+
+
+def postgis_tables(connection, schema, names=None, batch_size=1000):
+    '''Names of the ingested tables in ``schema``, ordered by name, in one
+    catalog query read through a server-side cursor.'''
+    # WITH HOLD so dropping tables in between does not close the cursor
+    cursor = connection.cursor('spatialingestor_reconcile', withhold=True)
+    cursor.itersize = batch_size
+    sql = 'SELECT tablename FROM pg_tables WHERE schemaname = %(schema)s AND tablename ~ %(pattern)s'
+    params = {'schema': schema, 'pattern': TABLE_PATTERN}
+    if names is not None:
+        sql += ' AND tablename = ANY(%(names)s)'
+        params['names'] = list(names)
+    cursor.execute(sql + ' ORDER BY tablename COLLATE "C"', params)
+    try:
+        for row in cursor:
+            yield row[0]
+    finally:
+        cursor.close()
+
+
+def drop_tables(connection, schema, names):
+    '''Drop ``names`` from ``schema`` in one statement.'''
+    if not names:
+        return
+    cursor = connection.cursor()
+    try:
+        cursor.execute('DROP TABLE IF EXISTS {0}'.format(
+            ', '.join('"{0}"."{1}"'.format(schema, name) for name in names)))
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+class GeoServer(object):
+    '''The few GeoServer REST calls the extension needs.'''
+
+    def __init__(self, rest):
+        self.rest = rest
+
+    @classmethod
+    def from_config(cls):
+        info = settings.get().geoserver
+        base_url = '{0}://{1}{2}/{3}/rest/'.format(
+            info['db_type'], info['db_host'], ':' + info['db_port'] if info.get('db_port') else '',
+            info['db_name'])
+        return cls(client.from_config(base_url, auth=(info['db_user'], info['db_pass'])))
+
+    def _list(self, path, container, item):
+        r = self.rest.get(path, headers={'Accept': 'application/json'})
+        r.raise_for_status()
+        # GeoServer answers with an empty string instead of an empty list
+        return (r.json().get(container) or {}).get(item) or []
+
+    def workspaces(self):
+        return sorted(w['name'] for w in self._list('workspaces.json', 'workspaces', 'workspace'))
+
+    def layers(self):
+        '''Names of all layers, ``workspace:layer``, from a single listing.'''
+        return [layer['name'] for layer in self._list('layers.json', 'layers', 'layer')]
+
+    def layer_counts(self, layers=None):
+        '''``{workspace: number of layers}`` from a single listing.'''
+        counts = {}
+        for name in (self.layers() if layers is None else layers):
+            workspace, _, _ = name.rpartition(':')
+            counts[workspace] = counts.get(workspace, 0) + 1
+        return counts
+
+    def delete_workspace(self, name):
+        self.rest.delete('workspaces/{0}?recurse=true'.format(name)).raise_for_status()
+
+    def seed(self, layer, zoom_stop, mime_format, gridset):
+        '''Ask GeoWebCache to seed zoom levels 0 to ``zoom_stop`` of ``layer``
+        in the background.'''
+        self.rest.post('../gwc/rest/seed/{0}.json'.format(layer), headers={'Content-Type': 'application/json'},
+                       data=json.dumps({'seedRequest': {'name': layer,
+                                                        'gridSetId': gridset,
+                                                        'zoomStart': 0,
+                                                        'zoomStop': zoom_stop,
+                                                        'format': mime_format,
+                                                        'type': 'seed',
+                                                        'threadCount': 1}})).raise_for_status()
+
+
+def get_watermark():
+    return model.get_system_info(WATERMARK_KEY)
+
+
+def set_watermark(value):
+    model.set_system_info(WATERMARK_KEY, value)
+
+
+class Reconciler(object):
+    '''Finds and repairs drift between CKAN, PostGIS and GeoServer.
+
+    Each inventory is streamed in name order and diffed as a sorted
+    merge, so memory use does not grow with the catalogue. Datasets that
+    are missing artifacts are queued for a forced reingest, and datasets
+    with orphaned spatial children are queued for cleanup. Leftover tables
+    and workspaces of ingested resources are only removed with ``drop``;
+    those the ingestor has no record of are reported and never removed.
+    Repairs are applied ``batch_size`` at a time; with ``dry_run`` drift
+    is only reported.
+    '''
+
+    def __init__(self, connection, geoserver, schema='public', dry_run=False, batch_size=100, session=None,
+                 drop=False):
+        self.connection = connection
+        # Repairs are committed on their own session, the inventories are
+        # still being streamed from model.Session
+        self.session = session or orm.sessionmaker(bind=model.meta.engine)()
+        self.geoserver = geoserver
+        self.schema = schema
+        self.dry_run = dry_run
+        self.drop = drop
+        self.batch_size = batch_size
+        self._layers = None
+
+    @classmethod
+    def from_config(cls, **kwargs):
+        return cls(postgis_connection(), GeoServer.from_config(),
+                   schema=settings.get().postgis_schema, **kwargs)
+
+    def layers(self):
+        '''GeoServer layer names, listed once per run.'''
+        if self._layers is None:
+            self._layers = self.geoserver.layers()
+        return self._layers
+
+    def table_drift(self, since=None):
+        rows = ckan_tables(since)
+        names = None
+        if since is not None:
+            # Only look at the tables of the datasets that changed
+            rows = list(rows)
+            names = [row.name for row in rows]
+        coverages = None
+        for row, name in merge(((row.name, row) for row in rows), postgis_tables(self.connection, self.schema, names)):
+            if name is not None:
+                # A parent still being ingested or that failed keeps its table, if any
+                if row is None or not (row.parent or ingested(row)):
+                    yield Drift(UNKNOWN_TABLE, name, None, None)
+                elif not row.parent:
+                    yield Drift(ORPHANED_TABLE, name, row.package_id, row.resource_id)
+            elif has_table(row):
+                yield Drift(MISSING_TABLE, row.name, row.package_id, row.resource_id)
+            elif has_coverage(row):
+                if coverages is None:
+                    coverages = frozenset(self.layers())
+                layer = '{0}:{1}'.format(row.package_name, row.name)
+                if layer not in coverages:
+                    yield Drift(MISSING_COVERAGE, layer, row.package_id, row.resource_id)
+
+    def workspace_drift(self, since=None):
+        rows = ckan_workspaces(since)
+        workspaces = self.geoserver.workspaces()
+        if since is not None:
+            rows = list(rows)
+            names = set(row.name for row in rows)
+            workspaces = [w for w in workspaces if w in names]
+        layer_counts = self.geoserver.layer_counts(self.layers())
+
+        for row, name in merge(((row.name, row) for row in rows), workspaces):
+            if name is None:
+                if row.expected:
+                    yield Drift(MISSING_WORKSPACE, row.name, row.package_id, None)
+            elif row is None or not (row.expected or row.ingested):
+                # GeoServer's sample workspaces, those of other applications
+                yield Drift(UNKNOWN_WORKSPACE, name, None, None)
+            elif not row.expected:
+                yield Drift(ORPHANED_WORKSPACE, name, row.package_id, None)
+            elif not layer_counts.get(name):
+                yield Drift(EMPTY_WORKSPACE, name, row.package_id, None)
+
+    def child_drift(self, package_ids=None):
+        for candidate in discovery.orphaned_children(discovery.iter_candidates(package_ids=package_ids)):
+            yield Drift(ORPHANED_CHILD, candidate.resource_id, candidate.package_id, candidate.resource_id)
+
+    def repair(self, batch):
+        reingest = [d.resource_id for d in batch if d.kind in (MISSING_TABLE, MISSING_COVERAGE)]
+        reingest_packages = set(d.package_id for d in batch if d.kind in (MISSING_WORKSPACE, EMPTY_WORKSPACE))
+        if reingest_packages:
+            reingest.extend(c.resource_id for c in
+                            discovery.iter_candidates(package_ids=reingest_packages, parents_only=True))
+        for resource_id in set(reingest):
+            outbox.enqueue(outbox.INGEST, resource_id, {'force': True}, session=self.session)
+        for package_id in set(d.package_id for d in batch if d.kind == ORPHANED_CHILD):
+            outbox.enqueue(outbox.ORPHANS, package_id, session=self.session)
+        self.session.commit()
+
+        if not self.drop:
+            return
+        drop_tables(self.connection, self.schema, [d.name for d in batch if d.kind == ORPHANED_TABLE])
+
+        for drift in batch:
+            if drift.kind == ORPHANED_WORKSPACE:
+                try:
+                    self.geoserver.delete_workspace(drift.name)
+                except Exception, e:
+                    log.error('Could not delete workspace {0}: {1}'.format(drift.name, str(e)))
+
+    def run(self, since=None, report=None):
+        '''Reconcile everything, or only datasets modified after ``since``.
+
+        :param report: called with each :class:`Drift` found
+        :returns: ``{drift kind: count}``
+        '''
+        package_ids = None
+        if since is not None:
+            package_ids = [row[0] for row in model.Session.query(model.Package.id).filter(
+                model.Package.metadata_modified > since)]
+
+        counts = {}
+        batch = []
+        streams = (self.table_drift(since), self.workspace_drift(since), self.child_drift(package_ids))
+        for drifts in streams:
+            for drift in drifts:
+                counts[drift.kind] = counts.get(drift.kind, 0) + 1
+                if report:
+                    report(drift)
+                if not self.dry_run:
+                    batch.append(drift)
+                    if len(batch) >= self.batch_size:
+                        self.repair(batch)
+                        batch = []
+        if batch:
+            self.repair(batch)
+        return counts
+
+
+def reconcile(incremental=False, dry_run=False, batch_size=100, report=None, drop=False):
+    '''Run a :class:`Reconciler` from the config, moving the watermark of
+    incremental runs forward unless ``dry_run`` is set.'''
+    started = datetime.datetime.utcnow()
+    since = None
+    if incremental:
+        watermark = get_watermark()
+        if watermark:
+            since = datetime.datetime.strptime(watermark, '%Y-%m-%dT%H:%M:%S.%f')
+        else:
+            log.info('No reconcile watermark yet, checking everything')
+
+    reconciler = Reconciler.from_config(dry_run=dry_run, batch_size=batch_size, drop=drop)
+    try:
+        counts = reconciler.run(since, report)
+    finally:
+        reconciler.connection.close()
+        reconciler.session.close()
+
+    if not dry_run:
+        set_watermark(started.strftime('%Y-%m-%dT%H:%M:%S.%f'))
+    return counts
@@ -0,0 +1,168 @@
+import datetime
+import heapq
+import logging
+from collections import namedtuple
+
+from ckan import model
+from sqlalchemy import text
+
+from ckanext.spatialingestor import discovery
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+MANUAL = 'manual'
+
+# task_status states of jobs the microservice has not finished yet
+IN_FLIGHT_STATES = ('submitting', 'pending', 'running')
+
+# Organizations are identified by name, like the org_weights setting
+Candidate = namedtuple('Candidate', ['id', 'resource_id', 'organization', 'format', 'size', 'manual', 'available_at'])
+
+
+class Scheduler(object):
+    '''Decides which pending ingest entries of the outbox run next.
+
+    Jobs still running at the microservice are read from ``task_status``
+    and counted per organization and per input format. Candidates are then
+    picked by weighted fair queuing across organizations, smallest input
+    first within an organization, without exceeding the per-organization
+    and per-format concurrency caps. Manual triggers go first and are not
+    capped.
+    '''
+
+    def __init__(self, max_per_org=0, max_per_format=None, org_weights=None, window=500,
+                 in_flight_timeout=6 * 3600):
+        self.max_per_org = max_per_org
+        self.max_per_format = max_per_format or {}
+        self.org_weights = org_weights or {}
+        self.window = window
+        self.in_flight_timeout = in_flight_timeout
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(max_per_org=settings.scheduler_max_per_org,
+                   max_per_format=settings.scheduler_max_per_format,
+                   org_weights=settings.scheduler_org_weights,
+                   window=settings.scheduler_window,
+                   in_flight_timeout=settings.scheduler_in_flight_timeout)
+
+    def in_flight(self):
+        '''Count unfinished jobs as ``({org name: n}, {format: n})``.
+
+        Jobs not updated for ``in_flight_timeout`` seconds are assumed lost
+        so they do not hold a slot forever.
+        '''
+        params = {'states': IN_FLIGHT_STATES,
+                  'cutoff': datetime.datetime.utcnow() - datetime.timedelta(seconds=self.in_flight_timeout)}
+        rows = model.Session.execute(text('''
+            SELECT g.name, {format_case} AS format, count(*)
+            FROM task_status t
+            JOIN resource r ON r.id = t.entity_id
+            JOIN package p ON p.id = r.package_id
+            LEFT JOIN "group" g ON g.id = p.owner_org
+            WHERE t.key = 'spatialingestor' AND t.task_type = 'spatial_ingest'
+              AND t.state IN :states AND t.last_updated > :cutoff
+            GROUP BY 1, 2'''.format(format_case=discovery.format_case(params))), params).fetchall()
+
+        by_org, by_format = {}, {}
+        for organization, fmt, count in rows:
+            by_org[organization] = by_org.get(organization, 0) + count
+            if fmt:
+                by_format[fmt] = by_format.get(fmt, 0) + count
+        return by_org, by_format
+
+    def candidates(self):
+        '''Up to ``window`` due ingest entries with what is needed to rank them.
+
+        Manual triggers come first, then the entries of all organizations
+        take turns, each organization's smallest and oldest first, so one
+        organization with a long backlog cannot fill the window. At most
+        ``max_per_org`` entries of an organization are considered, as no
+        more of them can be submitted.
+        '''
+        params = {'now': datetime.datetime.utcnow(),
+                  'window': self.window,
+                  'per_org': min(self.max_per_org, self.window) if self.max_per_org else self.window}
+        rows = model.Session.execute(text('''
+            SELECT id, entity_id, organization, format, size, manual, available_at FROM (
+                SELECT due.*, row_number() OVER (
+                    PARTITION BY organization ORDER BY manual DESC, size, available_at) AS turn
+                FROM (
+                    SELECT pending.id, pending.entity_id, g.name AS organization, {format_case} AS format, r.size,
+                           coalesce(pending.payload::json ->> 'priority' = :manual, false) AS manual,
+                           pending.available_at
+                    FROM spatialingestor_outbox pending
+                    LEFT JOIN resource r ON r.id = pending.entity_id
+                    LEFT JOIN package p ON p.id = r.package_id
+                    LEFT JOIN "group" g ON g.id = p.owner_org
+                    WHERE pending.operation = 'ingest' AND pending.state = 'pending'
+                      AND pending.available_at <= :now
+                      AND NOT EXISTS (
+                          SELECT 1 FROM spatialingestor_outbox running
+                          WHERE running.state = 'running'
+                            AND running.operation = pending.operation
+                            AND running.entity_id = pending.entity_id)) due) ranked
+            WHERE manual OR turn <= :per_org
+            ORDER BY manual DESC, turn, available_at
+            LIMIT :window'''.format(format_case=discovery.format_case(params))),
+            dict(params, manual=MANUAL)).fetchall()
+        return [Candidate(row[0], row[1], row[2], row[3], row[4], bool(row[5]), row[6]) for row in rows]
+
+    def select(self, candidates, in_flight, limit):
+        '''Pick up to ``limit`` candidates, in the order they should run.
+
+        :param in_flight: ``({org name: n}, {format: n})`` as returned by
+            :meth:`in_flight`
+        '''
+        by_org, by_format = dict(in_flight[0]), dict(in_flight[1])
+        selected = []
+
+        def take(candidate):
+            selected.append(candidate)
+            by_org[candidate.organization] = by_org.get(candidate.organization, 0) + 1
+            if candidate.format:
+                by_format[candidate.format] = by_format.get(candidate.format, 0) + 1
+
+        queues = {}
+        for candidate in candidates:
+            if candidate.manual:
+                if len(selected) < limit:
+                    take(candidate)
+            else:
+                queues.setdefault(candidate.organization, []).append(candidate)
+
+        # Smallest inputs first, unknown sizes last, then oldest first
+        for queue in queues.values():
+            queue.sort(key=lambda c: (c.size is None, c.size, c.available_at), reverse=True)
+
+        def virtual_time(org):
+            return float(by_org.get(org, 0)) / self.org_weights.get(org, 1)
+
+        heap = [(virtual_time(org), org) for org in queues]
+        heapq.heapify(heap)
+        while heap and len(selected) < limit:
+            _, org = heapq.heappop(heap)
+            if self.max_per_org and by_org.get(org, 0) >= self.max_per_org:
+                continue
+            queue = queues[org]
+            for i in range(len(queue) - 1, -1, -1):
+                fmt = queue[i].format
+                if not fmt or by_format.get(fmt, 0) < self.max_per_format.get(fmt, float('inf')):
+                    take(queue.pop(i))
+                    break
+            else:
+                # Everything left for this organization is format capped
+                continue
+            if queue:
+                heapq.heappush(heap, (virtual_time(org), org))
+        return selected
+
+    def next_batch(self, limit):
+        '''IDs of the outbox entries to claim next, in run order.'''
+        candidates = self.candidates()
+        if not candidates:
+            return []
+        selected = self.select(candidates, self.in_flight(), limit)
+        if len(selected) < len(candidates):
+            log.debug('Scheduler picked {0} of {1} pending ingests'.format(len(selected), len(candidates)))
+        return [c.id for c in selected]
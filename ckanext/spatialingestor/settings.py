@@ -0,0 +1,176 @@
+import re
+from collections import namedtuple
+
+from ckan.plugins import toolkit
+
+PREFIX = 'ckan.spatialingestor.'
+
+# Served by callbacks.HookMiddleware
+HOOK_PATH = '/api/spatialingestor/hook'
+
+REQUIRED = ('ckan.spatialingestor.url', 'ckan.spatialingestor.postgis_url',
+            'ckan.spatialingestor.internal_geoserver_url')
+
+Settings = namedtuple('Settings', [
+    # Microservice
+    'url', 'site_url', 'callback_url', 'postgis', 'geoserver', 'public_geoserver_url', 'target_spatial_formats',
+    'postgis_schema', 'ckan_user', 'sniff', 'sniff_bytes', 'callback_secret', 'callback_token_ttl',
+    'api_key_cache_ttl',
+    # Split jobs
+    'chunk_min_size', 'chunk_tile_size', 'chunk_features', 'chunk_max_attempts',
+    # Job history
+    'history_size', 'history_max_age', 'compact_after',
+    # Completed layers
+    'describe_layers', 'seed_zoom_levels', 'vector_tiles', 'package_extent', 'extent_overwrite',
+    # Triggers
+    'auto_ingest', 'quiet_window', 'quiet_window_max', 'status_refresh_after',
+    # Blacklists
+    'org_blacklist', 'pkg_blacklist', 'user_blacklist', 'blacklist_cache_ttl',
+    # Connections
+    'connect_timeout', 'read_timeout', 'retries', 'backoff_factor', 'pool_size', 'breaker_threshold',
+    'breaker_reset',
+    # Worker and scheduler
+    'worker_poll_interval', 'worker_max_attempts', 'scheduler_max_per_org', 'scheduler_max_per_format',
+    'scheduler_org_weights', 'scheduler_window', 'scheduler_in_flight_timeout',
+    # Admission control
+    'admission_high_water', 'admission_reserve', 'admission_queue_path', 'admission_queue_ttl',
+])
+
+
+class ConfigError(Exception):
+    pass
+
+
+def _parse_pairs(value, convert=int):
+    '''Parse ``"GRID:2 SHP:10"`` into ``{'GRID': 2, 'SHP': 10}``.'''
+    pairs = {}
+    for item in (value or '').split():
+        name, _, number = item.rpartition(':')
+        if not name:
+            raise ValueError('Expected name:number, got {0!r}'.format(item))
+        pairs[name] = convert(number)
+    return pairs
+
+
+# Same format as ckan.lib.cli.parse_db_config, which only reads the global config
+_URL_PATTERN = re.compile(r'^\s*(?P<db_type>\w*)://(?P<db_user>[^:]*):?(?P<db_pass>[^@]*)@'
+                          r'(?P<db_host>[^/:]*):?(?P<db_port>[^/]*)/(?P<db_name>[\w.-]*)')
+
+
+def _db_config(config, key):
+    match = _URL_PATTERN.match(config[key])
+    if not match:
+        raise ConfigError('Config option `{0}` is not a valid URL.'.format(key))
+    return match.groupdict()
+
+
+def build(config):
+    '''Parse and validate the ``ckan.spatialingestor.*`` options.
+
+    :raises ConfigError: if an option is missing or malformed
+    '''
+    for key in REQUIRED:
+        if not config.get(key):
+            raise ConfigError('Config option `{0}` must be set to use the SpatialIngestor.'.format(key))
+
+    def get(name, default=None):
+        return config.get(PREFIX + name, default)
+
+    site_url = config.get('ckan.site_url', 'http://localhost:8000/')
+    callback_secret = (get('callback_secret') or '').encode('utf-8')
+    try:
+        return Settings(
+            url=get('url'),
+            site_url=site_url,
+            # Signed callbacks go to the lightweight endpoint
+            callback_url=site_url.rstrip('/') + (HOOK_PATH if callback_secret else
+                                                 '/api/3/action/spatialingestor_hook'),
+            postgis=_db_config(config, PREFIX + 'postgis_url'),
+            geoserver=_db_config(config, PREFIX + 'internal_geoserver_url'),
+            public_geoserver_url=get('public_geoserver_url', site_url + '/geoserver'),
+            target_spatial_formats=tuple(sorted(set(x.upper() for x in toolkit.aslist(get('target_formats', []))))),
+            postgis_schema=get('postgis_schema', 'public'),
+            ckan_user=get('ckan_user'),
+            sniff=toolkit.asbool(get('sniff', 'False')),
+            sniff_bytes=toolkit.asint(get('sniff_bytes', 4096)),
+            callback_secret=callback_secret,
+            callback_token_ttl=toolkit.asint(get('callback_token_ttl', 7 * 24 * 3600)),
+            api_key_cache_ttl=toolkit.asint(get('api_key_cache_ttl', 300)),
+
+            chunk_min_size=toolkit.asint(get('chunk_min_size', 0)),
+            chunk_tile_size=toolkit.asint(get('chunk_tile_size', 4096)),
+            chunk_features=toolkit.asint(get('chunk_features', 1000000)),
+            chunk_max_attempts=toolkit.asint(get('chunk_max_attempts', 3)),
+
+            history_size=toolkit.asint(get('history_size', 10)),
+            history_max_age=toolkit.asint(get('history_max_age', 90)),
+            compact_after=toolkit.asint(get('compact_after', 30)),
+
+            describe_layers=toolkit.asbool(get('describe_layers', 'True')),
+            seed_zoom_levels=toolkit.asint(get('seed_zoom_levels', 0)),
+            vector_tiles=toolkit.asbool(get('vector_tiles', 'False')),
+            package_extent=toolkit.asbool(get('package_extent', 'True')),
+            extent_overwrite=toolkit.asbool(get('extent_overwrite', 'False')),
+
+            auto_ingest=toolkit.asbool(get('auto_ingest', 'False')),
+            quiet_window=toolkit.asint(get('quiet_window', 5)),
+            quiet_window_max=toolkit.asint(get('quiet_window_max', 60)),
+            status_refresh_after=toolkit.asint(get('status_refresh_after', 0)),
+
+            org_blacklist=tuple(toolkit.aslist(get('org_blacklist', []))),
+            pkg_blacklist=tuple(toolkit.aslist(get('pkg_blacklist', []))),
+            user_blacklist=tuple(toolkit.aslist(get('user_blacklist', []))),
+            blacklist_cache_ttl=toolkit.asint(get('blacklist_cache_ttl', 30)),
+
+            connect_timeout=float(get('connect_timeout', 5)),
+            read_timeout=float(get('read_timeout', 30)),
+            retries=toolkit.asint(get('retries', 3)),
+            backoff_factor=float(get('backoff_factor', 0.5)),
+            pool_size=toolkit.asint(get('pool_size', 10)),
+            breaker_threshold=toolkit.asint(get('breaker_threshold', 5)),
+            breaker_reset=float(get('breaker_reset', 30)),
+
+            worker_poll_interval=toolkit.asint(get('worker.poll_interval', 2)),
+            worker_max_attempts=toolkit.asint(get('worker.max_attempts', 5)),
+            scheduler_max_per_org=toolkit.asint(get('scheduler.max_per_org', 0)),
+            scheduler_max_per_format=dict((k.upper(), v) for k, v in
+                                          _parse_pairs(get('scheduler.max_per_format')).items()),
+            scheduler_org_weights=_parse_pairs(get('scheduler.org_weights'), float),
+            scheduler_window=toolkit.asint(get('scheduler.window', 500)),
+            scheduler_in_flight_timeout=toolkit.asint(get('scheduler.in_flight_timeout', 6 * 3600)),
+
+            admission_high_water=toolkit.asint(get('admission.high_water', 0)),
+            admission_reserve=toolkit.asint(get('admission.reserve', 10)),
+            admission_queue_path=get('admission.queue_path'),
+            admission_queue_ttl=toolkit.asint(get('admission.queue_ttl', 5)),
+        )
+    except ValueError, e:
+        raise ConfigError('Invalid spatialingestor configuration: {0}'.format(e))
+
+
+_settings = None
+
+
+def load(config):
+    '''Build the settings once, at startup (``update_config``).'''
+    global _settings
+    _settings = build(config)
+    return _settings
+
+
+def get():
+    if _settings is None:
+        raise ConfigError('The spatialingestor settings have not been loaded, is the plugin enabled?')
+    return _settings
+
+
+def reload(config):
+    '''Rebuild the settings and everything derived from them, for tests
+    that change the configuration.'''
+    from ckanext.spatialingestor import blacklist, client, formats
+
+    load(config)
+    client.reset()
+    formats.reset()
+    blacklist.load(_settings)
+    return _settings
@@ -0,0 +1,23 @@
+from ckanext.spatialingestor import settings as settings_module
+
+
+class FakeSettings(object):
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class SettingsMixin(object):
+    '''Serves ``overrides`` from ``settings.get()`` during each test, as
+    ``self.settings``.'''
+
+    overrides = {}
+
+    def setUp(self):
+        super(SettingsMixin, self).setUp()
+        self._get = settings_module.get
+        self.settings = FakeSettings(**self.overrides)
+        settings_module.get = lambda: self.settings
+
+    def tearDown(self):
+        settings_module.get = self._get
+        super(SettingsMixin, self).tearDown()
@@ -0,0 +1,24 @@
+import unittest
+
+from ckanext.spatialingestor.logic.action import _int_param
+
+
+class TestIntParam(unittest.TestCase):
+
+    def test_default_when_missing_or_empty(self):
+        errors = {}
+        self.assertEqual(_int_param({}, 'limit', 100, 1, errors), 100)
+        self.assertEqual(_int_param({'limit': ''}, 'limit', 100, 1, errors), 100)
+        self.assertEqual(errors, {})
+
+    def test_errors_are_reported_under_their_own_key(self):
+        errors = {}
+        _int_param({'max_age': 'soon'}, 'max_age', None, None, errors)
+        _int_param({'offset': '-1'}, 'offset', 0, 0, errors)
+        _int_param({'limit': '0'}, 'limit', 100, 1, errors)
+        self.assertEqual(sorted(errors), ['limit', 'max_age', 'offset'])
+
+    def test_valid_values(self):
+        errors = {}
+        self.assertEqual(_int_param({'offset': '20'}, 'offset', 0, 0, errors), 20)
+        self.assertEqual(errors, {})
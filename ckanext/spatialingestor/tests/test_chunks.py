@@ -0,0 +1,94 @@
+import json
+import unittest
+
+from ckanext.spatialingestor import chunks
+from ckanext.spatialingestor.tests import SettingsMixin
+
+_CHUNK_SETTINGS = {'chunk_max_attempts': 3, 'chunk_min_size': 1000, 'chunk_tile_size': 256, 'chunk_features': 500}
+
+
+class FakeResult(object):
+    def __init__(self, row):
+        self.row = row
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeChunkSession(object):
+    '''Applies the chunk upsert of chunks.record to a dict.'''
+
+    def __init__(self):
+        self.chunks = {}
+
+    def execute(self, statement, params):
+        key = (params['resource_id'], params['chunk_index'])
+        previous = self.chunks.get(key)
+        row = dict(params, attempts=params['failed'] + (previous['attempts'] if previous else 0))
+        self.chunks[key] = row
+        return FakeResult((row['attempts'],))
+
+
+class FakeModel(object):
+    def __init__(self, session):
+        self.Session = session
+
+
+class TestRecord(SettingsMixin, unittest.TestCase):
+
+    overrides = _CHUNK_SETTINGS
+
+    def setUp(self):
+        super(TestRecord, self).setUp()
+        self._model, self._ready = chunks.model, chunks._ready
+        self.session = FakeChunkSession()
+        chunks.model = FakeModel(self.session)
+        # The fake session stands in for the table
+        chunks._ready = True
+
+    def tearDown(self):
+        chunks.model, chunks._ready = self._model, self._ready
+        super(TestRecord, self).tearDown()
+
+    def test_failed_chunk_is_retried_up_to_max_attempts(self):
+        chunk = {'index': 2, 'status': 'error', 'error': {'message': 'boom'}}
+        self.assertEqual([chunks.record('res', 'job', chunk) for _ in range(4)], [True, True, False, False])
+
+    def test_other_states_are_not_retried_or_counted(self):
+        for status in ('pending', 'running', 'complete'):
+            self.assertFalse(chunks.record('res', 'job', {'index': 0, 'status': status}))
+        self.assertEqual(self.session.chunks[('res', 0)]['attempts'], 0)
+
+    def test_attempts_are_counted_per_chunk(self):
+        chunks.record('res', 'job', {'index': 0, 'status': 'error'})
+        chunks.record('res', 'job', {'index': 0, 'status': 'error'})
+        self.assertTrue(chunks.record('res', 'job', {'index': 1, 'status': 'error'}))
+        self.assertTrue(chunks.record('other', 'job', {'index': 0, 'status': 'error'}))
+
+    def test_detail_and_error_are_kept(self):
+        chunks.record('res', 'job', {'index': '4', 'status': 'error', 'rows': 10, 'error': {'message': 'boom'}})
+        row = self.session.chunks[('res', 4)]
+        self.assertEqual((row['job_id'], row['state']), ('job', 'error'))
+        self.assertEqual(json.loads(row['detail']), {'rows': 10})
+        self.assertEqual(json.loads(row['error']), {'message': 'boom'})
+
+    def test_invalid_chunks_are_rejected(self):
+        for chunk in (None, {'status': 'complete'}, {'index': 'x', 'status': 'complete'},
+                      {'index': 1, 'status': 'done'}):
+            self.assertRaises(ValueError, chunks.record, 'res', 'job', chunk)
+        self.assertEqual(self.session.chunks, {})
+
+
+class TestPlan(SettingsMixin, unittest.TestCase):
+
+    overrides = _CHUNK_SETTINGS
+
+    def test_small_or_unknown_sizes_run_whole(self):
+        for size in (None, 0, 999, 'x'):
+            self.assertEqual(chunks.plan(size, 'SHP'), None)
+
+    def test_rasters_are_split_into_tiles(self):
+        self.assertEqual(chunks.plan(1000, 'GEOTIFF'), {'strategy': 'tiles', 'tile_size': 256})
+
+    def test_vectors_are_split_into_feature_ranges(self):
+        self.assertEqual(chunks.plan('5000', 'SHP'), {'strategy': 'features', 'features_per_chunk': 500})
@@ -0,0 +1,137 @@
+import unittest
+
+import requests
+
+from ckanext.spatialingestor import client
+from ckanext.spatialingestor.client import CircuitBreaker, CircuitOpenError, MicroserviceClient
+
+
+class FakeResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSession(object):
+    '''Answers each request with the next outcome, raising exceptions.'''
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def _refused():
+    reason = client.NewConnectionError(None, 'Connection refused')
+    return requests.exceptions.ConnectionError(requests.packages.urllib3.exceptions.MaxRetryError(
+        None, 'http://localhost/', reason))
+
+
+class TestRequestRetries(unittest.TestCase):
+
+    def request(self, method, outcomes, retries=2):
+        c = MicroserviceClient('http://localhost/', retries=retries, backoff_factor=0,
+                               breaker=CircuitBreaker(threshold=100))
+        c._session = FakeSession(outcomes)
+        c._pid = client.os.getpid()
+        try:
+            return c.request(method, 'job'), c._session.calls
+        except requests.exceptions.RequestException, e:
+            return e, c._session.calls
+
+    def test_get_is_retried_on_5xx(self):
+        response, calls = self.request('GET', [503, 200])
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+    def test_get_is_retried_on_read_timeout(self):
+        response, calls = self.request('GET', [requests.exceptions.ReadTimeout(), 200])
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+    def test_get_gives_up_after_retries(self):
+        response, calls = self.request('GET', [502, 502, 502])
+        self.assertEqual((response.status_code, calls), (502, 3))
+
+    def test_post_is_not_retried_on_5xx(self):
+        response, calls = self.request('POST', [500, 200])
+        self.assertEqual((response.status_code, calls), (500, 1))
+
+    def test_post_is_not_retried_on_read_timeout(self):
+        error, calls = self.request('POST', [requests.exceptions.ReadTimeout(), 200])
+        self.assertTrue(isinstance(error, requests.exceptions.ReadTimeout))
+        self.assertEqual(calls, 1)
+
+    def test_post_is_retried_on_connect_timeout(self):
+        response, calls = self.request('POST', [requests.exceptions.ConnectTimeout(), 200])
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+    def test_post_is_retried_when_refused(self):
+        response, calls = self.request('POST', [_refused(), 200])
+        self.assertEqual((response.status_code, calls), (200, 2))
+
+    def test_post_is_not_retried_on_reset_connection(self):
+        error, calls = self.request('POST', [requests.exceptions.ConnectionError('Connection aborted'), 200])
+        self.assertTrue(isinstance(error, requests.exceptions.ConnectionError))
+        self.assertEqual(calls, 1)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self._time = client.time.time
+        self.now = 1000.0
+        client.time.time = lambda: self.now
+
+    def tearDown(self):
+        client.time.time = self._time
+
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+    def test_success_resets_the_count(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+    def test_half_open_lets_one_call_through(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+        breaker.failure()
+        self.now += 30
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+        breaker.failure()
+        self.now += 30
+        breaker.allow()
+        breaker.failure()
+        self.now += 29
+        self.assertFalse(breaker.allow())
+
+    def test_successful_trial_closes(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+        breaker.failure()
+        self.now += 30
+        breaker.allow()
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def test_open_circuit_fails_without_calling(self):
+        c = MicroserviceClient('http://localhost/', breaker=CircuitBreaker(threshold=1))
+        c.breaker.failure()
+        c._session = FakeSession([])
+        c._pid = client.os.getpid()
+        self.assertRaises(CircuitOpenError, c.get, 'status')
+        self.assertEqual(c._session.calls, 0)
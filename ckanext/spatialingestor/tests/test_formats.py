@@ -0,0 +1,73 @@
+import unittest
+
+from ckanext.spatialingestor import formats
+from ckanext.spatialingestor.formats import DEFAULT_FORMATS, Registry
+from ckanext.spatialingestor.tests import SettingsMixin
+
+_ALL = [f.input_format for f in DEFAULT_FORMATS]
+
+
+class TestSniff(SettingsMixin, unittest.TestCase):
+
+    overrides = {'sniff_bytes': 4096}
+
+    def setUp(self):
+        super(TestSniff, self).setUp()
+        self._read_upload = formats._read_upload
+        self._read_remote = formats._read_remote
+        self.read = []
+        self.head = None
+        formats._read_upload = lambda resource, max_bytes: self.fake_read('upload', max_bytes)
+        formats._read_remote = lambda url, max_bytes: self.fake_read(url, max_bytes)
+        formats._registry = Registry(enabled=_ALL)
+
+    def tearDown(self):
+        formats._read_upload = self._read_upload
+        formats._read_remote = self._read_remote
+        formats.reset()
+        super(TestSniff, self).tearDown()
+
+    def fake_read(self, source, max_bytes):
+        self.read.append((source, max_bytes))
+        return self.head
+
+    def sniff(self, head, **resource):
+        self.head = head
+        return formats.sniff(resource)
+
+    def test_shapefile_signature(self):
+        self.assertEqual(self.sniff('\x00\x00\x27\x0a' + '\x00' * 96, url='http://x/data'), 'SHP')
+
+    def test_geopackage_signature_at_offset(self):
+        self.assertEqual(self.sniff('SQLite format 3\x00'.ljust(68, '\x00') + 'GP10', url='http://x/data'), 'GPKG')
+
+    def test_tiff_signatures(self):
+        self.assertEqual(self.sniff('II*\x00rest', url='http://x/a'), 'GEOTIFF')
+        self.assertEqual(self.sniff('MM\x00*rest', url='http://x/a'), 'GEOTIFF')
+
+    def test_text_markers(self):
+        self.assertEqual(self.sniff('\xef\xbb\xbf <?xml version="1.0"?><kml xmlns="x">', url='http://x/a'), 'KML')
+        self.assertEqual(self.sniff('\n{"type": "FeatureCollection", "features": []}', url='http://x/a'), 'GEOJSON')
+
+    def test_markers_only_count_in_text(self):
+        self.assertEqual(self.sniff('PK\x03\x04 "FeatureCollection"', url='http://x/a'), None)
+
+    def test_unknown_content(self):
+        self.assertEqual(self.sniff('%PDF-1.4', url='http://x/a'), None)
+
+    def test_disabled_formats_are_not_sniffed(self):
+        formats._registry = Registry(enabled=['SHP'])
+        self.assertEqual(self.sniff('II*\x00rest', url='http://x/a'), None)
+
+    def test_uploads_are_read_from_disk(self):
+        self.sniff('II*\x00', id='res', url='data.tif', url_type='upload')
+        self.assertEqual(self.read, [('upload', 4096)])
+
+    def test_remote_files_are_read_up_to_sniff_bytes(self):
+        self.sniff('II*\x00', url='http://x/data.tif')
+        self.assertEqual(self.read, [('http://x/data.tif', 4096)])
+
+    def test_nothing_to_read(self):
+        self.assertEqual(self.sniff('II*\x00'), None)
+        self.assertEqual(self.read, [])
+        self.assertEqual(self.sniff(None, url='http://x/gone'), None)
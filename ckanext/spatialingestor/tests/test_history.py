@@ -0,0 +1,31 @@
+import unittest
+
+from ckanext.spatialingestor import history
+from ckanext.spatialingestor.tests import SettingsMixin
+
+
+class NoModel(object):
+    '''Fails the test if the history table is touched.'''
+
+    def __getattr__(self, name):
+        raise AssertionError('The database was used')
+
+
+class TestDisabled(SettingsMixin, unittest.TestCase):
+
+    overrides = {'history_size': 0}
+
+    def setUp(self):
+        super(TestDisabled, self).setUp()
+        self._model = history.model
+        history.model = NoModel()
+
+    def tearDown(self):
+        history.model = self._model
+        super(TestDisabled, self).tearDown()
+
+    def test_record_is_skipped(self):
+        history.record('res', 'spatial_ingest', 'complete')
+
+    def test_recent_is_skipped(self):
+        self.assertEqual(history.recent('res', 'spatial_ingest'), [])
@@ -0,0 +1,138 @@
+import unittest
+
+from ckanext.spatialingestor import reconcile
+from ckanext.spatialingestor.reconcile import CkanTable, CkanWorkspace
+
+
+class FakeGeoServer(object):
+    def __init__(self, layers=(), workspaces=()):
+        self._layers = list(layers)
+        self._workspaces = sorted(workspaces)
+        self.deleted = []
+
+    def layers(self):
+        return self._layers
+
+    def workspaces(self):
+        return self._workspaces
+
+    def layer_counts(self, layers=None):
+        return reconcile.GeoServer(None).layer_counts(self._layers if layers is None else layers)
+
+    def delete_workspace(self, name):
+        self.deleted.append(name)
+
+
+def _row(name, package_name='dataset', fmt='SHP', state='complete', parent=True):
+    return CkanTable(name, name.replace('_', '-'), 'package-' + package_name, package_name, parent, fmt, state)
+
+
+class TestTableDrift(unittest.TestCase):
+
+    def setUp(self):
+        self._ckan_tables = reconcile.ckan_tables
+        self._postgis_tables = reconcile.postgis_tables
+
+    def tearDown(self):
+        reconcile.ckan_tables = self._ckan_tables
+        reconcile.postgis_tables = self._postgis_tables
+
+    def drift(self, rows, tables, layers=()):
+        reconcile.ckan_tables = lambda since=None: iter(sorted(rows))
+        reconcile.postgis_tables = lambda connection, schema, names=None: iter(sorted(tables))
+        reconciler = reconcile.Reconciler(None, FakeGeoServer(layers), session=object())
+        return [(d.kind, d.name) for d in reconciler.table_drift()]
+
+    def test_grid_parent_is_not_expected_to_have_a_table(self):
+        grid = _row('aaaa', fmt='GRID')
+        self.assertEqual(self.drift([grid], [], layers=['dataset:aaaa']), [])
+
+    def test_grid_parent_without_coverage(self):
+        grid = _row('aaaa', fmt='GRID')
+        self.assertEqual(self.drift([grid], []), [(reconcile.MISSING_COVERAGE, 'dataset:aaaa')])
+
+    def test_vector_parent_without_table(self):
+        self.assertEqual(self.drift([_row('aaaa')], []), [(reconcile.MISSING_TABLE, 'aaaa')])
+
+    def test_unfinished_parents_are_left_alone(self):
+        rows = [_row('aaaa', state='pending'), _row('bbbb', state='deferred'), _row('cccc', state='error'),
+                _row('dddd', state=None), _row('eeee', fmt='GRID', state='error')]
+        self.assertEqual(self.drift(rows, []), [])
+
+    def test_table_of_unfinished_parent_is_kept(self):
+        self.assertEqual(self.drift([_row('aaaa', state='pending')], ['aaaa']), [])
+
+    def test_table_of_ingested_non_parent_is_orphaned(self):
+        rows = [_row('aaaa'), _row('bbbb', parent=False, state='complete'), _row('cccc', parent=False, state='error')]
+        self.assertEqual(self.drift(rows, ['aaaa', 'bbbb', 'cccc']),
+                         [(reconcile.ORPHANED_TABLE, 'bbbb'), (reconcile.ORPHANED_TABLE, 'cccc')])
+
+    def test_table_without_ingest_task_is_unknown(self):
+        rows = [_row('aaaa'), _row('bbbb', parent=False, state=None)]
+        self.assertEqual(self.drift(rows, ['aaaa', 'bbbb', 'cccc']),
+                         [(reconcile.UNKNOWN_TABLE, 'bbbb'), (reconcile.UNKNOWN_TABLE, 'cccc')])
+
+
+class FakeReconcileSession(object):
+    def commit(self):
+        pass
+
+
+class TestRepair(unittest.TestCase):
+
+    def setUp(self):
+        self._drop_tables = reconcile.drop_tables
+        self.dropped = []
+        reconcile.drop_tables = lambda connection, schema, names: self.dropped.extend(names)
+
+    def tearDown(self):
+        reconcile.drop_tables = self._drop_tables
+
+    def repair(self, drop):
+        reconciler = reconcile.Reconciler(None, FakeGeoServer(), session=FakeReconcileSession(), drop=drop)
+        reconciler.repair([reconcile.Drift(reconcile.ORPHANED_TABLE, 'aaaa', None, None),
+                           reconcile.Drift(reconcile.UNKNOWN_TABLE, 'bbbb', None, None)])
+        return self.dropped
+
+    def test_nothing_is_dropped_by_default(self):
+        self.assertEqual(self.repair(drop=False), [])
+
+    def test_only_orphaned_tables_are_dropped(self):
+        self.assertEqual(self.repair(drop=True), ['aaaa'])
+
+
+class TestWorkspaceDrift(unittest.TestCase):
+
+    def setUp(self):
+        self._ckan_workspaces = reconcile.ckan_workspaces
+        rows = [CkanWorkspace('active', 'p1', True, True), CkanWorkspace('empty', 'p2', True, True),
+                CkanWorkspace('gone', 'p3', False, True), CkanWorkspace('missing', 'p4', True, False)]
+        reconcile.ckan_workspaces = lambda since=None: iter(rows)
+        self.geoserver = FakeGeoServer(layers=['active:aaaa'], workspaces=['active', 'cite', 'empty', 'gone', 'topp'])
+
+    def tearDown(self):
+        reconcile.ckan_workspaces = self._ckan_workspaces
+
+    def reconciler(self, drop):
+        return reconcile.Reconciler(None, self.geoserver, session=FakeReconcileSession(), drop=drop)
+
+    def test_drift(self):
+        self.assertEqual([(d.kind, d.name) for d in self.reconciler(False).workspace_drift()],
+                         [(reconcile.UNKNOWN_WORKSPACE, 'cite'), (reconcile.EMPTY_WORKSPACE, 'empty'),
+                          (reconcile.ORPHANED_WORKSPACE, 'gone'), (reconcile.MISSING_WORKSPACE, 'missing'),
+                          (reconcile.UNKNOWN_WORKSPACE, 'topp')])
+
+    def test_foreign_workspaces_survive_drop(self):
+        self._discovery = reconcile.discovery.iter_candidates
+        reconcile.discovery.iter_candidates = lambda package_ids=None, parents_only=False: iter([])
+        try:
+            reconciler = self.reconciler(True)
+            reconciler.repair(list(reconciler.workspace_drift()))
+        finally:
+            reconcile.discovery.iter_candidates = self._discovery
+        self.assertEqual(self.geoserver.deleted, ['gone'])
+
+    def test_nothing_is_deleted_by_default(self):
+        reconciler = self.reconciler(False)
+        reconciler.repair([d for d in reconciler.workspace_drift() if d.kind == reconcile.ORPHANED_WORKSPACE])
+        self.assertEqual(self.geoserver.deleted, [])
@@ -0,0 +1,107 @@
+import datetime
+import json
+import unittest
+
+from ckan import model
+from ckan.tests import factories, helpers
+
+from ckanext.spatialingestor import outbox
+from ckanext.spatialingestor.scheduler import MANUAL, Candidate, Scheduler
+
+_NOW = datetime.datetime(2020, 1, 1)
+
+
+def _candidate(id, organization='org', fmt='SHP', size=100, manual=False, age=0):
+    return Candidate(id, 'res-{0}'.format(id), organization, fmt, size, manual,
+                     _NOW - datetime.timedelta(seconds=age))
+
+
+def _ids(selected):
+    return [c.id for c in selected]
+
+
+class TestSelect(unittest.TestCase):
+
+    def test_smallest_first_then_oldest_unknown_sizes_last(self):
+        candidates = [_candidate(1, size=None, age=9), _candidate(2, size=500), _candidate(3, size=10, age=1),
+                      _candidate(4, size=10, age=5)]
+        self.assertEqual(_ids(Scheduler().select(candidates, ({}, {}), 10)), [4, 3, 2, 1])
+
+    def test_limit(self):
+        candidates = [_candidate(i) for i in range(5)]
+        self.assertEqual(len(Scheduler().select(candidates, ({}, {}), 2)), 2)
+
+    def test_organizations_take_turns(self):
+        candidates = [_candidate(1, 'a', size=1), _candidate(2, 'a', size=2), _candidate(3, 'a', size=3),
+                      _candidate(4, 'b', size=4), _candidate(5, 'b', size=5)]
+        self.assertEqual(sorted(_ids(Scheduler().select(candidates, ({}, {}), 4))), [1, 2, 4, 5])
+
+    def test_in_flight_jobs_count_against_an_organization(self):
+        candidates = [_candidate(1, 'a'), _candidate(2, 'b')]
+        self.assertEqual(_ids(Scheduler().select(candidates, ({'a': 3}, {}), 1)), [2])
+
+    def test_org_weights_are_keyed_by_name(self):
+        candidates = [_candidate(i, 'heavy', size=i) for i in range(1, 5)] + \
+                     [_candidate(i, 'light', size=i) for i in range(5, 9)]
+        scheduler = Scheduler(org_weights={'heavy': 3})
+        selected = scheduler.select(candidates, ({}, {}), 4)
+        self.assertEqual([c.organization for c in selected].count('heavy'), 3)
+
+    def test_max_per_org(self):
+        candidates = [_candidate(1, 'a', size=1), _candidate(2, 'a', size=2), _candidate(3, 'b')]
+        selected = Scheduler(max_per_org=2).select(candidates, ({'a': 1}, {}), 10)
+        self.assertEqual(sorted(_ids(selected)), [1, 3])
+
+    def test_max_per_format_skips_to_other_formats(self):
+        candidates = [_candidate(1, fmt='GRID', size=1), _candidate(2, fmt='SHP', size=2)]
+        selected = Scheduler(max_per_format={'GRID': 1}).select(candidates, ({}, {'GRID': 1}), 10)
+        self.assertEqual(_ids(selected), [2])
+
+    def test_manual_triggers_go_first_and_are_not_capped(self):
+        candidates = [_candidate(1, 'a', size=1), _candidate(2, 'a', size=50, manual=True)]
+        selected = Scheduler(max_per_org=1).select(candidates, ({'a': 1}, {}), 10)
+        self.assertEqual(_ids(selected), [2])
+
+
+class TestCandidates(unittest.TestCase):
+    '''Runs against the CKAN test database.'''
+
+    def setUp(self):
+        helpers.reset_db()
+        outbox.setup()
+        model.Session.execute(outbox.outbox_table.delete())
+        model.Session.commit()
+
+    def _queue(self, organization, count, manual=False, age=0):
+        org = factories.Organization(name=organization)
+        dataset = factories.Dataset(owner_org=org['id'])
+        now = datetime.datetime.utcnow()
+        for i in range(count):
+            resource = factories.Resource(package_id=dataset['id'], format='SHP',
+                                          url='http://example.com/{0}.shp'.format(i))
+            payload = {'priority': MANUAL} if manual else {}
+            model.Session.execute(outbox.outbox_table.insert().values(
+                operation=outbox.INGEST, entity_id=resource['id'], payload=json.dumps(payload),
+                available_at=now - datetime.timedelta(seconds=age + count - i)))
+        model.Session.commit()
+
+    def test_an_organization_cannot_fill_the_window(self):
+        self._queue('backlog', 8, age=3600)
+        self._queue('other', 2)
+        candidates = Scheduler(window=4).candidates()
+        self.assertEqual(len(candidates), 4)
+        self.assertEqual([c.organization for c in candidates].count('other'), 2)
+
+    def test_window_holds_no_more_of_an_organization_than_can_be_submitted(self):
+        self._queue('backlog', 8, age=3600)
+        self._queue('other', 1)
+        candidates = Scheduler(window=10, max_per_org=2).candidates()
+        self.assertEqual(sorted(c.organization for c in candidates), ['backlog', 'backlog', 'other'])
+
+    def test_late_manual_trigger_is_in_the_window_first(self):
+        self._queue('backlog', 8, age=3600)
+        self._queue('other', 1, manual=True)
+        candidates = Scheduler(window=4).candidates()
+        self.assertEqual(len(candidates), 4)
+        self.assertTrue(candidates[0].manual)
+        self.assertEqual(candidates[0].organization, 'other')
@@ -0,0 +1,47 @@
+import unittest
+
+from ckanext.spatialingestor import tokens
+from ckanext.spatialingestor.tests import SettingsMixin
+
+
+class TestTokens(SettingsMixin, unittest.TestCase):
+
+    overrides = {'callback_secret': 'secret', 'callback_token_ttl': 60}
+
+    def test_round_trip_returns_the_nonce(self):
+        token = tokens.issue('res', 'spatial_ingest', 'abc', now=1000)
+        self.assertEqual(tokens.verify(token, 'res', 'spatial_ingest', now=1030), 'abc')
+
+    def test_nonces_differ(self):
+        self.assertNotEqual(tokens.nonce(), tokens.nonce())
+
+    def test_other_resource_is_rejected(self):
+        token = tokens.issue('res', 'spatial_ingest', 'abc', now=1000)
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'other', 'spatial_ingest', now=1000)
+
+    def test_other_job_type_is_rejected(self):
+        token = tokens.issue('res', 'spatial_purge', 'abc', now=1000)
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1000)
+
+    def test_changed_nonce_is_rejected(self):
+        expires, _, signature = tokens.issue('res', 'spatial_ingest', 'abc', now=1000).split('.')
+        token = '.'.join([expires, 'def', signature])
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1000)
+
+    def test_changed_expiry_is_rejected(self):
+        _, nonce, signature = tokens.issue('res', 'spatial_ingest', 'abc', now=1000).split('.')
+        token = '.'.join(['99999', nonce, signature])
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1000)
+
+    def test_expired_token_is_rejected(self):
+        token = tokens.issue('res', 'spatial_ingest', 'abc', now=1000)
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1061)
+
+    def test_other_secret_is_rejected(self):
+        token = tokens.issue('res', 'spatial_ingest', 'abc', now=1000)
+        self.settings.callback_secret = 'other'
+        self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1000)
+
+    def test_malformed_tokens_are_rejected(self):
+        for token in ('', 'abc', 'x.abc.def', u'1000.\xe9.abc'):
+            self.assertRaises(tokens.InvalidToken, tokens.verify, token, 'res', 'spatial_ingest', now=1000)
@@ -0,0 +1,57 @@
+import hashlib
+import hmac
+import time
+import uuid
+
+from ckanext.spatialingestor import settings
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _signature(secret, resource_id, job_type, nonce, expires):
+    return hmac.new(secret, '{0}:{1}:{2}:{3}'.format(resource_id, job_type, nonce, expires),
+                    hashlib.sha256).hexdigest()
+
+
+def enabled():
+    return bool(settings.get().callback_secret)
+
+
+def nonce():
+    '''A new submission nonce, stored in the task value by the submitter.'''
+    return uuid.uuid4().hex
+
+
+def issue(resource_id, job_type, nonce, now=None):
+    '''A callback token for the submission ``nonce`` of a ``job_type`` job
+    of ``resource_id``, valid for ``ckan.spatialingestor.callback_token_ttl``
+    seconds.'''
+    current = settings.get()
+    expires = int((now or time.time()) + current.callback_token_ttl)
+    return '{0}.{1}.{2}'.format(expires, nonce, _signature(current.callback_secret, resource_id, job_type, nonce,
+                                                           expires))
+
+
+def verify(token, resource_id, job_type, now=None):
+    '''Check a token sent back with a job callback, without any lookup.
+
+    The caller still has to check that the nonce is that of the current
+    submission, so callbacks of a superseded job are rejected.
+
+    :returns: the submission nonce the token was issued for
+    :raises InvalidToken: if the token is malformed, expired or was not
+        issued for a ``job_type`` job of ``resource_id``
+    '''
+    try:
+        expires, nonce, signature = str(token).split('.', 2)
+        expires = int(expires)
+    except (UnicodeEncodeError, ValueError):
+        raise InvalidToken('Malformed callback token')
+    if expires < (now or time.time()):
+        raise InvalidToken('Expired callback token')
+    if not hmac.compare_digest(signature, _signature(settings.get().callback_secret, resource_id, job_type, nonce,
+                                                     expires)):
+        raise InvalidToken('Invalid callback token')
+    return nonce
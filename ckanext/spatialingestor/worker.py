@@ -0,0 +1,142 @@
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckanext.spatialingestor import admission, layers, metrics, outbox, settings
+from ckanext.spatialingestor.logic.action import IngestorUnavailable
+from ckanext.spatialingestor.scheduler import MANUAL, Scheduler
+
+log = logging.getLogger('ckanext_spatialingestor')
+
+
+def job_context():
+    user = settings.get().ckan_user
+    if not user:
+        user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})['name']
+    return {'model': model, 'session': model.Session, 'user': user, 'ignore_auth': True}
+
+
+def _ingest(context, entry):
+    resource = model.Resource.get(entry['entity_id'])
+    if resource is None or resource.state == 'deleted':
+        log.debug('Resource {0} is gone, dropping ingest'.format(entry['entity_id']))
+        return
+    context['force_ingest'] = entry['payload'].get('force', False)
+    context['sniff_format'] = entry['payload'].get('sniff', False)
+    # Manual triggers are not held back by admission control either
+    context['admitted'] = entry['payload'].get('priority') == MANUAL
+    toolkit.get_action('spatialingestor_ingest_resource')(context, resource.as_dict())
+
+
+def _purge(context, entry):
+    resource = model.Resource.get(entry['entity_id'])
+    if resource is None:
+        return
+    toolkit.get_action('spatialingestor_purge_resource_datastores')(context, resource.as_dict())
+
+
+def _orphans(context, entry):
+    package = model.Package.get(entry['entity_id'])
+    if package is None or package.state == 'deleted':
+        return
+    toolkit.get_action('spatialingestor_delete_orphaned_resources')(context, {'id': package.id})
+
+
+def _describe(context, entry):
+    resource = model.Resource.get(entry['entity_id'])
+    if resource is None or resource.state == 'deleted':
+        return
+    layers.process(context, resource.id)
+
+
+def _release(context, entry):
+    for job_type in sorted(entry['payload']):
+        data_dict = admission.submission(entry['entity_id'], job_type)
+        if data_dict is None:
+            log.debug('Deferred {0} of {1} was superseded'.format(job_type, entry['entity_id']))
+            continue
+        try:
+            toolkit.get_action('spatialingestor_job_submit')(dict(context, admitted=True), data_dict)
+        except IngestorUnavailable:
+            # Keep the released slot so the retry of this entry finds it
+            admission.hold(entry['entity_id'], job_type, data_dict)
+            raise
+        except toolkit.ValidationError, e:
+            # Recorded on the task by spatialingestor_job_submit
+            log.error(e)
+
+
+handlers = {
+    outbox.INGEST: _ingest,
+    outbox.PURGE: _purge,
+    outbox.ORPHANS: _orphans,
+    outbox.DESCRIBE: _describe,
+    outbox.RELEASE: _release,
+}
+
+
+class OutboxWorker(object):
+    '''Drains the outbox with a bounded pool of threads.
+
+    Each claimed entry runs the matching spatialingestor action in its own
+    thread-local session. Failed entries are retried with exponential
+    backoff until ``max_attempts`` is reached. Which ingests run next is
+    left to the :class:`~ckanext.spatialingestor.scheduler.Scheduler`.
+    '''
+
+    def __init__(self, workers=4, batch_size=None, poll_interval=2, max_attempts=5, stale_after=3600,
+                 scheduler=None):
+        self.workers = workers
+        self.batch_size = batch_size or workers * 2
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.scheduler = scheduler or Scheduler()
+        self.pool = ThreadPool(workers)
+
+    def process(self, entry):
+        try:
+            with metrics.timer('outbox_seconds', operation=entry['operation']):
+                handlers[entry['operation']](job_context(), entry)
+            outbox.complete(entry['id'])
+            metrics.inc('outbox_processed_total', operation=entry['operation'], outcome='done')
+        except Exception, e:
+            model.Session.rollback()
+            metrics.inc('outbox_processed_total', operation=entry['operation'], outcome='failed')
+            log.error('Outbox {0} of {1} failed (attempt {2}): {3}'.format(
+                entry['operation'], entry['entity_id'], entry['attempts'], str(e)))
+            if entry['attempts'] >= self.max_attempts:
+                outbox.fail(entry['id'], e)
+            else:
+                outbox.fail(entry['id'], e, retry_in=2 ** entry['attempts'])
+        finally:
+            model.Session.remove()
+
+    def run_once(self):
+        # Normally released by the callbacks of finished jobs, this catches
+        # capacity freed by jobs that never called back
+        admission.release()
+        entries = outbox.claim(self.batch_size, exclude_operations=[outbox.INGEST])
+        if len(entries) < self.batch_size:
+            ids = self.scheduler.next_batch(self.batch_size - len(entries))
+            entries.extend(outbox.claim(len(ids), ids=ids))
+        if entries:
+            self.pool.map(self.process, entries)
+        return len(entries)
+
+    def run(self):
+        requeued = outbox.requeue_stale(self.stale_after)
+        if requeued:
+            log.info('Requeued {0} stale outbox entries'.format(requeued))
+
+        log.info('Spatial ingestor worker started with {0} threads'.format(self.workers))
+        try:
+            while True:
+                if not self.run_once():
+                    time.sleep(self.poll_interval)
+        finally:
+            self.pool.close()
+            self.pool.join()